@@ -0,0 +1,95 @@
+import argparse
+import time
+import torch
+from torch.optim import Adam
+from torch.special import expit as sigmoid
+from datasets import load_dataset
+from wls_loss import wls_loss, FusedLoss
+
+
+def diag_loss(x_0, x_t, x, y, params, sensitives, basis, flat, consts, smoothing):
+    """
+    loss_fn_generator's eager loss as the driver runs it without --jit, n x n diag included
+    """
+    one_d = sigmoid(x_0 @ (sensitives * params))
+    diag = torch.diag(one_d)
+    denom = torch.inverse((torch.t(x) @ diag @ x) + flat)
+    difference_penalty = torch.abs(basis @ (denom @ (torch.t(x) @ diag @ y)) - consts[0].item())
+    size = torch.sum(one_d)/x.shape[0]
+    alpha, lam = consts[1:3].tolist(), consts[3].item()
+    size_penalty = lam*(max(alpha[0]-size, 0) + max(size-alpha[1], 0))
+    return size_penalty - .1*difference_penalty
+
+
+def bench_data(name, rows, seed):
+    """
+    The dataset's train-ready tensors as linearexpressivity builds them, resampled to rows rows if given
+    :return: x_0 with intercept column, x without it, y, sensitive mask
+    """
+    df, target, sensitive_features, _ = load_dataset(name)
+    df = df.copy()
+    if rows:
+        df = df.sample(rows, replace=True, random_state=seed)
+    features = [c for c in df.columns if c != target]
+    df.insert(len(features), 'Intercept', 1.)
+    x_0 = torch.tensor(df.drop(target, axis=1).values.astype('float16')).float()
+    y = torch.tensor(df[target].values).float()
+    sensitives = torch.zeros(x_0.shape[1])
+    sensitives[[features.index(f) for f in sensitive_features] + [x_0.shape[1] - 1]] = 1.
+    return x_0, x_0[:, :-1].contiguous(), y, sensitives
+
+
+def time_steps(loss, fused, x_0, x, y, sensitives, feature_num, alpha, lam, warmup, steps, seed):
+    """
+    Runs warmup + steps optimizer steps of linearexpressivity's training loop on loss
+    :return: seconds per step after warmup, final parameters
+    """
+    torch.manual_seed(seed)
+    params = torch.randn(x_0.shape[1], requires_grad=True)
+    optim = Adam(params=[params], lr=0.05, fused=fused)
+    basis = torch.zeros(1, x.shape[1])
+    basis[0, feature_num] = 1.
+    flat = torch.diag(torch.full((x.shape[1],), 0.00001))
+    x_t = torch.t(x).contiguous()
+    initial = torch.linalg.solve(torch.t(x) @ x + flat, torch.t(x) @ y)[feature_num].item()
+    consts = torch.tensor([initial, alpha[0], alpha[1], lam])
+    for i in range(warmup + steps):
+        if i == warmup:
+            start = time.perf_counter()
+        optim.zero_grad()
+        loss_res = loss(x_0, x_t, x, y, params, sensitives, basis, flat, consts, 0.)
+        loss_res.backward()
+        optim.step()
+    return (time.perf_counter() - start) / steps, params.detach()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Per-step time of the linearexpressivity loss, eager and fused')
+    parser.add_argument('--dataset', type=str, default='student', help='dataset name from datasets.DATASETS')
+    parser.add_argument('--rows', type=int, default=None, help='resample the dataset to this many rows')
+    parser.add_argument('--feature', type=int, default=0)
+    parser.add_argument('--alpha', type=float, nargs=2, default=[.1, .15])
+    parser.add_argument('--lam', type=float, default=10.)
+    parser.add_argument('--steps', type=int, default=300)
+    parser.add_argument('--warmup', type=int, default=10, help='untimed steps first, which include compilation')
+    parser.add_argument('--modes', type=str, nargs='+', default=['diag', 'eager', 'script', 'compile'],
+                        choices=['diag', 'eager', 'script', 'compile'])
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    x_0, x, y, sensitives = bench_data(args.dataset, args.rows, args.seed)
+    print(args.dataset, x_0.shape[0], "rows,", x_0.shape[1], "columns,", torch.get_num_threads(), "threads")
+    losses = {'diag': (diag_loss, False), 'eager': (wls_loss, False)}
+    times, finals = {}, {}
+    for mode in args.modes:
+        loss, fused = losses[mode] if mode in losses else (FusedLoss(mode), True)
+        times[mode], finals[mode] = time_steps(loss, fused, x_0, x, y, sensitives, args.feature, args.alpha,
+                                               args.lam, args.warmup, args.steps, args.seed)
+    reference = args.modes[0]
+    print(f"{'mode':<8} {'ms/step':>9} {'speedup':>8} {'max |params - ' + reference + '|':>24}")
+    for mode in args.modes:
+        print(f"{mode:<8} {1000 * times[mode]:>9.3f} {times[reference] / times[mode]:>7.2f}x "
+              f"{float(torch.max(torch.abs(finals[mode] - finals[reference]))):>24.2e}")
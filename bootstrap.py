@@ -0,0 +1,78 @@
+import numpy as np
+import torch
+
+
+def poisson_weights(n: int, n_boot: int, seed: int = 0, device=None) -> torch.Tensor:
+    """
+    Poisson bootstrap: each resample weights every row by an independent Poisson(1) count instead of drawing
+    exactly n rows, so resamples are rows of a weight matrix rather than index lists.
+    :return: n_boot x n weight matrix
+    """
+    gen = torch.Generator().manual_seed(seed)
+    return torch.poisson(torch.ones(n_boot, n, dtype=torch.float64), generator=gen).to(device)
+
+
+def bootstrap_coefficients(x: torch.Tensor, weights: torch.Tensor, y: torch.Tensor, feature_num: int,
+                           flatval: float, resample_weights: torch.Tensor, row_chunk: int = 1024) -> torch.Tensor:
+    """
+    Weighted least squares coefficient of one feature under every resample at once. Each resample's Gram matrix
+    is x^T diag(w * p_b) x, built for the whole batch a block of rows at a time and solved as one batch.
+    :param x: the data tensor without intercept column
+    :param weights: subgroup weight of each row, ones for the full dataset
+    :param y: the target tensor
+    :param feature_num: the feature to test
+    :param flatval: ridge term added to the Gram matrices
+    :param resample_weights: B x n resample weights
+    :param row_chunk: rows per block, bounds the weighted copy of x at B x row_chunk x d
+    :return: B coefficients, NaN for resamples whose Gram matrix is singular, e.g. when a resample drops every
+             row of a rare one-hot column and the ridge term is 0
+    """
+    pw = resample_weights * weights
+    grams = flatval * torch.eye(x.shape[1], dtype=x.dtype, device=x.device).repeat(pw.shape[0], 1, 1)
+    for start in range(0, x.shape[0], row_chunk):
+        block = x[start:start + row_chunk]
+        grams += (pw[:, start:start + row_chunk, None] * block).transpose(1, 2) @ block
+    rhs = pw @ (x * y[:, None])
+    coefficients, info = torch.linalg.solve_ex(grams, rhs)
+    coefficients = coefficients[:, feature_num]
+    coefficients[info != 0] = float('nan')
+    return coefficients
+
+
+def bootstrap_ci(x: torch.Tensor, assigns, y: torch.Tensor, feature_num: int, n_boot: int, flat_subgroup: float,
+                 flat_full: float, level: float = .95, seed: int = 0, chunk: int = 64) -> dict:
+    """
+    Percentile bootstrap intervals for F(D), F(S) and their difference, all computed on the same resamples.
+    :param x: the data tensor without intercept column
+    :param assigns: subgroup weight of each row
+    :param y: the target tensor
+    :param feature_num: the feature to test
+    :param n_boot: number of resamples
+    :param flat_subgroup: ridge term for F(S)
+    :param flat_full: ridge term for F(D)
+    :param level: coverage of the intervals
+    :param chunk: resamples per batch, bounds memory at chunk x n weights, a chunk x 1024 x d block of weighted
+                  rows and chunk x d x d Gram matrices
+    :return: dict from output column name to interval bound, over the resamples with nonsingular Gram matrices,
+             and the number of singular resamples left out
+    """
+    x, y = x.double(), y.double()
+    weights = torch.as_tensor(np.asarray(assigns), dtype=torch.float64, device=x.device)
+    ones = torch.ones_like(weights)
+    full, subgroup = [], []
+    for start in range(0, n_boot, chunk):
+        resample = poisson_weights(x.shape[0], min(chunk, n_boot - start), seed + start, x.device)
+        full.append(bootstrap_coefficients(x, ones, y, feature_num, flat_full, resample).cpu().numpy())
+        subgroup.append(bootstrap_coefficients(x, weights, y, feature_num, flat_subgroup, resample).cpu().numpy())
+    full, subgroup = np.concatenate(full), np.concatenate(subgroup)
+
+    # resamples where either solve failed are left out of all three intervals
+    kept = ~(np.isnan(full) | np.isnan(subgroup))
+    full, subgroup = full[kept], subgroup[kept]
+    tails = [100 * (1 - level) / 2, 100 * (1 + level) / 2]
+    out = {'bootstrap_singular': int(n_boot - kept.sum())}
+    for name, values in [('F(D)', full), ('max(F(S))', subgroup), ('Difference', np.abs(subgroup - full))]:
+        low, high = np.percentile(values, tails) if len(values) else (np.nan, np.nan)
+        out[f'{name}_ci_low'] = float(low)
+        out[f'{name}_ci_high'] = float(high)
+    return out
@@ -0,0 +1,59 @@
+import numpy as np
+from scipy import sparse
+
+
+class PatternCompression:
+    """
+    Groups rows by their pattern of sensitive feature values. Subgroup functions only see the sensitive columns,
+    so every row of a group gets the same membership, and anything an optimizer sums over rows can be summed over
+    the k groups instead once each group's rows are aggregated. On one-hot or low-cardinality sensitive features
+    k is usually far below n.
+    :param x_sensitive: n x s sensitive columns
+    """
+    def __init__(self, x_sensitive, chunk=65536):
+        x_sensitive = np.asarray(x_sensitive)
+        _, self.first, inverse, self.counts = np.unique(x_sensitive, axis=0, return_index=True,
+                                                        return_inverse=True, return_counts=True)
+        self.inverse = inverse.ravel()
+        self.n = len(self.inverse)
+        self.k = len(self.counts)
+        self.chunk = chunk
+        # k x n indicator, row g sums the rows of group g
+        self.members = sparse.csr_matrix((np.ones(self.n), (self.inverse, np.arange(self.n))), shape=(self.k, self.n))
+
+    def sum_rows(self, values):
+        """
+        :param values: n x ... per-row values, e.g. expressivities
+        :return: k x ... per-group sums
+        """
+        values = np.asarray(values, dtype=np.float64)
+        return (self.members @ values.reshape(self.n, -1)).reshape((self.k,) + values.shape[1:])
+
+    def grams(self, x):
+        """
+        :param x: n x d data
+        :return: k x d x d Gram blocks, x_g^T x_g of each group's rows
+        """
+        x = np.asarray(x, dtype=np.float64)
+        d = x.shape[1]
+        out = np.zeros((self.k, d * d))
+        for start in range(0, self.n, self.chunk):
+            block = x[start:start + self.chunk]
+            outer = (block[:, :, None] * block[:, None, :]).reshape(len(block), -1)
+            out += self.members[:, start:start + self.chunk] @ outer
+        return out.reshape(self.k, d, d)
+
+    def moments(self, x, y):
+        """
+        :return: k x d blocks x_g^T y_g
+        """
+        x = np.asarray(x, dtype=np.float64)
+        return self.sum_rows(x * np.asarray(y, dtype=np.float64)[:, None])
+
+    def expand(self, values):
+        """
+        Takes per-group values, e.g. memberships, back to rows.
+        :param values: k x ... values
+        :return: n x ... values
+        """
+        return values[self.inverse]
@@ -1,86 +1,247 @@
 from lime_exp_func import LimeExpFunc
-from constrained_solver import ConstrainedSolver
+from tree_exp_func import TreeShapExpFunc
+from constrained_solver import ConstrainedSolver, BatchConstrainedSolver
 from learner import Learner
+from reg_oracle import RegOracle, LinearPredictor, GramLinearRegression
 from sklearn import linear_model
+from scipy import sparse
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.model_selection import train_test_split
 import pandas as pd
 import numpy as np
-from aif360.datasets import CompasDataset, BankDataset
 import time
 import argparse
 from datetime import datetime
 import json
 import pdb
+from tracing import tracer
+from pipeline import ExpPipeline, ExpMatrix
+from compression import PatternCompression
+from exact_solver import best_selection, best_threshold
+from datasets import load_dataset, split_dataset, to_csr
 
 
 parser = argparse.ArgumentParser(description='Locally separable run')
 parser.add_argument('--dummy', action='store_true')
+parser.add_argument('--dataset', type=str, default='student', help='dataset name from datasets.DATASETS')
+parser.add_argument('--alpha', type=float, nargs=2, default=None, help='subgroup size band, e.g. --alpha .01 .05')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--t-split', type=float, default=None, help='test fraction, defaults to the dataset setting')
+parser.add_argument('--out', type=str, default=None, help='output csv path, defaults to a dated file under output_constrained/')
+parser.add_argument('--exp-backend', choices=['lime', 'treeshap'], default='lime',
+                    help='lime reads precomputed LIME values from data/exps/, treeshap computes exact tree attributions')
+parser.add_argument('--pipeline', action='store_true',
+                    help='compute expressivities in background processes instead of reading data/exps, optimizing as '
+                         'soon as train is explained while test is still being explained')
+parser.add_argument('--pipeline-chunk', type=int, default=64, help='rows per chunk streamed from --pipeline workers')
+parser.add_argument('--sequential', action='store_true',
+                    help='run the dual ascent one feature and direction at a time instead of all together')
+parser.add_argument('--compress', action='store_true',
+                    help='run the batched dual ascent over unique sensitive feature patterns instead of rows')
+parser.add_argument('--exact', action='store_true',
+                    help='take the best subgroup of the dual solver\'s threshold family exactly, by scanning sorted '
+                         'sensitive patterns, and report the optimum over any union of patterns')
+parser.add_argument('--optimum', action='store_true',
+                    help='add the exact threshold and pattern optima for the train split as reference columns')
+parser.add_argument('--sparse', action='store_true',
+                    help='fit the subgroup cost regressions on sparse copies of the data')
+parser.add_argument('--trace', type=str, default=None, help='append JSON phase timings to this file')
+parser.add_argument('--trace-memory', action='store_true', help='sample peak memory at the end of every span')
 args = parser.parse_args()
 dummy = args.dummy
+if args.trace:
+    tracer.enable(args.trace, memory=args.trace_memory)
+
+EXP_BACKENDS = {'lime': LimeExpFunc, 'treeshap': TreeShapExpFunc}
+
+
+def regression(x):
+    """
+    Cost regression for data x: sklearn's LinearRegression, or GramLinearRegression for scipy sparse x
+    """
+    return GramLinearRegression() if sparse.issparse(x) else linear_model.LinearRegression()
 
 
 def argmin_g(x, y, feature_num, f_sensitive, exp_func, minimize, alphas):
-    exp_order = np.mean([abs(exp_func.exps[i][feature_num]) for i in range(len(x))])
+    n = x.shape[0]
+    exp_order = np.mean([abs(exp_func.exps[i][feature_num]) for i in range(n)])
     solver = ConstrainedSolver(exp_func, alpha_s=alphas[0], alpha_L=alphas[1], B=10000*exp_order, nu=.000002)
-    v = .01*exp_order*len(x)
+    v = .01*exp_order*n
 
     x_sensitive = x[:,f_sensitive]
-    costs0 = [0 for _ in range(len(x))] # costs0 is always zeros
-    learner = Learner(x_sensitive, y, linear_model.LinearRegression())
+    costs0 = [0 for _ in range(n)] # costs0 is always zeros
+    learner = Learner(x_sensitive, y, regression(x))
 
     _ = 1
     start2 = time.time()
-    while solver.v_t > v:
-        if _%100==0:
-            print("ITERATION NUMBER ", _, "time:", time.time()-start2)
-            print(np.mean(assigns))
-            print(solver.v_t, ' | ',v)
-        solver.update_lambdas()
-
-        # CSC solver, returns regoracle fit using costs0/costs1
-        # h_t <- Best_h(lam_t)
-        current_lam = solver.lambda_history[-1]
-        if minimize:
-            costs1 = [exp_func.exps[i][feature_num]-current_lam[0]+current_lam[1] for i in range(len(x))]
-        else:
-            costs1 = [-exp_func.exps[i][feature_num]-current_lam[0]+current_lam[1] for i in range(len(x))]
-        l_response = learner.best_response(costs0, costs1)
-        solver.g_history.append(l_response)
-
-        assigns, cost = l_response.predict(x_sensitive)
-        expressivity = exp_func.get_total_exp(assigns, feature_num)
-        solver.pred_history.append(np.array(assigns))
-        solver.exp_history.append(expressivity)
-
-        # # Q^ <- avg(h_t), L_ceiling <- L(Q^, best_lam(Q^))
-        # avg_pred = [np.mean(k) for k in zip(*solver.pred_history)]
-        # best_lam = solver.best_lambda(avg_pred)
-        # L_ceiling = solver.lagrangian(avg_pred, best_lam, feature_num, minimize)
-        #
-        # # lam^ <- avg(lambda), L_floor <- L(best_h(lam^), lam^)
-        # avg_lam = [np.mean(k) for k in zip(*solver.lambda_history)]
-        # best_g = solver.best_g(learner, feature_num, avg_lam, minimize)
-        # best_g_assigns, best_g_costs = best_g.predict(x_sensitive)
-        # best_g_exps = exp_func.get_total_exp(best_g_assigns, feature_num)
-        # L_floor = solver.lagrangian(best_g_assigns, avg_lam, feature_num, minimize)
-        #
-        # L = solver.lagrangian(avg_pred, avg_lam, feature_num, minimize)
-        # solver.v_t = max(abs(L-L_floor), abs(L_ceiling-L))
-
-        if solver.phi_s(assigns)+solver.phi_L(assigns) == 0:
-            solver.v_t = 0
-        if _%800 == 0:
-            print('Max iterations reached')
-            solver.v_t = 0
-        solver.update_thetas(assigns)
-        _ += 1
+    direction = 'minimize' if minimize else 'maximize'
+    with tracer.span('feature_opt', feature=feature_num, direction=direction, alpha=alphas) as span:
+        while solver.v_t > v:
+            if _%100==0:
+                print("ITERATION NUMBER ", _, "time:", time.time()-start2)
+                print(np.mean(assigns))
+                print(solver.v_t, ' | ',v)
+            with tracer.span('solver_step'):
+                solver.update_lambdas()
+
+                # CSC solver, returns regoracle fit using costs0/costs1
+                # h_t <- Best_h(lam_t)
+                current_lam = solver.lambda_history[-1]
+                if minimize:
+                    costs1 = [exp_func.exps[i][feature_num]-current_lam[0]+current_lam[1] for i in range(n)]
+                else:
+                    costs1 = [-exp_func.exps[i][feature_num]-current_lam[0]+current_lam[1] for i in range(n)]
+                l_response = learner.best_response(costs0, costs1)
+                solver.g_history.append(l_response)
+
+                assigns, cost = l_response.predict(x_sensitive)
+                expressivity = exp_func.get_total_exp(assigns, feature_num)
+            solver.pred_history.append(np.array(assigns))
+            solver.exp_history.append(expressivity)
+
+            # # Q^ <- avg(h_t), L_ceiling <- L(Q^, best_lam(Q^))
+            # avg_pred = [np.mean(k) for k in zip(*solver.pred_history)]
+            # best_lam = solver.best_lambda(avg_pred)
+            # L_ceiling = solver.lagrangian(avg_pred, best_lam, feature_num, minimize)
+            #
+            # # lam^ <- avg(lambda), L_floor <- L(best_h(lam^), lam^)
+            # avg_lam = [np.mean(k) for k in zip(*solver.lambda_history)]
+            # best_g = solver.best_g(learner, feature_num, avg_lam, minimize)
+            # best_g_assigns, best_g_costs = best_g.predict(x_sensitive)
+            # best_g_exps = exp_func.get_total_exp(best_g_assigns, feature_num)
+            # L_floor = solver.lagrangian(best_g_assigns, avg_lam, feature_num, minimize)
+            #
+            # L = solver.lagrangian(avg_pred, avg_lam, feature_num, minimize)
+            # solver.v_t = max(abs(L-L_floor), abs(L_ceiling-L))
+
+            if solver.phi_s(assigns)+solver.phi_L(assigns) == 0:
+                solver.v_t = 0
+            if _%800 == 0:
+                print('Max iterations reached')
+                solver.v_t = 0
+            solver.update_thetas(assigns)
+            span.add('iterations')
+            _ += 1
 
     ### method 2: Returning best valid model
     print('num iterations: ', _-1)
     best_model, best_assigns, best_exp = solver.get_best_valid_model(minimize)
     return best_model, best_assigns, best_exp
 
+def argmin_g_batched(x, f_sensitive, exp_matrix, alphas, max_iters=800, compress=False):
+    """
+    argmin_g for every (feature, direction) pair at once. The dual updates run in lock step on arrays of
+    thetas/lambdas, and a pair is retired as soon as its assignments fall within the size band (or at
+    max_iters), which is the model argmin_g returns for it.
+    Each step's cost regression for a pair is its expressivity column, signed by direction, shifted by
+    lambda_L - lambda_s. Least squares is linear in the target, so every column is fit once up front with
+    a single multi-output solve, and each step's predictions are the fitted values plus the shift.
+    :param x: training data
+    :param f_sensitive: indices of the sensitive columns the subgroup is defined on
+    :param exp_matrix: n x d expressivity matrix
+    :param alphas: [min, max] subgroup size
+    :param compress: run the dual ascent over unique sensitive patterns instead of rows. Rows with the same pattern
+                     always get the same assignment, so sizes and expressivities come from pattern counts and summed
+                     expressivities, and assignments are expanded back to rows at the end.
+    :return: dict mapping (feature_num, minimize) to (model, assigns, expressivity), as from argmin_g
+    """
+    n, d = exp_matrix.shape
+    x_sensitive = x[:, f_sensitive]
+    base = regression(x).fit(x_sensitive, exp_matrix)
+    fitted = x_sensitive @ base.coef_.T + base.intercept_
+    counts, exp_sums = np.ones(n), exp_matrix
+    if compress:
+        groups = PatternCompression(x_sensitive.toarray() if sparse.issparse(x_sensitive) else x_sensitive)
+        print("Compressed", n, "rows to", groups.k, "sensitive patterns")
+        fitted, counts, exp_sums = fitted[groups.first], groups.counts, groups.sum_rows(exp_matrix)
+
+    # pair j is feature features[j]; minimize pairs first, then maximize
+    features = np.concatenate([np.arange(d), np.arange(d)])
+    signs = np.concatenate([np.ones(d), -np.ones(d)])
+    exp_order = np.mean(np.abs(exp_matrix), axis=0)[features]
+    solver = BatchConstrainedSolver(alpha_s=alphas[0], alpha_L=alphas[1], B=10000*exp_order, nu=.000002)
+
+    results = {}
+    active = np.arange(2*d)
+    it = 1
+    with tracer.span('feature_opt', features=d, alpha=alphas) as span:
+        while len(active) > 0:
+            with tracer.span('solver_step'):
+                lams = solver.update_lambdas(active)
+                shift = lams[:, 1] - lams[:, 0]
+                # cost of assigning 1 minus the (zero) cost of assigning 0; rows with negative cost join
+                assigns = (signs[active] * fitted[:, features[active]] + shift) < 0
+                sizes = counts @ assigns / n
+                exps = np.einsum('ij,ij->j', assigns, exp_sums[:, features[active]])
+            span.add('iterations', len(active))
+
+            done = solver.is_valid(sizes)
+            if it % max_iters == 0:
+                print('Max iterations reached for', np.count_nonzero(~done), 'of', 2*d, 'problems')
+                done[:] = True
+            for j in np.flatnonzero(done):
+                pair = active[j]
+                f, sign = features[pair], signs[pair]
+                k = x_sensitive.shape[1]
+                model = RegOracle(LinearPredictor(np.zeros(k), 0.),
+                                  LinearPredictor(sign*base.coef_[f], sign*base.intercept_[f] + shift[j]))
+                pair_assigns = assigns[:, j].astype(int)
+                if compress:
+                    pair_assigns = groups.expand(pair_assigns)
+                results[(int(f), sign > 0)] = (model, pair_assigns, exps[j])
+
+            solver.update_thetas(active[~done], sizes[~done])
+            active = active[~done]
+            it += 1
+    print('num iterations: ', it-1)
+    return results
+
+def exact_g_batched(x, f_sensitive, exp_matrix, alphas):
+    """
+    Exact references for argmin_g_batched, computed over unique sensitive patterns.
+    :param x: training data
+    :param f_sensitive: indices of the sensitive columns the subgroup is defined on
+    :param exp_matrix: n x d expressivity matrix
+    :param alphas: [min, max] subgroup size
+    :return: dict mapping (feature_num, minimize) to (model, assigns, expressivity) of the best subgroup in the
+             threshold family argmin_g_batched searches (None if none is within the size band), and dict mapping
+             (feature_num, minimize) to the optimal expressivity over any union of patterns (None likewise, or if
+             the knapsack table is over best_selection's max_cells)
+    """
+    n, d = exp_matrix.shape
+    x_sensitive = x[:, f_sensitive]
+    base = regression(x).fit(x_sensitive, exp_matrix)
+    fitted = x_sensitive @ base.coef_.T + base.intercept_
+    groups = PatternCompression(x_sensitive.toarray() if sparse.issparse(x_sensitive) else x_sensitive)
+    print("Compressed", n, "rows to", groups.k, "sensitive patterns")
+    fitted, exp_sums = fitted[groups.first], groups.sum_rows(exp_matrix)
+    thresholds, optima = {}, {}
+    # the knapsack table has the same size for every pair, so once it is too large the rest are skipped
+    too_large = False
+    with tracer.span('feature_opt', features=d, alpha=alphas, solver='exact') as span:
+        for f in range(d):
+            for sign in [1., -1.]:
+                key = (f, sign > 0)
+                # minimizing pairs (sign 1) maximize -expressivity
+                mask, _, shift = best_threshold(-sign*exp_sums[:, f], groups.counts, sign*fitted[:, f], n, alphas)
+                thresholds[key] = None
+                if mask is not None:
+                    model = RegOracle(LinearPredictor(np.zeros(len(f_sensitive)), 0.),
+                                      LinearPredictor(sign*base.coef_[f], sign*base.intercept_[f] + shift))
+                    thresholds[key] = (model, groups.expand(mask.astype(int)), float(exp_sums[mask, f].sum()))
+                optima[key] = None
+                if too_large:
+                    continue
+                try:
+                    mask, _ = best_selection(-sign*exp_sums[:, f], groups.counts, n, alphas)
+                except ValueError as e:
+                    print(e, "- reporting the pattern optimum as NaN")
+                    too_large = True
+                    continue
+                if mask is not None:
+                    optima[key] = float(exp_sums[mask, f].sum())
+        span.add('patterns', groups.k)
+    return thresholds, optima
+
 # Given distribution of models, compute predictions on x and return average
 def get_avg_prediction(mix_models, x):
     predictions = [m.predict(x)[0] for m in mix_models]
@@ -110,42 +271,88 @@ def extremize_exps_dataset(dataset, exp_func, target_column, f_sensitive, alphas
     :param seed: int, random seed
     :return: total expressivity over these rows
     """
-    train_df, test_df = train_test_split(dataset, test_size=t_split, random_state=seed)
-    x_train, y_train = split_out_dataset(train_df, target_column)
-    x_test, y_test = split_out_dataset(test_df, target_column)
-    classifier = RandomForestClassifier(random_state=seed)
-    classifier.fit(x_train, y_train)
+    with tracer.span('data_split') as span:
+        span.add('rows', len(dataset))
+        train_df, test_df = split_dataset(dataset, t_split, seed)
+        x_train, y_train = split_out_dataset(train_df, target_column)
+        x_test, y_test = split_out_dataset(test_df, target_column)
+        # subgroups are fit and applied on x_fit, the classifier and explainers keep the dense rows
+        x_fit, x_fit_test = x_train, x_test
+        if args.sparse:
+            x_fit = to_csr(train_df.drop(target_column, axis=1))
+            x_fit_test = to_csr(test_df.drop(target_column, axis=1))
+    with tracer.span('classifier_fit') as span:
+        span.add('rows', len(x_train))
+        classifier = RandomForestClassifier(random_state=seed)
+        classifier.fit(x_train, y_train)
     out_df = pd.DataFrame()
 
-    exp_func_train = exp_func(classifier, x_train, seed)
-    #print("Populating train expressivity values")
-    #exp_func_train.populate_exps()
-
-    exp_func_test = exp_func(classifier, x_test, seed)
-    #print("Populating test expressivity values")
-    #exp_func_test.populate_exps()
-
-    # Temporary exp populating
-    with open(f'data/exps/{df_name}_train_seed0', 'r') as f:
-        train_temp = list(map(json.loads, f))[0]
-    for e_list in train_temp:
-        exp_func_train.exps.append({int(k):v for k,v in e_list.items()})
-    with open(f'data/exps/{df_name}_test_seed0', 'r') as f:
-        test_temp = list(map(json.loads, f))[0]
-    for e_list in test_temp:
-        exp_func_test.exps.append({int(k):v for k,v in e_list.items()})
-    # ^Temporary code, delete later^
+    # the pipeline's workers build their own explainers
+    if not args.pipeline:
+        exp_func_train = exp_func(classifier, x_train, seed)
+        #print("Populating train expressivity values")
+        #exp_func_train.populate_exps()
+
+        exp_func_test = exp_func(classifier, x_test, seed)
+        #print("Populating test expressivity values")
+        #exp_func_test.populate_exps()
+
+    test_pipe = None
+    if args.pipeline:
+        # test is explained in the background through the optimization, and only waited for at the first test_eval
+        train_pipe = ExpPipeline(exp_func, classifier, x_train, seed, args.pipeline_chunk, name='train').start()
+        test_pipe = ExpPipeline(exp_func, classifier, x_test, seed, args.pipeline_chunk, name='test').start()
+        with tracer.span('lime_populate', split='train', source='pipeline') as span:
+            span.add('rows', len(x_train))
+            exp_func_train = ExpMatrix(train_pipe.result())
+    elif args.exp_backend == 'treeshap':
+        with tracer.span('lime_populate', split='train', source='treeshap') as span:
+            span.add('rows', len(x_train))
+            exp_func_train.populate_exps()
+        with tracer.span('lime_populate', split='test', source='treeshap') as span:
+            span.add('rows', len(x_test))
+            exp_func_test.populate_exps()
+    else:
+        # Temporary exp populating
+        with tracer.span('lime_populate', split='train', source='file') as span:
+            span.add('rows', len(x_train))
+            with open(f'data/exps/{df_name}_train_seed{seed}', 'r') as f:
+                train_temp = list(map(json.loads, f))[0]
+            for e_list in train_temp:
+                exp_func_train.exps.append({int(k):v for k,v in e_list.items()})
+        with tracer.span('lime_populate', split='test', source='file') as span:
+            span.add('rows', len(x_test))
+            with open(f'data/exps/{df_name}_test_seed{seed}', 'r') as f:
+                test_temp = list(map(json.loads, f))[0]
+            for e_list in test_temp:
+                exp_func_test.exps.append({int(k):v for k,v in e_list.items()})
+        # ^Temporary code, delete later^
+
+    if args.exact or args.optimum:
+        thresholds, optima = exact_g_batched(x_fit, f_sensitive, exp_func_train.as_matrix(), alphas)
+    if args.exact and all(thresholds.values()):
+        batched = thresholds
+    elif args.exact or not args.sequential:
+        if args.exact:
+            print("No threshold subgroup within", alphas, "for some features, falling back to the dual solver")
+        batched = argmin_g_batched(x_fit, f_sensitive, exp_func_train.as_matrix(), alphas, compress=args.compress)
+        if args.exact:
+            batched = {key: thresholds[key] or batched[key] for key in batched}
 
     for feature_num in range(len(x_train[0])):
         print('*****************')
         print(train_df.columns[feature_num])
         total_exp_train = full_dataset_expressivity(exp_func_train, feature_num)
         print('total exp: ', total_exp_train)
-        min_model, min_assigns, min_exp = argmin_g(x_train, y_train, feature_num, f_sensitive, exp_func_train,
-                                                   minimize=True, alphas=alphas)
+        if args.sequential and not args.exact:
+            min_model, min_assigns, min_exp = argmin_g(x_fit, y_train, feature_num, f_sensitive, exp_func_train,
+                                                       minimize=True, alphas=alphas)
+            max_model, max_assigns, max_exp = argmin_g(x_fit, y_train, feature_num, f_sensitive, exp_func_train,
+                                                       minimize=False, alphas=alphas)
+        else:
+            min_model, min_assigns, min_exp = batched[(feature_num, True)]
+            max_model, max_assigns, max_exp = batched[(feature_num, False)]
         print('min exp', min_exp, '| size', sum(min_assigns) / len(min_assigns))
-        max_model, max_assigns, max_exp = argmin_g(x_train, y_train, feature_num, f_sensitive, exp_func_train,
-                                                   minimize=False, alphas=alphas)
         print('max exp', max_exp, '| size', sum(max_assigns)/len(max_assigns))
 
         # Choose max difference
@@ -162,34 +369,51 @@ def extremize_exps_dataset(dataset, exp_func, target_column, f_sensitive, alphas
         subgroup_size_train = np.mean(assigns_train)
 
         # compute test values
-        total_exp_test = full_dataset_expressivity(exp_func_test, feature_num)
-        #assigns_test = get_avg_prediction(best_model, x_test) # mix model method
-        assigns_test = best_model.predict(x_test[:,f_sensitive])[0] # sensitive features only method
-        #assigns_test = best_model.predict(x_test)[0]
-        subgroup_size_test = np.mean(assigns_test)
-        furthest_exp_test = 0
-        for i in range(len(assigns_test)):
-            furthest_exp_test += assigns_test[i]*exp_func_test.exps[i][feature_num]
+        if test_pipe is not None:
+            with tracer.span('lime_populate', split='test', source='pipeline') as span:
+                span.add('rows', len(x_test))
+                exp_func_test = ExpMatrix(test_pipe.result())
+            test_pipe = None
+        with tracer.span('test_eval', feature=train_df.columns[feature_num]) as span:
+            span.add('rows', len(x_test))
+            total_exp_test = full_dataset_expressivity(exp_func_test, feature_num)
+            #assigns_test = get_avg_prediction(best_model, x_test) # mix model method
+            assigns_test = best_model.predict(x_fit_test[:,f_sensitive])[0] # sensitive features only method
+            #assigns_test = best_model.predict(x_test)[0]
+            subgroup_size_test = np.mean(assigns_test)
+            furthest_exp_test = 0
+            for i in range(len(assigns_test)):
+                furthest_exp_test += assigns_test[i]*exp_func_test.exps[i][feature_num]
 
         # # from mix models, pick model with largest exp diff that is valid
-        params = best_model.b1.coef_
+        params, intercept = best_model.linear_cost()
         params_with_labels = {dataset.columns[i]: float(param) for (i, param) in zip(f_sensitive, params)}
+        params_with_labels['Intercept'] = intercept
         print(params_with_labels)
 
-        out_df = pd.concat([out_df, pd.DataFrame.from_records([{'Feature': dataset.columns[feature_num],
-                                                                'Alpha': alphas,
-                                                                'F(D)': total_exp_test,
-                                                                'max(F(S))': furthest_exp_test,
-                                                                'Difference': abs(furthest_exp_test - total_exp_test),
-                                                                'avg(F(D))': total_exp_test/len(assigns_test),
-                                                                'avg(F(S))': furthest_exp_test/(sum(assigns_test)+.0001),
-                                                                'Subgroup Coefficients': params_with_labels,
-                                                                'Subgroup Size': subgroup_size_test,
-                                                                'Direction': direction,
-                                                                'F(D)_train': total_exp_train,
-                                                                'max(F(S))_train': furthest_exp_train,
-                                                                'Difference_train': abs(furthest_exp_train-total_exp_train),
-                                                                'Subgroup Size_train': subgroup_size_train}])])
+        record = {'Feature': dataset.columns[feature_num],
+                  'Alpha': alphas,
+                  'F(D)': total_exp_test,
+                  'max(F(S))': furthest_exp_test,
+                  'Difference': abs(furthest_exp_test - total_exp_test),
+                  'avg(F(D))': total_exp_test/len(assigns_test),
+                  'avg(F(S))': furthest_exp_test/(sum(assigns_test)+.0001),
+                  'Subgroup Coefficients': params_with_labels,
+                  # rows are members where their cost x @ coef + intercept is negative
+                  'Membership': 'cost<0',
+                  'Subgroup Size': subgroup_size_test,
+                  'Direction': direction,
+                  'F(D)_train': total_exp_train,
+                  'max(F(S))_train': furthest_exp_train,
+                  'Difference_train': abs(furthest_exp_train-total_exp_train),
+                  'Subgroup Size_train': subgroup_size_train}
+        if args.exact or args.optimum:
+            # references for the chosen direction: best subgroup of the dual solver's threshold family, and best
+            # union of sensitive patterns
+            key = (feature_num, direction == 'minimize')
+            record['max(F(S))_train_threshold'] = thresholds[key][2] if thresholds[key] else np.nan
+            record['max(F(S))_train_optimum'] = np.nan if optima[key] is None else optima[key]
+        out_df = pd.concat([out_df, pd.DataFrame.from_records([record])])
 
     return out_df
 
@@ -217,43 +441,24 @@ def run_system(df, target, sensitive_features, df_name, dummy=False, t_split=.5)
     # date = datetime.today().strftime('%m_%d')
     # final_df.to_csv(f'output_constrained/{df_name}_output_{date}.csv')
 
-    a = [.01,.05]
+    a = args.alpha or [.01,.05]
     print("Running", df_name, ", Alphas =", a)
     start = time.time()
-    final_df = extremize_exps_dataset(dataset=df, exp_func=LimeExpFunc, target_column=target,
-                                      f_sensitive=f_sensitive, alphas=a, t_split=t_split)
+    final_df = extremize_exps_dataset(dataset=df, exp_func=EXP_BACKENDS[args.exp_backend], target_column=target,
+                                      f_sensitive=f_sensitive, alphas=a, seed=args.seed, t_split=t_split)
     print("Runtime:", '%.2f' % ((time.time() - start) / 3600), "Hours")
     date = datetime.today().strftime('%m_%d')
-    final_df.to_csv(f'output_constrained/{df_name}_output_{date}_alpha{a}.csv')
+    final_df.to_csv(args.out or f'output_constrained/{df_name}_output_{date}_alpha{a}.csv')
 
     return 1
 
 
-# df = pd.read_csv('data/student/student_cleaned.csv')
-# target = 'G3'
-# t_split = .5
-# sensitive_features = ['sex_M', 'Pstatus_T', 'address_U', 'Dalc', 'Walc', 'health']
-# df_name = 'student'
-# run_system(df, target, sensitive_features, df_name, dummy, t_split)
-
-# df = pd.read_csv('data/compas/compas_decile.csv')
-# target = 'decile_score'
-# t_split = .5
-# sensitive_features = ['age','sex_Male','race_African-American','race_Asian','race_Caucasian','race_Hispanic','race_Native American','race_Other']
-# df_name = 'compas_decile'
-# run_system(df, target, sensitive_features, df_name, dummy, t_split)
-
-# df = BankDataset().convert_to_dataframe()[0]
-# target = 'y'
-# t_split = .5
-# sensitive_features = ['age', 'marital=married', 'marital=single', 'marital=divorced']
-# df_name = 'bank'
-# run_system(df, target, sensitive_features, df_name, dummy, t_split)
-
-# df = pd.read_csv('data/folktables/ACSIncome_MI_2018_new.csv')
-# target = 'PINCP'
-# t_split = .5
-# sensitive_features = ['AGEP', 'SEX', 'MAR_1.0', 'MAR_2.0', 'MAR_3.0', 'MAR_4.0', 'MAR_5.0', 'RAC1P_1.0', 'RAC1P_2.0',
-#                       'RAC1P_3.0', 'RAC1P_4.0', 'RAC1P_5.0', 'RAC1P_6.0', 'RAC1P_7.0', 'RAC1P_8.0', 'RAC1P_9.0']
-# df_name = 'folktables'
-# run_system(df, target, sensitive_features, df_name, dummy, t_split)
+with tracer.span('data_load', dataset=args.dataset):
+    df, target, sensitive_features, t_split = load_dataset(args.dataset)
+if args.t_split is not None:
+    t_split = args.t_split
+# With --exp-backend lime, precomputed LIME values are read from data/exps/{df_name}_*, see process_LIME_exps.py
+df_name = args.dataset
+run_system(df, target, sensitive_features, df_name, dummy, t_split)
+
+tracer.close()
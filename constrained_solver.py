@@ -113,3 +113,40 @@ class ConstrainedSolver:
             if sign*self.exp_history[i] <= best_exp:
                 best_i = i
         return self.g_history[best_i], self.pred_history[best_i], self.exp_history[best_i]
+
+
+class BatchConstrainedSolver:
+    """
+    ConstrainedSolver's dual dynamics for many problems at once, e.g. every (feature, direction) pair.
+    Thetas and lambdas are arrays with one row per problem, and each update only touches the problems
+    passed in as active.
+    :param alpha_s: minimum size desired for subgroup
+    :param alpha_L: maximum size desired for subgroup
+    :param B: array of weighted bounds of the constraint penalty, one per problem
+    :param nu: step size of the theta updates
+    """
+    def __init__(self, alpha_s, alpha_L, B, nu):
+        self.alpha_s = alpha_s
+        self.alpha_L = alpha_L
+        self.B = np.asarray(B, dtype=float)
+        self.nu = nu
+
+        self.thetas = np.zeros((len(self.B), 2))
+        self.lambdas = np.zeros((len(self.B), 2))
+
+    # size of each column of assigns is within [alpha_s, alpha_L]
+    def is_valid(self, sizes):
+        return (self.alpha_s - sizes <= 0) & (sizes - self.alpha_L <= 0)
+
+    # same exponential ratio as ConstrainedSolver.update_lambdas
+    def update_lambdas(self, active):
+        theta = self.thetas[active]
+        B = self.B[active]
+        self.lambdas[active, 0] = B * np.exp(theta[:, 0]) / (1 + np.exp(theta[:, 1]))
+        self.lambdas[active, 1] = B * np.exp(theta[:, 1]) / (1 + np.exp(theta[:, 0]))
+        return self.lambdas[active]
+
+    # same constraint violation step as ConstrainedSolver.update_thetas
+    def update_thetas(self, active, sizes):
+        self.thetas[active, 0] += self.nu * (self.alpha_s - sizes)
+        self.thetas[active, 1] += self.nu * (sizes - self.alpha_L)
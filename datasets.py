@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# Prepared copies of each dataset live here, see load_dataset
+CACHE_DIR = 'data/cache'
+
+# Datasets the drivers can run on. See datasets.ipynb for how each csv was produced.
+# 'source' is a csv path, or 'aif360:<Name>' for datasets loaded through aif360.
+DATASETS = {
+    'student': {
+        'source': 'data/student/student_cleaned.csv',
+        'target': 'G3',
+        't_split': .5,
+        'sensitive_features': ['sex_M', 'Pstatus_T', 'address_U', 'Dalc', 'Walc', 'health'],
+    },
+    'compas_recid': {
+        'source': 'data/compas/compas_recid.csv',
+        'target': 'two_year_recid',
+        't_split': .5,
+        'sensitive_features': ['age', 'sex_Male', 'race_African-American', 'race_Asian', 'race_Caucasian',
+                               'race_Hispanic', 'race_Native American', 'race_Other'],
+    },
+    'compas_decile': {
+        'source': 'data/compas/compas_decile.csv',
+        'target': 'decile_score',
+        't_split': .5,
+        'sensitive_features': ['age', 'sex_Male', 'race_African-American', 'race_Asian', 'race_Caucasian',
+                               'race_Hispanic', 'race_Native American', 'race_Other'],
+    },
+    'compas': {
+        'source': 'aif360:CompasDataset',
+        'target': 'two_year_recid',
+        't_split': .5,
+        'sensitive_features': ['age', 'race', 'sex', 'age_cat=25 - 45', 'age_cat=Greater than 45',
+                               'age_cat=Less than 25'],
+    },
+    'bank': {
+        'source': 'aif360:BankDataset',
+        'target': 'y',
+        't_split': .2,
+        'sensitive_features': ['age', 'marital=married', 'marital=single', 'marital=divorced'],
+    },
+    'folktables': {
+        'source': 'data/folktables/ACSIncome_MI_2018_new.csv',
+        'target': 'PINCP',
+        't_split': .2,
+        'sensitive_features': ['AGEP', 'SEX', 'MAR_1.0', 'MAR_2.0', 'MAR_3.0', 'MAR_4.0', 'MAR_5.0', 'RAC1P_1.0',
+                               'RAC1P_2.0', 'RAC1P_3.0', 'RAC1P_4.0', 'RAC1P_5.0', 'RAC1P_6.0', 'RAC1P_7.0',
+                               'RAC1P_8.0', 'RAC1P_9.0'],
+    },
+    'folktables_sampled': {
+        'source': 'data/folktables/ACSIncome_MI_2018_sampled.csv',
+        'target': 'PINCP',
+        't_split': .2,
+        'sensitive_features': ['AGEP', 'SEX', 'MAR_1.0', 'MAR_2.0', 'MAR_3.0', 'MAR_4.0', 'MAR_5.0', 'RAC1P_1.0',
+                               'RAC1P_2.0', 'RAC1P_3.0', 'RAC1P_4.0', 'RAC1P_5.0', 'RAC1P_6.0', 'RAC1P_7.0',
+                               'RAC1P_8.0', 'RAC1P_9.0'],
+    },
+}
+
+
+def read_source(source):
+    """
+    Reads a dataset from its original source. aif360 is only imported for aif360 sources.
+    """
+    if source.startswith('aif360:'):
+        import aif360.datasets
+        return getattr(aif360.datasets, source[len('aif360:'):])().convert_to_dataframe()[0]
+    return pd.read_csv(source)
+
+
+def source_hash(source):
+    """
+    Content hash of a dataset source. csv hashes are remembered by path, size and mtime so an unchanged
+    file is only read once. aif360 sources are keyed by the installed aif360 version.
+    """
+    if source.startswith('aif360:'):
+        from importlib.metadata import version
+        return hashlib.sha1(f'{source}:{version("aif360")}'.encode()).hexdigest()
+
+    stat = os.stat(source)
+    index_path = os.path.join(CACHE_DIR, 'hashes.json')
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+    entry = index.get(source)
+    if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+        return entry['hash']
+
+    sha = hashlib.sha1()
+    with open(source, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    index[source] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': sha.hexdigest()}
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = f'{index_path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp, index_path)
+    return sha.hexdigest()
+
+
+def build_cache(name, cache_path):
+    """
+    Converts a dataset into a float64 .npy matrix with the target as the last column, plus a meta.json
+    holding the column names.
+    """
+    config = DATASETS[name]
+    df = read_source(config['source'])
+    target = config['target']
+    df = df[[col for col in df.columns if col != target] + [target]]
+    os.makedirs(cache_path, exist_ok=True)
+    # write to temporary files first so parallel runs never see a partial cache. meta.json goes last.
+    tmp = os.path.join(cache_path, f'x.{os.getpid()}.tmp.npy')
+    np.save(tmp, df.to_numpy(dtype=np.float64))
+    os.replace(tmp, os.path.join(cache_path, 'x.npy'))
+    tmp = os.path.join(cache_path, f'meta.{os.getpid()}.tmp')
+    with open(tmp, 'w') as f:
+        json.dump({'name': name, 'source': config['source'], 'target': target, 'columns': list(df.columns),
+                   'rows': df.shape[0]}, f)
+    os.replace(tmp, os.path.join(cache_path, 'meta.json'))
+
+
+def load_dataset(name, cache=True):
+    """
+    Loads one of the datasets in DATASETS. The first load converts the source into a cached binary under
+    CACHE_DIR, keyed by the source's content hash. Later loads memory-map that file instead of parsing the
+    source again.
+    :param name: key into DATASETS
+    :param cache: set False to read the original source and skip the cache
+    :return: dataframe with the target as its last column, target column, sensitive feature names,
+             default test split fraction
+    """
+    if name not in DATASETS:
+        raise ValueError(f"Unknown dataset '{name}'. Choose from {sorted(DATASETS)}")
+    config = DATASETS[name]
+    target = config['target']
+    if not cache:
+        df = read_source(config['source'])
+        df = df[[col for col in df.columns if col != target] + [target]]
+        return df, target, list(config['sensitive_features']), config['t_split']
+
+    cache_path = os.path.join(CACHE_DIR, f"{name}_{source_hash(config['source'])[:16]}")
+    if not os.path.exists(os.path.join(cache_path, 'meta.json')):
+        print("Building cache for", name, "in", cache_path)
+        build_cache(name, cache_path)
+    with open(os.path.join(cache_path, 'meta.json')) as f:
+        meta = json.load(f)
+    # copy-on-write so the drivers can still assign columns (e.g. --dummy) without touching the file
+    x = np.load(os.path.join(cache_path, 'x.npy'), mmap_mode='c')
+    df = pd.DataFrame(x, columns=meta['columns'], copy=False)
+    df.attrs['cache_path'] = cache_path
+    return df, target, list(config['sensitive_features']), config['t_split']
+
+
+def to_csr(df, chunk=65536):
+    """
+    CSR copy of a dataframe's values, built a block of rows at a time so a memory-mapped dataset is never
+    densified in full. One-hot heavy datasets (folktables, bank, compas) keep a small fraction of their entries.
+    :return: scipy.sparse.csr_matrix of float64
+    """
+    from scipy import sparse
+    blocks = [sparse.csr_matrix(df.iloc[start:start + chunk].to_numpy(dtype=np.float64))
+              for start in range(0, df.shape[0], chunk)]
+    return sparse.vstack(blocks, format='csr') if blocks else sparse.csr_matrix((0, df.shape[1]))
+
+
+def split_dataset(dataset, t_split, seed):
+    """
+    Same split as sklearn's train_test_split(dataset, test_size=t_split, random_state=seed). For datasets
+    loaded through the cache, the split indices are stored next to the data and reused.
+    :return: train dataframe, test dataframe
+    """
+    n = dataset.shape[0]
+    cache_path = dataset.attrs.get('cache_path')
+    split_path = None
+    if cache_path is not None:
+        split_path = os.path.join(cache_path, f'split_n{n}_t{t_split}_seed{seed}.npz')
+    if split_path is not None and os.path.exists(split_path):
+        split = np.load(split_path)
+        train_idx, test_idx = split['train'], split['test']
+    else:
+        from sklearn.model_selection import train_test_split
+        train_idx, test_idx = train_test_split(np.arange(n), test_size=t_split, random_state=seed)
+        if split_path is not None:
+            tmp = f'{split_path[:-len(".npz")]}.{os.getpid()}.tmp.npz'
+            np.savez(tmp, train=train_idx, test=test_idx)
+            os.replace(tmp, split_path)
+    return dataset.iloc[train_idx], dataset.iloc[test_idx]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build the dataset cache ahead of a run')
+    parser.add_argument('names', nargs='*', default=sorted(DATASETS))
+    args = parser.parse_args()
+    for dataset_name in args.names:
+        load_dataset(dataset_name)
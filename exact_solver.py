@@ -0,0 +1,81 @@
+import numpy as np
+
+
+def valid_totals(n, alphas, high=None):
+    """
+    :return: boolean array over row counts 0..high (default n), True where count / n is within the size band,
+             with the same comparison as BatchConstrainedSolver.is_valid
+    """
+    sizes = np.arange((n if high is None else high) + 1) / n
+    return (alphas[0] - sizes <= 0) & (sizes - alphas[1] <= 0)
+
+
+def best_selection(values, counts, n, alphas, max_cells=2**30):
+    """
+    Exact optimum of the locally separable problem over sensitive patterns: the set of patterns with the largest
+    summed value whose rows make up a share of the n rows within alphas. A 0/1 knapsack over row counts, solved by
+    dynamic programming in O(k * alpha_L * n).
+    :param values: k summed expressivities, negate them to minimize
+    :param counts: k row counts
+    :param max_cells: largest k x alpha_L * n choice table to allocate
+    :return: boolean mask over patterns and its value, (None, None) if no selection is valid
+    """
+    valid = valid_totals(n, alphas)
+    high = int(np.flatnonzero(valid)[-1]) if valid.any() else -1
+    if high < 0:
+        return None, None
+    if len(values) * (high + 1) > max_cells:
+        raise ValueError(f"{len(values)} patterns x {high + 1} sizes is over max_cells, use the dual solver")
+    best = np.full(high + 1, -np.inf)
+    best[0] = 0.
+    take = np.zeros((len(values), high + 1), dtype=bool)
+    for g, (v, c) in enumerate(zip(values, counts)):
+        if c > high:
+            continue
+        candidate = best[:high + 1 - c] + v
+        improved = candidate > best[c:]
+        take[g, c:] = improved
+        best[c:] = np.where(improved, candidate, best[c:])
+    best[~valid[:high + 1]] = -np.inf
+    total = int(np.argmax(best))
+    if best[total] == -np.inf:
+        return None, None
+    value = best[total]
+    mask = np.zeros(len(values), dtype=bool)
+    for g in range(len(values) - 1, -1, -1):
+        if take[g, total]:
+            mask[g] = True
+            total -= counts[g]
+    return mask, value
+
+
+def best_threshold(values, counts, scores, n, alphas):
+    """
+    Best subgroup of the form {scores + shift < 0}, the family the batched dual ascent moves through for one
+    (feature, direction) pair. Sorting patterns by score makes every such subgroup a prefix, so one scan over the
+    cuts between distinct scores finds the optimum.
+    :param values: k summed expressivities, negate them to minimize
+    :param counts: k row counts
+    :param scores: k signed fitted costs of the patterns
+    :return: boolean mask over patterns, its value and the shift that selects it, (None, None, None) if no
+             prefix is valid
+    """
+    order = np.argsort(scores, kind='stable')
+    sorted_scores = scores[order]
+    totals = np.concatenate([[0], np.cumsum(counts[order])])
+    sums = np.concatenate([[0.], np.cumsum(values[order])])
+    # a prefix of length m is a threshold subgroup when it doesn't split patterns with equal scores
+    cuts = np.concatenate([[True], sorted_scores[1:] > sorted_scores[:-1], [True]])
+    valid = cuts & valid_totals(n, alphas)[totals]
+    if not valid.any():
+        return None, None, None
+    m = int(np.flatnonzero(valid)[np.argmax(sums[valid])])
+    mask = np.zeros(len(values), dtype=bool)
+    mask[order[:m]] = True
+    if m == 0:
+        shift = -sorted_scores[0] + 1.
+    elif m == len(values):
+        shift = -sorted_scores[-1] - 1.
+    else:
+        shift = -(sorted_scores[m - 1] + sorted_scores[m]) / 2
+    return mask, sums[m], shift
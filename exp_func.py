@@ -0,0 +1,28 @@
+import numpy as np
+
+
+class ExpFunc:
+    """
+    Lookups shared by the explainers and pipeline.ExpMatrix. Subclasses hold exps, a list with one
+    {feature: expressivity} dict per row, matrix, the dense array of exps or None, and n_features, the number of
+    matrix columns, and define populate_exps to fill exps when it is empty.
+    """
+    # Given feature and row, return the computed expressivities
+    def get_exp(self, row, feature):
+        if len(self.exps) == 0:
+            print("Expressivity dict empty. Populating now...")
+            self.populate_exps()
+        return self.exps[row][feature]
+
+    # Dense n x d array of the expressivities, as_matrix()[n, i] == exps[n][i]. Rebuilt only when exps changes size.
+    def as_matrix(self):
+        if len(self.exps) == 0:
+            print("Expressivity dict empty. Populating now...")
+            self.populate_exps()
+        if self.matrix is None or self.matrix.shape[0] != len(self.exps):
+            d = self.n_features
+            self.matrix = np.array([[e.get(i, 0.) for i in range(d)] for e in self.exps])
+        return self.matrix
+
+    def get_total_exp(self, assigns, feature_num):
+        return float(np.dot(assigns, self.as_matrix()[:len(assigns), feature_num]))
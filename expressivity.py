@@ -1,11 +1,13 @@
 from reg_oracle import ZeroPredictor, CostPredictor, RegOracle
+from lime_exp_func import LimeExpFunc
 import numpy as np
 import pandas as pd
-from typing import Union, Callable, NewType
+from typing import Union, Callable, NewType, Optional
 from random import uniform
-from lime.lime_tabular import LimeTabularExplainer
 
-CostFuncGenType = NewType("CostFuncGenType", Callable[[np.ndarray, int], Callable[[np.ndarray], float]])
+# A cost function generator takes (dataset, feature_num, out) and returns the cost of every row of the dataset
+# for that feature as an array. out is an optional length-n buffer the costs may be written into.
+CostFuncGenType = NewType("CostFuncGenType", Callable[[np.ndarray, int, Optional[np.ndarray]], np.ndarray])
 
 
 def fit_one_side(dataset, costs, minimize=False):
@@ -19,61 +21,87 @@ def fit_one_side(dataset, costs, minimize=False):
 def fit_costs_dataset(dataset: np.ndarray, feature_num: int,
                       cost_func_gen: CostFuncGenType,
                       minimize=False):
-    costs = []
-    rows = []
-    cost_func = cost_func_gen(dataset, feature_num)
-    for row in dataset:
-        costs.append(cost_func(row))
-        rows.append(row[:-1])
-
-    predictor = fit_one_side(np.array(rows), costs, minimize=minimize)
-    predictions, cost = predictor.predict(dataset)
+    costs = cost_func_gen(dataset, feature_num, None)
+    # the last column is the label, costs are regressed on the rest
+    predictor = fit_one_side(dataset[:, :-1], costs, minimize=minimize)
+    predictions, cost = predictor.predict(dataset[:, :-1])
     return predictions, cost
 
 
+def fit_costs_both(dataset: np.ndarray, costs: np.ndarray):
+    """
+    Fits the cost regression once and reads off both extremes. With a zero cost for assigning 1, rows with a
+    positive predicted cost are left out when maximizing and kept when minimizing, matching
+    RegOracle.predict on the same fit.
+    :param dataset: data with the label as its last column
+    :param costs: cost vector for the feature
+    :return: (max predictions, max cost), (min predictions, min cost)
+    """
+    predictor = CostPredictor()
+    predictor.fit(dataset[:, :-1], costs)
+    c_0 = predictor.predict(dataset[:, :-1])
+    max_predictions = (c_0 <= 0).astype(int)
+    min_predictions = (c_0 > 0).astype(int)
+    return (max_predictions, np.maximum(c_0, 0).sum()), (min_predictions, np.minimum(c_0, 0).sum())
+
+
 def total_cost(dataset, feature_num, cost_func_gen: CostFuncGenType):
-    cost_func = cost_func_gen(dataset, feature_num)
-    return sum(cost_func(row) for row in dataset)
+    return cost_func_gen(dataset, feature_num, None).sum()
 
 
 def extremize_costs_dataset(dataset: Union[np.ndarray, pd.DataFrame], cost_func_gen: CostFuncGenType,
                             target_column=None):
-    if target_column is None:
-        max_costs = np.array(
-            [(feature_num, fit_costs_dataset(dataset, feature_num, cost_func_gen, minimize=False),
-              total_cost(dataset, feature_num, cost_func_gen)) for feature_num in range(dataset.shape[1] - 1)])
-        min_costs = np.array(
-            [(feature_num, fit_costs_dataset(dataset, feature_num, cost_func_gen, minimize=True),
-              total_cost(dataset, feature_num, cost_func_gen)) for feature_num in range(dataset.shape[1] - 1)])
-    else:
-        numpy_ds = dataset.drop(target_column, axis=1).to_numpy()
-        max_costs = np.array(
-            [(feature_num, fit_costs_dataset(numpy_ds, feature_num, cost_func_gen, minimize=False),
-              total_cost(numpy_ds, feature_num, cost_func_gen)) for feature_num in range(dataset.shape[1] - 1)])
-        min_costs = np.array(
-            [(feature_num, fit_costs_dataset(numpy_ds, feature_num, cost_func_gen, minimize=True),
-              total_cost(numpy_ds, feature_num, cost_func_gen)) for feature_num in range(dataset.shape[1] - 1)])
-    feature_num, (max_predictions, max_cost), total = sorted(max_costs, key=lambda x: (x[1][1] - x[2]), reverse=True)[0]
-    feature_num, (min_predictions, min_cost), total = sorted(min_costs, key=lambda x: (x[1][1] - x[2]))[0]
-    if abs(max_cost) >= abs(min_cost):
+    num_features = dataset.shape[1] - 1
+    if target_column is not None:
+        dataset = dataset.drop(target_column, axis=1).to_numpy()
+
+    # every feature's cost vector is computed once into the same buffer and shared by both directions
+    buffer = np.empty(dataset.shape[0])
+    best_max, best_min = None, None
+    for feature_num in range(num_features):
+        costs = cost_func_gen(dataset, feature_num, buffer)
+        total = costs.sum()
+        (max_predictions, max_cost), (min_predictions, min_cost) = fit_costs_both(dataset, costs)
+        if best_max is None or max_cost - total > best_max[2] - best_max[3]:
+            best_max = (feature_num, max_predictions, max_cost, total)
+        if best_min is None or min_cost - total < best_min[2] - best_min[3]:
+            best_min = (feature_num, min_predictions, min_cost, total)
+
+    feature_num, max_predictions, max_cost, total = best_max
+    if abs(max_cost) >= abs(best_min[2]):
         return feature_num, max_predictions, max_cost - total, total
+    feature_num, min_predictions, min_cost, total = best_min
     return feature_num, min_predictions, min_cost - total, total
 
 
-def means_cost_func(dataset: np.ndarray, feature_num: int) -> Callable[[np.ndarray], float]:
-    probability_f_i = dataset[dataset[..., feature_num] == 1].shape[0] / dataset.shape[0]
-    return lambda row: (row[feature_num] - probability_f_i) * row[-1] / (probability_f_i * (1 - probability_f_i))
-
-
-def lime_cost_func_generator(classifier):
-    def cost_func(dataset, feature_num):
-        lime_exp = LimeTabularExplainer(dataset)
-
-        def internal_cost(row):
-            explanation = lime_exp.explain_instance(row, classifier.predict_proba, num_features=row.shape[1])
-            return explanation.as_list()[feature_num][1]
-
-        return internal_cost
+def means_cost_func(dataset: np.ndarray, feature_num: int, out: Optional[np.ndarray] = None) -> np.ndarray:
+    column = dataset[:, feature_num]
+    probability_f_i = np.count_nonzero(column == 1) / dataset.shape[0]
+    out = np.subtract(column, probability_f_i, out=out)
+    out *= dataset[:, -1]
+    out /= probability_f_i * (1 - probability_f_i)
+    return out
+
+
+def lime_cost_func_generator(classifier, seed=None):
+    """
+    Cost function generator using LIME weights as costs. Each dataset is explained once, with one explainer,
+    and the full per-row explanation is kept so every feature's costs are a column of the same matrix.
+    """
+    explained = {}
+
+    def cost_func(dataset, feature_num, out=None):
+        # keyed by id; the LimeExpFunc holds a reference to the dataset so the id can't be reused
+        key = (id(dataset), dataset.shape)
+        if key not in explained:
+            exp_func = LimeExpFunc(classifier, dataset, seed)
+            exp_func.populate_exps()
+            explained[key] = exp_func
+        costs = explained[key].as_matrix()[:, feature_num]
+        if out is None:
+            return costs.copy()
+        out[:] = costs
+        return out
 
     return cost_func
 
@@ -5,19 +5,47 @@ from torch.special import expit as sigmoid
 from torch.optim import Adam
 import time
 from datetime import datetime
-from aif360.datasets import CompasDataset, BankDataset
-from sklearn.model_selection import train_test_split
 import argparse
+from tracing import tracer
+from datasets import load_dataset, split_dataset
+from permutation_test import permutation_null, reoptimize_null, p_value
+from bootstrap import bootstrap_ci
+from size_projection import band_shift
 
 
 parser = argparse.ArgumentParser(description='Locally separable run')
-parser.add_argument('flatval', type=float)
+parser.add_argument('flatval', type=float, nargs='+', help='ridge value; several values run as one sweep')
 parser.add_argument('--dummy', action='store_true')
 parser.add_argument('--cuda', action='store_true')
+parser.add_argument('--dataset', type=str, default='student', help='dataset name from datasets.DATASETS')
+parser.add_argument('--alpha', type=float, nargs=2, default=None, help='subgroup size band, e.g. --alpha .1 .15')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--t-split', type=float, default=None, help='test fraction, defaults to the dataset setting')
+parser.add_argument('--out', type=str, default=None, help='output csv path, defaults to a dated file under output/')
+parser.add_argument('--warm-niters', type=int, default=250,
+                    help='training iterations for each ridge value after the first in a sweep, which warm-start')
+parser.add_argument('--permutations', type=int, default=0,
+                    help='p-value of each learned subgroup on the test set against this many shuffled targets')
+parser.add_argument('--reopt-permutations', type=int, default=0,
+                    help='also relearn subgroups on this many shuffled train targets for a p-value that accounts for the search')
+parser.add_argument('--bootstrap', type=int, default=0,
+                    help='add bootstrap confidence intervals over this many resamples of the test set')
+parser.add_argument('--ci-level', type=float, default=.95, help='coverage of the --bootstrap intervals')
+parser.add_argument('--project', action='store_true',
+                    help='after every step, shift the subgroup intercept so its size is inside the alpha band')
+parser.add_argument('--trace', type=str, default=None, help='append JSON phase timings to this file')
+parser.add_argument('--trace-memory', action='store_true', help='sample peak memory at the end of every span')
 args = parser.parse_args()
-flatval = args.flatval
+# sweeps run from the smallest ridge value up, each warm-starting from the previous one
+flatvals = sorted(args.flatval)
+flatval = flatvals[0]
 dummy = args.dummy
 useCUDA = args.cuda
+seed = args.seed
+niters = 1000
+warm_niters = args.warm_niters
+if args.trace:
+    tracer.enable(args.trace, memory=args.trace_memory)
 
 # Enable GPU if desired. Sometimes returns false values
 if useCUDA:
@@ -26,103 +54,106 @@ else:
     torch.device('cuda:0')
 
 
-def loss_fn_generator(x_0: torch.Tensor, y: torch.Tensor, feature_num: int, sensitives: torch.Tensor,
-                      alpha: list, minimize: bool):
+def bidirectional_loss_fn(x_0: torch.Tensor, y: torch.Tensor, feature_num: int, sensitives: torch.Tensor,
+                          alpha: list, flatval: float = flatval):
     """
-    Factory for the loss function that pytorch runs will be optimizing in WLS
+    Factory for the WLS loss of both directions at once. Column 0 of the p x 2 parameters minimizes the coefficient
+    and column 1 maximizes it, each with a steep penalty outside the alpha band. Both weighted Gram matrices and
+    moments come out of one batched product with the shared x^T, and the summed loss has each column's own gradient.
     :param x_0: the data tensor with intercept column
     :param y: the target tensor
-    :param initial_val: expressivity over full dataset
     :param feature_num: Which feature in the data do we care about
     :param sensitives: tensor representing sensitive features
     :param alpha: desired subgroup size
-    :param minimize: Boolean -- are we minimizing or maximizing
-    :return: a loss function for our particular WLS problem.
+    :param flatval: ridge term added to the weighted Gram matrix
+    :return: a function from p x 2 parameters to the summed loss, the coefficient and the size of each column
     """
     x = remove_intercept_column(x_0)
+    x_t = torch.t(x)
+    flat = torch.diag(torch.full((x.shape[1],), flatval, device=x.device))
+    signs = torch.tensor([1., -1.], device=x.device)
 
-    basis_list = [[0. for _ in range(x.shape[1])]]
-    basis_list[0][feature_num] = 1.
-    flat_list = [flatval for _ in range(x.shape[1])]
-
-    if useCUDA:
-        basis = torch.tensor(basis_list, requires_grad=True).cuda()
-        flat = torch.tensor(flat_list, requires_grad=True).cuda()
-    else:
-        basis = torch.tensor(basis_list, requires_grad=True)
-        flat = torch.tensor(flat_list, requires_grad=True)
-
-    if minimize:
-        sign = 1
-    else:
-        sign = -1
-
-    # Look into derivation of gradient by hand and implementing it here instead.
     def loss_fn(params):
-        # only train using sensitive features
-        one_d = sigmoid(x_0 @ (sensitives * params))
-        diag = torch.diag(one_d)
-        x_t = torch.t(x)
-        denom = torch.inverse((x_t @ diag @ x) + torch.diag(flat))
-        coefficient = basis @ (denom @ (x_t @ diag @ y))
-
-        size = torch.sum(one_d)/x.shape[0]
-        size_penalty = 100000*(max(alpha[0]-size, 0) + max(size-alpha[1], 0))
+        one_d = sigmoid(x_0 @ (sensitives[:, None] * params))
+        # 2 x d x n, x^T diag(w) for each direction
+        x_tw = x_t[None, :, :] * torch.t(one_d)[:, None, :]
+        denom = torch.inverse((x_tw @ x) + flat)
+        coefficients = (denom @ (x_tw @ y)[:, :, None])[:, feature_num, 0]
 
-        return size_penalty + .1 * sign * coefficient
+        sizes = torch.sum(one_d, dim=0)/x.shape[0]
+        size_penalty = 100000*(torch.clamp(alpha[0]-sizes, min=0) + torch.clamp(sizes-alpha[1], min=0))
+        return torch.sum(size_penalty + .1 * signs * coefficients), coefficients, sizes
 
     return loss_fn
 
 
-def train_and_return(x: torch.Tensor, y: torch.Tensor, feature_num: int, f_sensitive: list, alpha: list, minimize: bool):
+def train_both_directions(x: torch.Tensor, y: torch.Tensor, feature_num: int, f_sensitive: list, alpha: list,
+                          initial_val: float, flatval: float = flatval, init_params: tuple = None,
+                          niters: int = niters, project: bool = False):
     """
-    Given an x, y, feature num, and the expressivity over the whole dataset,
-    returns the differential expressivity and maximal subset for that feature
+    Given an x, y and feature num, learns the subgroups that minimize and maximize the feature's expressivity in
+    one pass, as a p x 2 parameter batch. Adam updates every parameter on its own, so each column follows the same
+    path as a run for its direction alone. The coefficient and size recorded after each step come from the next
+    step's forward pass instead of separate evaluations.
     :param x: The data tensor
     :param y: the target tensor
     :param feature_num: which feature to optimize, int.
-    :param initial_val: What the expressivity over the whole dataset for the feature is.
     :param f_sensitive: indices of sensitive features
     :param alpha: target subgroup size
-    :return: the differential expressivity and maximal subset weights.
+    :param initial_val: expressivity over the whole dataset, to pick the direction that differs most from it
+    :param flatval: ridge term
+    :param init_params: (minimizing, maximizing) parameters to start from, e.g. the result for an adjacent ridge
+                        value. Both start from the same random parameters if None.
+    :param niters: number of optimizer steps
+    :param project: shift the intercepts (the last parameter row) onto the alpha band before the first step and
+                    after every step, so every iterate is feasible, see band_shift
+    :return: for the valid direction (see is_valid) that differs most from initial_val: its expressivity,
+             subgroup weights, parameters, size record and coefficient record. Then the (minimizing, maximizing)
+             parameters, to warm-start from.
     """
-    niters = 1000
     # Set seed to const value for reproducibility
     torch.manual_seed(seed)
-    s_list = [0. for _ in range(x.shape[1])]
-    for f in f_sensitive:
-        s_list[f] = 1.
-    if useCUDA:
-        sensitives = torch.tensor(s_list, requires_grad=True).cuda()
-        params_max = torch.randn(x.shape[1], requires_grad=True, device="cuda")
+    sensitives = torch.zeros(x.shape[1], device=x.device)
+    sensitives[f_sensitive] = 1.
+    if init_params is None:
+        start = torch.randn(x.shape[1], device=x.device)
+        params = torch.stack([start, start], dim=1)
     else:
-        sensitives = torch.tensor(s_list, requires_grad=True)
-        params_max = torch.randn(x.shape[1], requires_grad=True)
+        params = torch.tensor(np.stack(init_params, axis=1), dtype=torch.float32, device=x.device)
+    params.requires_grad_(True)
 
-    optim = Adam(params=[params_max], lr=0.05)
-    iters = 0
-    curr_error = 10000
+    optim = Adam(params=[params], lr=0.05)
     s_record = []
     p_record = []
-    loss_max = loss_fn_generator(x, y, feature_num, sensitives, alpha, minimize)
-    while iters < niters:
-        optim.zero_grad()
-        loss_res = loss_max(params_max)
-        loss_res.backward()
-        optim.step()
-        curr_error = loss_res.item()
-
-        params_temp = sensitives * params_max
-        size = np.sum((sigmoid(x @ params_temp)).cpu().detach().numpy())/x.shape[0]
-        s_record.append(size)
-
-        p_record.append(final_value(x, y, params_temp.cpu().detach().numpy(), feature_num)[0])
-        iters += 1
-    params_max = sensitives * params_max
-    max_error = curr_error * -1
-    assigns = (sigmoid(x @ params_max)).cpu().detach().numpy()
-    #print('final train size: ',torch.sum(sigmoid(x @ params_max))/x.shape[0])
-    return max_error, assigns, params_max.cpu().detach().numpy(), s_record, p_record
+    loss_both = bidirectional_loss_fn(x, y, feature_num, sensitives, alpha, flatval)
+
+    def project_params():
+        with torch.no_grad():
+            params[-1] += band_shift(x @ (sensitives[:, None] * params), None, x.shape[0], alpha).float()
+    if project:
+        project_params()
+    loss_res, coefficients, sizes = loss_both(params)
+    for _ in range(niters):
+        with tracer.span('solver_step'):
+            optim.zero_grad()
+            loss_res.backward()
+            optim.step()
+            if project:
+                project_params()
+            # statistics at the new parameters, recorded now and differentiated in the next step
+            loss_res, coefficients, sizes = loss_both(params)
+        s_record.append(sizes.tolist())
+        p_record.append(coefficients.tolist())
+
+    params_final = (sensitives[:, None] * params).detach()
+    assigns = sigmoid(x @ params_final).cpu().numpy()
+    coefficients = coefficients.tolist()
+    valid = [is_valid(assigns[:, c], alpha) for c in range(2)]
+    c = int(valid[1] * abs(coefficients[1] - initial_val) > valid[0] * abs(coefficients[0] - initial_val))
+    params_final = params_final.cpu().numpy()
+    return (coefficients[c], assigns[:, c], params_final[:, c], [s[c] for s in s_record],
+            [p[c] for p in p_record]), (params_final[:, 0], params_final[:, 1])
+
 
 def is_valid(assigns, alpha):
     """
@@ -135,7 +166,7 @@ def is_valid(assigns, alpha):
         valid = 0
     return valid
 
-def initial_value(x: torch.Tensor, y: torch.Tensor, feature_num: int) -> float:
+def initial_value(x: torch.Tensor, y: torch.Tensor, feature_num: int, flatval: float = flatval) -> float:
     """
     Given a dataset, target, and feature number, returns the expressivity of that feature over the dataset.
     :param x: the data tensor
@@ -159,13 +190,14 @@ def initial_value(x: torch.Tensor, y: torch.Tensor, feature_num: int) -> float:
         denom = torch.inverse((x_t @ x) + torch.diag(flat))
     return (basis @ (denom @ (x_t @ y))).item()
 
-def final_value(x_0: torch.Tensor, y: torch.Tensor, params: torch.Tensor, feature_num: int):
+def final_value(x_0: torch.Tensor, y: torch.Tensor, params: torch.Tensor, feature_num: int, flatval: float = flatval):
     """
     Given a defined subgroup function, returns the expressivity over the test data set
     :param x_0: the test data tensor
     :param y: the test target tensor
     :param params: tensor with coefficients defining the subgroup
     :param feature_num: the feature to test
+    :param flatval: ridge term
     :return: the float value of expressivity over the dataset and subgroup assignments
     """
     x = remove_intercept_column(x_0)
@@ -188,6 +220,22 @@ def final_value(x_0: torch.Tensor, y: torch.Tensor, params: torch.Tensor, featur
     denom = torch.inverse((x_t @ diag @ x) + torch.diag(flat))
     return (basis @ (denom @ (x_t @ diag @ y))).cpu().detach().numpy()[0], one_d.cpu().detach().numpy()
 
+def ridge_path(x: torch.Tensor, y: torch.Tensor, flatvals: list) -> np.ndarray:
+    """
+    Unweighted ridge coefficients for every feature and every ridge value, from one eigendecomposition of the
+    Gram matrix: (x^T x + f I)^-1 x^T y = V diag(1 / (s + f)) V^T x^T y. Replaces initial_value when sweeping.
+    :param x: the data tensor
+    :param y: the target tensor
+    :param flatvals: ridge values
+    :return: len(flatvals) x features array, row i holds initial_value(x, y, feature, flatvals[i]) for each feature
+    """
+    # float64 so the decomposition stays accurate for ridge values near zero
+    x, y = x.double(), y.double()
+    evals, evecs = torch.linalg.eigh(torch.t(x) @ x)
+    proj = torch.t(evecs) @ (torch.t(x) @ y)
+    flat = torch.tensor(flatvals, dtype=x.dtype, device=x.device)
+    return ((proj / (evals + flat[:, None])) @ torch.t(evecs)).cpu().numpy()
+
 def find_extreme_subgroups(dataset: pd.DataFrame, alpha: list, target_column: str, f_sensitive: list, t_split: float):
     """
     Given a dataset, finds the differential expressivity and maximal subset over all features.
@@ -200,66 +248,109 @@ def find_extreme_subgroups(dataset: pd.DataFrame, alpha: list, target_column: st
     """
     out_df = pd.DataFrame()
 
-    train_df, test_df = train_test_split(dataset, test_size=t_split, random_state=seed)
-
-    if useCUDA:
-        y_train = torch.tensor(train_df[target_column].values).float().cuda()
-        x_train = torch.tensor(train_df.drop(target_column, axis=1).values.astype('float16')).float().cuda()
-        y_test = torch.tensor(test_df[target_column].values).float().cuda()
-        x_test = torch.tensor(test_df.drop(target_column, axis=1).values.astype('float16')).float().cuda()
-    else:
-        y_train = torch.tensor(train_df[target_column].values).float()
-        x_train = torch.tensor(train_df.drop(target_column, axis=1).values.astype('float16')).float()
-        y_test = torch.tensor(test_df[target_column].values).float()
-        x_test = torch.tensor(test_df.drop(target_column, axis=1).values.astype('float16')).float()
+    with tracer.span('data_split') as span:
+        span.add('rows', len(dataset))
+        train_df, test_df = split_dataset(dataset, t_split, seed)
+
+        if useCUDA:
+            y_train = torch.tensor(train_df[target_column].values).float().cuda()
+            x_train = torch.tensor(train_df.drop(target_column, axis=1).values.astype('float16')).float().cuda()
+            y_test = torch.tensor(test_df[target_column].values).float().cuda()
+            x_test = torch.tensor(test_df.drop(target_column, axis=1).values.astype('float16')).float().cuda()
+        else:
+            y_train = torch.tensor(train_df[target_column].values).float()
+            x_train = torch.tensor(train_df.drop(target_column, axis=1).values.astype('float16')).float()
+            y_test = torch.tensor(test_df[target_column].values).float()
+            x_test = torch.tensor(test_df.drop(target_column, axis=1).values.astype('float16')).float()
     errors_and_weights = []
+    x_train_ni = remove_intercept_column(x_train)
+    x_test_ni = remove_intercept_column(x_test)
+    # unweighted expressivity of every feature for every ridge value, one eigendecomposition per split
+    total_exps_train = ridge_path(x_train_ni, y_train, flatvals)
+    with tracer.span('test_eval', feature='all') as span:
+        span.add('rows', x_test.shape[0])
+        total_exps_test = ridge_path(x_test_ni, y_test, flatvals)
+    sensitives = torch.zeros(x_train.shape[1], device=x_train.device)
+    sensitives[f_sensitive] = 1.
     for feature_num in range(x_train.shape[1]-1):
         print("Feature", feature_num, "of", x_train.shape[1]-1)
-        x_train_ni = remove_intercept_column(x_train)
-        total_exp_train = initial_value(x_train_ni, y_train, feature_num)
-        try:
-            _, assigns_min, params_min, s_record_min, p_record_min = train_and_return(x_train, y_train, feature_num,
-                                                                                      f_sensitive, alpha, minimize=True)
-            _, assigns_max, params_max, s_record_max, p_record_max = train_and_return(x_train, y_train, feature_num,
-                                                                                      f_sensitive, alpha, minimize=False)
-
-            furthest_exp_min, _ = final_value(x_train, y_train, params_min, feature_num)
-            furthest_exp_max, _ = final_value(x_train, y_train, params_max, feature_num)
-            valid_min = is_valid(assigns_min, alpha)
-            valid_max = is_valid(assigns_max, alpha)
-            if valid_max * abs(furthest_exp_max - total_exp_train) > valid_min * abs(furthest_exp_min - total_exp_train):
-                assigns_train, params, s_record, p_record = assigns_max, params_max, s_record_max, p_record_max
-                furthest_exp_train = furthest_exp_max
-            else:
-                assigns_train, params, s_record, p_record = assigns_min, params_min, s_record_min, p_record_min
-                furthest_exp_train = furthest_exp_min
-            subgroup_size_train = np.mean(assigns_train)
-
-            x_test_ni = remove_intercept_column(x_test)
-            total_exp = initial_value(x_test_ni, y_test, feature_num)
-            furthest_exp, assigns = final_value(x_test, y_test, params, feature_num)
-            subgroup_size = np.mean(assigns)
-            errors_and_weights.append((furthest_exp, feature_num))
-            print(furthest_exp, feature_num)
-            params_with_labels = {dataset.columns[i]: float(param) for (i, param) in enumerate(params)}
-            out_df = pd.concat([out_df, pd.DataFrame.from_records([{'Feature': dataset.columns[feature_num],
-                                                                    'Alpha': alpha,
-                                                                    'F(D)': total_exp,
-                                                                    'max(F(S))': furthest_exp,
-                                                                    'Difference': abs(furthest_exp - total_exp),
-                                                                    'Percent Change': 100*abs(furthest_exp - total_exp)/total_exp,
-                                                                    'Subgroup Coefficients': params_with_labels,
-                                                                    'Subgroup Size': subgroup_size,
-                                                                    'F(D)_train': total_exp_train,
-                                                                    'max(F(S))_train': furthest_exp_train,
-                                                                    'Difference_train': abs(furthest_exp_train - total_exp_train),
-                                                                    'Percent Change_train': 100*abs(furthest_exp_train - total_exp_train)/total_exp_train,
-                                                                    'Subgroup Size_train': subgroup_size_train,
-                                                                    'Size record': s_record,
-                                                                    'WLS Penalties': p_record}])])
-        except RuntimeError as e:
-            print(e)
-            continue
+        # trained subgroup parameters for the previous ridge value, to warm-start the next one
+        warm_min, warm_max = None, None
+        for f_i, flatval in enumerate(flatvals):
+            total_exp_train = total_exps_train[f_i, feature_num]
+            try:
+                iterations = niters if warm_min is None else warm_niters
+                with tracer.span('feature_opt', feature=dataset.columns[feature_num], alpha=alpha, flatval=flatval) as span:
+                    span.add('iterations', iterations)
+                    # both directions in one pass, keeping the valid one furthest from the full data's value
+                    best, warm = train_both_directions(
+                        x_train, y_train, feature_num, f_sensitive, alpha, total_exp_train, flatval=flatval,
+                        init_params=None if warm_min is None else (warm_min, warm_max), niters=iterations,
+                        project=args.project)
+                furthest_exp_train, assigns_train, params, s_record, p_record = best
+                warm_min, warm_max = warm
+                subgroup_size_train = np.mean(assigns_train)
+
+                with tracer.span('test_eval', feature=dataset.columns[feature_num], flatval=flatval) as span:
+                    span.add('rows', x_test.shape[0])
+                    total_exp = total_exps_test[f_i, feature_num]
+                    furthest_exp, assigns = final_value(x_test, y_test, params, feature_num, flatval)
+                subgroup_size = np.mean(assigns)
+                errors_and_weights.append((furthest_exp, feature_num))
+                print(furthest_exp, feature_num)
+                params_with_labels = {dataset.columns[i]: float(param) for (i, param) in enumerate(params)}
+                record = {'Feature': dataset.columns[feature_num],
+                          'Alpha': alpha,
+                          'flatval': flatval,
+                          'F(D)': total_exp,
+                          'max(F(S))': furthest_exp,
+                          'Difference': abs(furthest_exp - total_exp),
+                          'Percent Change': 100*abs(furthest_exp - total_exp)/total_exp,
+                          'Subgroup Coefficients': params_with_labels,
+                          'Subgroup Size': subgroup_size,
+                          'F(D)_train': total_exp_train,
+                          'max(F(S))_train': furthest_exp_train,
+                          'Difference_train': abs(furthest_exp_train - total_exp_train),
+                          'Percent Change_train': 100*abs(furthest_exp_train - total_exp_train)/total_exp_train,
+                          'Subgroup Size_train': subgroup_size_train,
+                          'Size record': s_record,
+                          'WLS Penalties': p_record,
+                          'Membership': 'sigmoid'}
+                if args.permutations:
+                    with tracer.span('permutation_test', feature=dataset.columns[feature_num]) as span:
+                        span.add('permutations', args.permutations)
+                        observed, null = permutation_null(x_test_ni, assigns, y_test, feature_num, args.permutations,
+                                                          flatval, flatval, seed)
+                    record['p_value'] = p_value(observed, null)
+                if args.reopt_permutations:
+                    with tracer.span('permutation_test', feature=dataset.columns[feature_num], reopt=True) as span:
+                        span.add('permutations', args.reopt_permutations)
+                        span.add('iterations', 2*niters)
+                        # both directions, keeping the larger valid difference per shuffle as the driver does
+                        nulls = []
+                        for sign in [1, -1]:
+                            diffs, sizes = reoptimize_null(
+                                x_train, y_train, sensitives, feature_num,
+                                lambda coefs, sizes, baselines: 100000*(torch.clamp(alpha[0]-sizes, min=0) +
+                                                                        torch.clamp(sizes-alpha[1], min=0))
+                                                                + .1*sign*coefs,
+                                args.reopt_permutations, [niters], flatval, flatval, seed,
+                                band=alpha if args.project else None)[niters]
+                            nulls.append(diffs * ((sizes > alpha[0]) & (sizes < alpha[1])))
+                    record['p_value_reopt'] = p_value(abs(furthest_exp_train - total_exp_train), np.maximum(*nulls))
+                if args.bootstrap:
+                    with tracer.span('bootstrap', feature=dataset.columns[feature_num]) as span:
+                        span.add('resamples', args.bootstrap)
+                        # the intervals are extra columns, a failure there keeps the point estimates
+                        try:
+                            record.update(bootstrap_ci(x_test_ni, assigns, y_test, feature_num, args.bootstrap,
+                                                       flatval, flatval, args.ci_level, seed))
+                        except RuntimeError as e:
+                            print("Bootstrap failed:", e)
+                out_df = pd.concat([out_df, pd.DataFrame.from_records([record])])
+            except RuntimeError as e:
+                print(e)
+                continue
     errors_sorted = sorted(errors_and_weights, key=lambda elem: abs(elem[0]), reverse=True)
     print(errors_sorted[0])
     #i_value = initial_value(x, y, errors_sorted[0][1])
@@ -303,52 +394,23 @@ def run_system(df, target, sensitive_features, df_name, dummy=False, t_split=.5)
     start = time.time()
     #alphas = [[.01,.05],[.05,.1],[.1,.15],[.15,.2]]
     alphas = [[.1,.15]]
+    if args.alpha:
+        alphas = [args.alpha]
     for a in alphas:
         print("Running", df_name, ", Alpha =", a)
         out = find_extreme_subgroups(df, alpha=a, target_column=target, f_sensitive=f_sensitive, t_split=t_split)
         final_df = pd.concat([final_df, out])
 
     date = datetime.today().strftime('%m_%d')
-    fname = f'output/nonsep/{df_name}_output_{date}.csv'
+    fname = args.out or f'output/nonsep/{df_name}_output_{date}.csv'
     final_df.to_csv(fname)
     print("Runtime:", '%.2f'%((time.time()-start)/3600), "Hours")
     return 1
 
-seed = 0
-
-df = pd.read_csv('data/student/student_cleaned.csv')
-target = 'G3'
-t_split = .5
-sensitive_features = ['sex_M', 'Pstatus_T', 'address_U', 'Dalc', 'Walc', 'health']
-df_name = 'student'
-run_system(df, target, sensitive_features, df_name, dummy, t_split)
-
-# df = pd.read_csv('data/compas/compas_recid.csv')
-# target = 'two_year_recid'
-# t_split = .5
-# sensitive_features = ['age','sex_Male','race_African-American','race_Asian','race_Caucasian','race_Hispanic','race_Native American','race_Other']
-# df_name = 'compas_recid'
-# run_system(df, target, sensitive_features, df_name, dummy, t_split)
-
-# df = pd.read_csv('data/compas/compas_decile.csv')
-# target = 'decile_score'
-# t_split = .5
-# sensitive_features = ['age','sex_Male','race_African-American','race_Asian','race_Caucasian','race_Hispanic','race_Native American','race_Other']
-# df_name = 'compas_decile'
-# run_system(df, target, sensitive_features, df_name, dummy, t_split)
-
-# df = BankDataset().convert_to_dataframe()[0]
-# target = 'y'
-# t_split = .2
-# sensitive_features = ['age', 'marital=married', 'marital=single', 'marital=divorced']
-# df_name = 'bank'
-# run_system(df, target, sensitive_features, df_name, dummy, t_split)
-
-# df = pd.read_csv('data/folktables/ACSIncome_MI_2018_new.csv')
-# target = 'PINCP'
-# t_split = .2
-# sensitive_features = ['AGEP', 'SEX', 'MAR_1.0', 'MAR_2.0', 'MAR_3.0', 'MAR_4.0', 'MAR_5.0', 'RAC1P_1.0', 'RAC1P_2.0',
-#                       'RAC1P_3.0', 'RAC1P_4.0', 'RAC1P_5.0', 'RAC1P_6.0', 'RAC1P_7.0', 'RAC1P_8.0', 'RAC1P_9.0']
-# df_name = 'folktables'
-# run_system(df, target, sensitive_features, df_name, dummy, t_split)
+with tracer.span('data_load', dataset=args.dataset):
+    df, target, sensitive_features, t_split = load_dataset(args.dataset)
+if args.t_split is not None:
+    t_split = args.t_split
+run_system(df, target, sensitive_features, args.dataset, dummy, t_split)
 
+tracer.close()
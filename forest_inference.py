@@ -0,0 +1,78 @@
+import numpy as np
+
+
+class LeafTableForest:
+    """
+    A fitted sklearn tree ensemble scored as a gather from a leaf table. The trees are still traversed by sklearn,
+    each by its own compiled apply over the whole batch. Only the leaf class fractions of all trees are gathered
+    into one contiguous table, and the batch's probabilities are summed straight from it, skipping sklearn's
+    per-call input validation, per-tree predict_proba copies and joblib dispatch. predict_proba matches the
+    sklearn model's predict_proba.
+    :param classifier: fitted RandomForestClassifier, ExtraTreesClassifier or DecisionTreeClassifier
+    """
+    def __init__(self, classifier):
+        trees = getattr(classifier, 'estimators_', [classifier])
+        self.classes_ = classifier.classes_
+        self.n_features = classifier.n_features_in_
+
+        self.trees, values, roots = [], [], []
+        offset = 0
+        for est in trees:
+            tree = est.tree_
+            if tree.n_outputs != 1:
+                raise ValueError("LeafTableForest only supports single-output classifiers")
+            # node values are class counts or fractions depending on the sklearn version, normalize either way
+            value = tree.value[:, 0, :]
+            values.append(value / value.sum(axis=1, keepdims=True))
+            self.trees.append(tree)
+            roots.append(offset)
+            offset += tree.node_count
+
+        # class-major, so each class's probabilities are one flat gather over all trees' leaves
+        self.value = np.ascontiguousarray(np.concatenate(values).T)
+        self.roots = np.array(roots, dtype=np.intp)
+
+    def apply(self, x):
+        """
+        Leaf reached in every tree by every sample.
+        :param x: m x p samples
+        :return: n_trees x m array of global node indices, columns of self.value
+        """
+        # sklearn trees split on float32 values and their apply only takes C-contiguous float32
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        leaves = np.empty((len(self.trees), x.shape[0]), dtype=np.intp)
+        for t, tree in enumerate(self.trees):
+            np.add(tree.apply(x), self.roots[t], out=leaves[t])
+        return leaves
+
+    def predict_proba(self, x):
+        leaves = self.apply(x)
+        return np.stack([np.take(value, leaves).sum(axis=0) for value in self.value], axis=1) / len(self.trees)
+
+    def predict(self, x):
+        return self.classes_.take(np.argmax(self.predict_proba(x), axis=1))
+
+    def matches(self, classifier, x, atol=1e-9):
+        """
+        Checks predict_proba against the sklearn model on the samples x.
+        """
+        return np.allclose(self.predict_proba(x), classifier.predict_proba(x), rtol=0, atol=atol)
+
+
+def fast_predict_proba(classifier, check_x=None):
+    """
+    predict_proba for the explanation pipeline. sklearn tree ensembles are scored through a LeafTableForest, after
+    checking it against the original on check_x if given. Any other classifier's own predict_proba is returned.
+    """
+    trees = getattr(classifier, 'estimators_', [classifier])
+    if not all(hasattr(tree, 'tree_') for tree in trees):
+        return classifier.predict_proba
+    try:
+        table = LeafTableForest(classifier)
+    except ValueError as e:
+        print(e)
+        return classifier.predict_proba
+    if check_x is not None and not table.matches(classifier, check_x):
+        print("LeafTableForest disagrees with", type(classifier).__name__, "- using its predict_proba")
+        return classifier.predict_proba
+    return table.predict_proba
@@ -0,0 +1,316 @@
+import argparse
+import ast
+import io
+import os
+import pickle
+import subprocess
+import sys
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from scipy.special import expit as sigmoid
+from datasets import DATASETS, load_dataset, split_dataset
+from tracing import tracer
+
+# Ridge terms each linear driver uses for F(D) and F(S). ext uses its flatval for both, read from the output.
+RIDGE = {
+    'nonsep': (0., 0.00001),
+    'ext': (None, None),
+}
+
+
+class GramStats:
+    """
+    Running x^T W x and x^T W y of a weighted least squares problem, plus the inverse of the (ridged) Gram matrix.
+    Appending m rows is a rank-m update. While m is below the number of features the inverse is updated with the
+    Woodbury identity instead of being recomputed.
+    :param d: number of features
+    :param flatval: ridge term added to the Gram matrix
+    :param refresh_every: recompute the inverse exactly after this many Woodbury updates to stop error building up
+    """
+    def __init__(self, d, flatval, refresh_every=100):
+        self.gram = flatval * np.eye(d)
+        self.moment = np.zeros(d)
+        self.inverse = None
+        self.refresh_every = refresh_every
+        self.woodbury_updates = 0
+
+    def update(self, x, y, weights):
+        xw = x * weights[:, None]
+        if self.inverse is not None and x.shape[0] < x.shape[1] and self.woodbury_updates < self.refresh_every:
+            # (A + U^T U)^-1 = A^-1 - A^-1 U^T (I + U A^-1 U^T)^-1 U A^-1, with U = sqrt(W) x
+            u = x * np.sqrt(weights)[:, None]
+            au = self.inverse @ u.T
+            self.inverse -= au @ np.linalg.solve(np.eye(x.shape[0]) + u @ au, au.T)
+            self.woodbury_updates += 1
+        else:
+            self.inverse = None
+        self.gram += xw.T @ x
+        self.moment += xw.T @ y
+
+    def coefficients(self):
+        if self.inverse is None:
+            self.inverse = np.linalg.inv(self.gram)
+            self.woodbury_updates = 0
+        return self.inverse @ self.moment
+
+
+def load_subgroups(path):
+    """
+    Reads the subgroups stored in a driver output csv.
+    :param path: output csv with 'Feature' and 'Subgroup Coefficients' columns
+    :return: the output dataframe, names of the subgroup parameters (the columns they multiply, in order), and a
+             subgroups x parameters coefficient matrix in the same row order as the dataframe
+    """
+    results = pd.read_csv(path, index_col=0).reset_index(drop=True)
+    coefficients = [ast.literal_eval(c) for c in results['Subgroup Coefficients']]
+    param_names = list(coefficients[0])
+    return results, param_names, np.array([[c[name] for name in param_names] for c in coefficients])
+
+
+def ridge_terms(results, method):
+    """
+    :return: ridge terms the driver used for F(D) and for F(S), one per output row
+    """
+    if method == 'ext':
+        return results['flatval'].to_numpy(), results['flatval'].to_numpy()
+    return np.full(len(results), RIDGE[method][0]), np.full(len(results), RIDGE[method][1])
+
+
+def design(df, target, param_names):
+    """
+    :return: features without the intercept (x), features with it (x_0) and target, as the linear drivers lay them out,
+             with the features rounded to float16 as the drivers' tensors are
+    """
+    x_0 = np.column_stack([df[name].to_numpy(dtype=np.float64) if name != 'Intercept' else np.ones(len(df))
+                           for name in param_names])
+    x_0 = x_0.astype(np.float16).astype(np.float64)
+    return x_0[:, :-1], x_0, df[target].to_numpy(dtype=np.float64)
+
+
+def init_state(output, dataset, method, command=None, lime=False, seed=0, t_split=None):
+    """
+    Builds the audit state for a finished linear driver run: Gram statistics for the full data and for each stored
+    subgroup, and the byte offset reached in the dataset's csv. The statistics start from the driver's test split,
+    split_dataset(df, t_split, seed) with the features rounded to float16, so the baseline matches the F(D), F(S),
+    Difference and Subgroup Size the driver reported. Appended rows are added on top of the test split.
+    :param output: the driver's output csv
+    :param dataset: key into DATASETS. Its source must be a csv that new rows are appended to.
+    :param method: 'nonsep' or 'ext', the driver that wrote output
+    :param command: command that reruns the driver and rewrites output, run when drift passes the threshold
+    :param lime: also track the mean LIME expressivity of every feature
+    :param seed: seed of the driver run
+    :param t_split: test fraction of the driver run, defaults to the dataset setting
+    :return: state dict
+    """
+    source = DATASETS[dataset]['source']
+    if source.startswith('aif360:'):
+        raise ValueError("Incremental audits need a csv source to append rows to")
+    offset = os.path.getsize(source)
+    df, target, _, dataset_t_split = load_dataset(dataset)
+    # the split only depends on the row count, so it matches the driver's whatever the column layout
+    train_df, test_df = split_dataset(df, dataset_t_split if t_split is None else t_split, seed)
+    results, param_names, params = load_subgroups(output)
+    features = param_names[:-1]
+    feature_index = [features.index(f) for f in results['Feature']]
+    flat_full, flat_subgroup = ridge_terms(results, method)
+
+    state = {'output': output, 'dataset': dataset, 'method': method, 'command': command, 'seed': seed,
+             't_split': t_split, 'source': source,
+             'source_columns': list(pd.read_csv(source, nrows=0).columns), 'target': target, 'offset': offset,
+             'n_rows': len(test_df), 'param_names': param_names, 'params': params, 'feature_index': feature_index,
+             'flat_full': flat_full, 'results': results[[c for c in ['Feature', 'Alpha', 'lam', 'niters', 'flatval']
+                                                         if c in results.columns]],
+             'full': {flat: GramStats(len(features), flat) for flat in set(flat_full)},
+             'subgroups': [GramStats(len(features), flat) for flat in flat_subgroup],
+             'sizes': np.zeros(len(results)), 'lime': None}
+    x, x_0, y = design(test_df, target, param_names)
+    ingest(state, x, x_0, y)
+    state['baseline'] = score(state)
+
+    if lime:
+        from sklearn.ensemble import RandomForestClassifier
+        # same classifier the LIME drivers fit
+        x_train = train_df.drop(target, axis=1).to_numpy()
+        classifier = RandomForestClassifier(random_state=seed)
+        classifier.fit(x_train, train_df[target].to_numpy())
+        # LIME's explainer does not pickle, so the state keeps what rebuilds it
+        state['lime'] = {'classifier': classifier, 'x_train': x_train, 'seed': seed,
+                         'sums': np.zeros(len(features)), 'count': 0}
+        explain(state, test_df.drop(target, axis=1).to_numpy())
+        state['lime']['baseline'] = state['lime']['sums'] / state['lime']['count']
+    return state
+
+
+def ingest(state, x, x_0, y):
+    """
+    Adds rows to every Gram statistic, in time proportional to the number of rows.
+    """
+    for stats in state['full'].values():
+        stats.update(x, y, np.ones(len(x)))
+    weights = sigmoid(x_0 @ state['params'].T)
+    for j, stats in enumerate(state['subgroups']):
+        stats.update(x, y, weights[:, j])
+    state['sizes'] += weights.sum(axis=0)
+
+
+def explain(state, x):
+    """
+    Explains only the rows in x with the stored LIME explainer and adds them to the running sums.
+    """
+    from lime_exp_func import LimeExpFunc
+    lime = state['lime']
+    exp_func = LimeExpFunc(lime['classifier'], lime['x_train'], lime['seed'])
+    exp_func.populate_exps(x)
+    lime['sums'] += exp_func.as_matrix().sum(axis=0)
+    lime['count'] += len(x)
+
+
+def score(state):
+    """
+    :return: F(D), F(S), difference and size of every stored subgroup over the test split and the rows appended since
+    """
+    full = {flat: stats.coefficients() for flat, stats in state['full'].items()}
+    out = state['results'].copy()
+    out['F(D)'] = [full[flat][f] for flat, f in zip(state['flat_full'], state['feature_index'])]
+    out['F(S)'] = [stats.coefficients()[f] for stats, f in zip(state['subgroups'], state['feature_index'])]
+    out['Difference'] = np.abs(out['F(S)'] - out['F(D)'])
+    out['Subgroup Size'] = state['sizes'] / state['n_rows']
+    return out
+
+
+def read_new_rows(state):
+    """
+    Parses only the bytes appended to the source since the last update. A trailing partial line is left for the
+    next update.
+    :return: dataframe of the new rows, None if there are none
+    """
+    with open(state['source'], 'rb') as f:
+        f.seek(state['offset'])
+        data = f.read()
+    end = data.rfind(b'\n') + 1
+    if end == 0:
+        return None
+    state['offset'] += end
+    return pd.read_csv(io.BytesIO(data[:end]), header=None, names=state['source_columns'])
+
+
+def update(state, threshold=.1):
+    """
+    Ingests the rows appended since the last update and re-scores every stored subgroup.
+    :param threshold: relative change in a subgroup's difference (or in a feature's mean LIME expressivity) that
+                      counts as drift
+    :return: report dataframe with a Drift column and a Reoptimize flag per subgroup, None if there was nothing new
+    """
+    with tracer.span('data_load', source='append') as span:
+        new = read_new_rows(state)
+        if new is None:
+            return None
+        span.add('rows', len(new))
+    with tracer.span('incremental_update') as span:
+        span.add('rows', len(new))
+        x, x_0, y = design(new, state['target'], state['param_names'])
+        state['n_rows'] += len(new)
+        ingest(state, x, x_0, y)
+        report = score(state)
+    baseline = state['baseline']['Difference'].to_numpy()
+    report['Baseline Difference'] = baseline
+    report['Drift'] = np.abs(report['Difference'] - baseline) / np.maximum(np.abs(baseline), 1e-12)
+    report['Reoptimize'] = report['Drift'] > threshold
+
+    if state['lime'] is not None:
+        with tracer.span('lime_populate', split='append') as span:
+            span.add('rows', len(new))
+            explain(state, new.drop(state['target'], axis=1)[state['param_names'][:-1]].to_numpy())
+        lime = state['lime']
+        mean = lime['sums'] / lime['count']
+        lime_drift = np.abs(mean - lime['baseline']) / np.maximum(np.abs(lime['baseline']), 1e-12)
+        report['LIME F(D)'] = mean[state['feature_index']]
+        report['LIME Drift'] = lime_drift[state['feature_index']]
+        report['Reoptimize'] |= report['LIME Drift'] > threshold
+    report['rows'] = state['n_rows']
+    report['time'] = datetime.now().isoformat(timespec='seconds')
+    return report
+
+
+def save_state(state, path):
+    # Gram statistics are stored as plain dicts so the state loads whether this module ran as a script or not
+    state = dict(state, full={flat: vars(stats) for flat, stats in state['full'].items()},
+                 subgroups=[vars(stats) for stats in state['subgroups']])
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(tmp, path)
+
+
+def load_state(path):
+    with open(path, 'rb') as f:
+        state = pickle.load(f)
+
+    def restore(attrs):
+        stats = GramStats.__new__(GramStats)
+        stats.__dict__.update(attrs)
+        return stats
+    state['full'] = {flat: restore(attrs) for flat, attrs in state['full'].items()}
+    state['subgroups'] = [restore(attrs) for attrs in state['subgroups']]
+    return state
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Incrementally re-audit stored subgroups as rows are appended')
+    sub = parser.add_subparsers(dest='action', required=True)
+    init_parser = sub.add_parser('init', help='build the audit state from a finished linear driver run, optionally '
+                                              'followed by -- and the driver command that rewrites OUTPUT')
+    init_parser.add_argument('output', type=str, help="the driver's output csv")
+    init_parser.add_argument('--dataset', type=str, required=True, help='dataset name from datasets.DATASETS')
+    init_parser.add_argument('--method', choices=sorted(RIDGE), required=True, help='driver that wrote the output')
+    init_parser.add_argument('--seed', type=int, default=0, help='seed of the driver run')
+    init_parser.add_argument('--t-split', type=float, default=None,
+                             help='test fraction of the driver run, defaults to the dataset setting')
+    init_parser.add_argument('--lime', action='store_true', help='also track mean LIME expressivities')
+    init_parser.add_argument('--state', type=str, default=None, help='state file, defaults to OUTPUT.audit.pkl')
+    update_parser = sub.add_parser('update', help='ingest appended rows and re-score the stored subgroups')
+    update_parser.add_argument('state', type=str)
+    update_parser.add_argument('--threshold', type=float, default=.1, help='relative drift that triggers reoptimizing')
+    update_parser.add_argument('--report', type=str, default=None,
+                               help='csv the re-scored subgroups are appended to, defaults to OUTPUT_audit.csv')
+    update_parser.add_argument('--no-reoptimize', action='store_true', help='only report drift')
+    parser.add_argument('--trace', type=str, default=None, help='append JSON phase timings to this file')
+    # init OUTPUT ... -- DRIVER COMMAND: everything after -- reruns the driver when drift is too large
+    argv = sys.argv[1:]
+    split = argv.index('--') if '--' in argv else len(argv)
+    args = parser.parse_args(argv[:split])
+    command = argv[split + 1:]
+    if args.trace:
+        tracer.enable(args.trace)
+
+    if args.action == 'init':
+        state = init_state(args.output, args.dataset, args.method, command or None, args.lime, args.seed, args.t_split)
+        save_state(state, args.state or args.output + '.audit.pkl')
+        print("Audit state for", len(state['subgroups']), "subgroups over", state['n_rows'], "test rows")
+    else:
+        state = load_state(args.state)
+        start = time.time()
+        report = update(state, args.threshold)
+        if report is None:
+            print("No new rows")
+        else:
+            print(report[['Feature', 'F(D)', 'F(S)', 'Difference', 'Drift', 'Reoptimize']])
+            report_path = args.report or state['output'][:-len('.csv')] + '_audit.csv'
+            report.to_csv(report_path, mode='a', header=not os.path.exists(report_path), index=False)
+            print("Update:", '%.3f' % (time.time() - start), "seconds")
+            if report['Reoptimize'].any() and not args.no_reoptimize:
+                if state['command'] is None:
+                    print("Drift above threshold for", sorted(set(report['Feature'][report['Reoptimize']])),
+                          "- rerun the driver and init again")
+                else:
+                    print("Drift above threshold, rerunning:", ' '.join(state['command']))
+                    with tracer.span('reoptimize'):
+                        code = subprocess.call(state['command'])
+                    if code != 0:
+                        raise SystemExit(code)
+                    state = init_state(state['output'], state['dataset'], state['method'], state['command'],
+                                       state['lime'] is not None, state['seed'], state['t_split'])
+        save_state(state, args.state)
+    tracer.close()
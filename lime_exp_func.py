@@ -1,23 +1,62 @@
-from lime.lime_tabular import LimeTabularExplainer
 import re
+import json
+import numpy as np
+from sklearn.metrics import pairwise_distances
+from exp_func import ExpFunc
+from forest_inference import fast_predict_proba
 
 
-class LimeExpFunc:
-    def __init__(self, classifier, dataset, seed):
+class LimeExpFunc(ExpFunc):
+    """
+    :param adaptive: draw LIME's perturbation samples in rounds and stop once the standard error of the top_k
+                     largest coefficients is at most tol, or max_samples have been drawn. The first round draws
+                     round_size samples and each later round doubles the total, so the fixed per-round cost of
+                     sampling and scoring is paid a handful of times per row. Otherwise every row uses LIME's
+                     fixed 5000 samples.
+    """
+    def __init__(self, classifier, dataset, seed, adaptive=False, tol=.02, top_k=5, round_size=500, max_samples=5000):
         self.classifier = classifier
         self.dataset = dataset
         self.exps = []
+        self.matrix = None
+        self.n_features = dataset.shape[1]
+        self.adaptive = adaptive
+        self.tol = tol
+        self.top_k = top_k
+        self.round_size = round_size
+        self.max_samples = max_samples
+        # samples drawn for each row of exps, and for adaptive runs the achieved standard error
+        self.num_samples = []
+        self.std_errs = []
+        # imported here so loading this module doesn't pull in lime
+        from lime.lime_tabular import LimeTabularExplainer
         self.lime_exp = LimeTabularExplainer(self.dataset, random_state=seed)
+        # adaptive rounds draw from LIME's private sampler (lime 0.2.0.1, pinned in requirements.txt), other
+        # versions fall back to the fixed samples
+        self.sampler = getattr(self.lime_exp, '_LimeTabularExplainer__data_inverse', None)
+        if self.adaptive and (self.sampler is None or not hasattr(self.lime_exp, 'base')):
+            print("This lime version has no LimeTabularExplainer sampler to draw rounds from, using fixed samples")
+            self.adaptive = False
+        # tree ensembles are scored from a table of their leaf values, checked against the original
+        self.predict_proba = fast_predict_proba(classifier, check_x=self.dataset[:100])
 
     # Populate exps with expressivity dictionaries
     # exps[n][i] returns expressivity of feature i in datapoint n
-    def populate_exps(self):
+    # rows defaults to the dataset. Other rows, e.g. newly arrived ones, are explained with the same explainer
+    # and appended to exps.
+    def populate_exps(self, rows=None):
+        if rows is None:
+            rows = self.dataset
         i = 0
-        for row in self.dataset:
+        for row in rows:
             if i % 100 == 0:
-                print(i, '/', len(self.dataset))
+                print(i, '/', len(rows))
             #print('Computing ', i)
-            exp_i = self.lime_exp.explain_instance(row, self.classifier.predict_proba, num_features=row.shape[0]).as_list()
+            if self.adaptive:
+                self.exps.append(self.explain_adaptive(row))
+                i += 1
+                continue
+            exp_i = self.lime_exp.explain_instance(row, self.predict_proba, num_features=row.shape[0]).as_list()
             exp_dict = {}
             # Clean up LIME output and return dict with key=feature, value=expressivity
             for e in exp_i:
@@ -27,17 +66,57 @@ class LimeExpFunc:
                         feature = int(p)
                 exp_dict[feature] = e[1]
             self.exps.append(exp_dict)
+            self.num_samples.append(5000)
+            self.std_errs.append(None)
             i += 1
 
-    # Given feature and row, return the computed expressivities
-    def get_exp(self, row, feature):
-        if len(self.exps) == 0:
-            print("Expressivity dict empty. Populating now...")
-            self.populate_exps()
-        return self.exps[row][feature]
-
-    def get_total_exp(self, assigns, feature_num):
-        total_expressivity = 0
-        for i in range(len(assigns)):
-            total_expressivity += assigns[i] * self.exps[i][feature_num]
-        return total_expressivity
+    def explain_adaptive(self, row):
+        """
+        LIME explanation of one row with samples drawn in rounds. Same sampling, kernel and ridge fit as
+        explain_instance, only the number of samples changes.
+        :return: dict with key=feature, value=expressivity
+        """
+        lime_exp = self.lime_exp
+        sample = self.sampler
+        # the first sample is the row itself, later rounds drop theirs
+        data, inverse = sample(row, min(self.round_size, self.max_samples))
+        yss = self.predict_proba(inverse)
+        while True:
+            scaled = (data - lime_exp.scaler.mean_) / lime_exp.scaler.scale_
+            distances = pairwise_distances(scaled, scaled[:1]).ravel()
+            weights = lime_exp.base.kernel_fn(distances)
+            coef, std_err = ridge_std_err(scaled, yss[:, 1], weights)
+            err = std_err[np.argsort(-np.abs(coef))[:self.top_k]].max()
+            if err <= self.tol or len(data) >= self.max_samples:
+                break
+            more, more_inverse = sample(row, min(len(data), self.max_samples - len(data)) + 1)
+            data = np.vstack([data, more[1:]])
+            yss = np.vstack([yss, self.predict_proba(more_inverse[1:])])
+        _, exp_i, _, _ = lime_exp.base.explain_instance_with_data(scaled, yss, distances, 1, row.shape[0],
+                                                                  feature_selection=lime_exp.feature_selection)
+        self.num_samples.append(len(data))
+        self.std_errs.append(float(err))
+        return {int(f): float(w) for f, w in exp_i}
+
+
+def write_sample_stats(exp_func, path):
+    # per-row sample counts and achieved standard errors, in the same row order as the exps file
+    print("mean samples per row:", sum(exp_func.num_samples) / len(exp_func.num_samples))
+    with open(path, 'w') as fout:
+        json.dump({'num_samples': exp_func.num_samples, 'std_errs': exp_func.std_errs}, fout)
+
+
+def ridge_std_err(x, y, weights, alpha=1.):
+    """
+    Weighted ridge fit with intercept, as LIME fits its local model, and the heteroskedasticity-robust standard
+    error of each coefficient. The standard errors measure how much the coefficients move between sample draws.
+    :return: coefficients, standard errors
+    """
+    w = weights / weights.sum()
+    xc = x - w @ x
+    yc = y - w @ y
+    a_inv = np.linalg.inv((xc.T * weights) @ xc + alpha * np.eye(x.shape[1]))
+    coef = a_inv @ ((xc.T * weights) @ yc)
+    scores = xc * (weights * (yc - xc @ coef))[:, None]
+    cov = a_inv @ (scores.T @ scores) @ a_inv
+    return coef, np.sqrt(np.clip(np.diag(cov), 0, None))
@@ -2,12 +2,18 @@ import torch
 import pandas as pd
 import numpy as np
 from torch.special import expit as sigmoid
-from torch.optim import Adam
+from torch.optim import Adam, LBFGS
+from torch.nn.functional import softplus
 import time
 from datetime import datetime
-from aif360.datasets import CompasDataset, BankDataset
-from sklearn.model_selection import train_test_split
 import argparse
+from tracing import tracer
+from datasets import load_dataset, split_dataset, to_csr
+from permutation_test import permutation_null, reoptimize_null, p_value
+from bootstrap import bootstrap_ci
+from compression import PatternCompression
+from size_projection import band_shift
+from wls_loss import FusedLoss
 
 
 parser = argparse.ArgumentParser(description='Locally separable run')
@@ -15,11 +21,62 @@ parser.add_argument('lam', type=float)
 parser.add_argument('niters', type=int)
 parser.add_argument('--dummy', action='store_true')
 parser.add_argument('--cuda', action='store_true')
+parser.add_argument('--dataset', type=str, default='student', help='dataset name from datasets.DATASETS')
+parser.add_argument('--alpha', type=float, nargs=2, default=None, help='subgroup size band, e.g. --alpha .1 .15')
+parser.add_argument('--alphas', type=float, nargs='+', default=None,
+                    help='sweep several alpha bands, given as LOW HIGH pairs, e.g. --alphas .01 .05 .1 .15')
+parser.add_argument('--lams', type=float, nargs='+', default=None, help='sweep several lam values instead of lam')
+parser.add_argument('--niters-grid', type=int, nargs='+', default=None,
+                    help='record results after each of these iteration counts instead of niters')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--t-split', type=float, default=None, help='test fraction, defaults to the dataset setting')
+parser.add_argument('--out', type=str, default=None, help='output csv path, defaults to a dated file under output/')
+parser.add_argument('--permutations', type=int, default=0,
+                    help='p-value of each learned subgroup on the test set against this many shuffled targets')
+parser.add_argument('--reopt-permutations', type=int, default=0,
+                    help='also relearn subgroups on this many shuffled train targets for a p-value that accounts for the search')
+parser.add_argument('--bootstrap', type=int, default=0,
+                    help='add bootstrap confidence intervals over this many resamples of the test set')
+parser.add_argument('--ci-level', type=float, default=.95, help='coverage of the --bootstrap intervals')
+parser.add_argument('--compress', action='store_true',
+                    help='optimize over unique sensitive feature patterns instead of rows, same objective')
+parser.add_argument('--sparse', action='store_true',
+                    help='run the optimizer on sparse tensors, for datasets dominated by one-hot columns')
+parser.add_argument('--sketch', type=int, default=0,
+                    help='optimize on a leverage-score row sample of about this many train rows, then evaluate on all rows')
+parser.add_argument('--optimizer', choices=['adam', 'lbfgs'], default='adam',
+                    help='subgroup parameter search: Adam for niters steps, or L-BFGS with a line search that stops '
+                         'once the loss stops improving')
+parser.add_argument('--size-smoothing', type=float, default=None,
+                    help='sharpness of the softplus size penalty, 0 for the hinge. Defaults to the hinge for adam '
+                         'and 200 for lbfgs, whose line search needs a smooth objective')
+parser.add_argument('--project', action='store_true',
+                    help='after every step, shift the subgroup intercept so its size is inside the alpha band. Every '
+                         'iterate is then feasible and lam has no effect with the hinge penalty')
+parser.add_argument('--jit', choices=['script', 'compile'], default=None,
+                    help='run the dense loss as one TorchScript or torch.compile function with a fused Adam step, '
+                         'falling back to eager if the backend is unavailable')
+parser.add_argument('--trace', type=str, default=None, help='append JSON phase timings to this file')
+parser.add_argument('--trace-memory', action='store_true', help='sample peak memory at the end of every span')
 args = parser.parse_args()
+if args.alphas and len(args.alphas) % 2:
+    parser.error('--alphas takes LOW HIGH pairs')
+if (args.sketch > 0) + args.compress + args.sparse > 1:
+    parser.error('--sketch, --compress and --sparse are alternatives')
+if args.project and args.optimizer == 'lbfgs':
+    parser.error('--project moves the iterate between steps, which L-BFGS curvature pairs assume it does not')
+if min([args.lam] + (args.lams or [])) < 0:
+    parser.error('lam weights the size penalty and must be at least 0')
 lam = args.lam
 niters = args.niters
 dummy = args.dummy
 useCUDA = args.cuda
+seed = args.seed
+smoothing = args.size_smoothing if args.size_smoothing is not None else (200. if args.optimizer == 'lbfgs' else 0.)
+# built once, so the compiled loss is reused across features
+fused_loss = FusedLoss(args.jit) if args.jit else None
+if args.trace:
+    tracer.enable(args.trace, memory=args.trace_memory)
 
 # Enable GPU if desired. Sometimes returns false values
 if useCUDA:
@@ -28,25 +85,49 @@ else:
     torch.device('cuda:0')
 
 
+def size_penalty(size, alpha: list, lam: float, smoothing: float = 0.):
+    """
+    Penalty on a subgroup size outside the alpha band
+    :param size: subgroup size as a share of rows, float or tensor, e.g. a batch of sizes
+    :param smoothing: 0 for the hinge lam * (distance outside the band), otherwise the sharpness of a softplus
+                      approximation of it, which has a continuous gradient for line searches
+    """
+    if not smoothing and torch.is_tensor(size):
+        return lam*(torch.clamp(alpha[0]-size, min=0) + torch.clamp(size-alpha[1], min=0))
+    if not smoothing:
+        return lam*(max(alpha[0]-size, 0) + max(size-alpha[1], 0))
+    size = torch.as_tensor(size)
+    return lam*(softplus(alpha[0]-size, beta=smoothing) + softplus(size-alpha[1], beta=smoothing))
+
+
 def loss_fn_generator(x_0: torch.Tensor, y: torch.Tensor, initial_val: float, feature_num: int,
-                      sensitives: torch.Tensor, alpha: list):
+                      sensitives: torch.Tensor, alpha: list, lam: float = lam, compressed: tuple = None,
+                      sketch: tuple = None, smoothing: float = 0.):
     """
     Factory for the loss function that pytorch runs will be optimizing in WLS
-    :param x_0: the data tensor with intercept column
+    :param x_0: the data tensor with intercept column. With compressed or sketch only its shape is used, so it may
+                be the first SparseOperator of sparse_stats.
     :param y: the target tensor
     :param initial_val: expressivity over full dataset
     :param feature_num: Which feature in the data do we care about
     :param sensitives: tensor representing sensitive features
     :param alpha: desired subgroup size
     :param minimize: Boolean -- are we minimizing or maximizing
+    :param lam: weight of the subgroup size penalty
+    :param compressed: compressed_stats (or sparse_stats) of x_0 and y. The loss then runs over sensitive patterns
+                       instead of rows (or over sparse rows).
+    :param sketch: sketch_rows of x_0 and y. The loss then runs over the sampled rows with their importance weights.
+    :param smoothing: see size_penalty
     :return: a loss function for our particular WLS problem.
     """
     # TODO: investigate minimize/maximize boolean
-    x = remove_intercept_column(x_0)
+    # the compressed and sketched losses only need the shape, so --sparse never densifies the train rows here
+    n, d = x_0.shape[0], x_0.shape[1] - 1
+    x = remove_intercept_column(x_0) if compressed is None and sketch is None else None
 
-    basis_list = [[0. for _ in range(x.shape[1])]]
+    basis_list = [[0. for _ in range(d)]]
     basis_list[0][feature_num] = 1.
-    flat_list = [0.00001 for _ in range(x.shape[1])]
+    flat_list = [0.00001 for _ in range(d)]
 
     if useCUDA:
         basis = torch.tensor(basis_list, requires_grad=True).cuda()
@@ -66,11 +147,174 @@ def loss_fn_generator(x_0: torch.Tensor, y: torch.Tensor, initial_val: float, fe
 
         #size_penalty = lam*torch.abs((torch.sum(one_d)/x.shape[0])-alpha)
         size = torch.sum(one_d)/x.shape[0]
-        size_penalty = lam*(max(alpha[0]-size, 0) + max(size-alpha[1], 0))
         # we want to maximize difference penalty but minimize size penalty
-        return size_penalty - .1*difference_penalty
+        return size_penalty(size, alpha, lam, smoothing) - .1*difference_penalty
+
+    # x^T W x and x^T W y are sums of each pattern's Gram block and moment, weighted by the pattern's membership.
+    # Gram blocks are stored flattened as the columns of a d^2 x k matrix, which may be sparse.
+    def compressed_loss_fn(params):
+        patterns, grams, moments, counts, _ = compressed
+        one_d = sigmoid(matvec(patterns, sensitives * params))
+        denom = torch.inverse(matvec(grams, one_d).reshape(d, d) + torch.diag(flat))
+        difference_penalty = torch.abs(basis @ (denom @ matvec(moments, one_d)) - initial_val)
+
+        size = (one_d @ counts)/n
+        return size_penalty(size, alpha, lam, smoothing) - .1*difference_penalty
+
+    # importance weights make the sketch's weighted Gram matrix, moment and size unbiased for the full data's
+    def sketch_loss_fn(params):
+        rows, y_s, importance = sketch[:3]
+        x_s = rows[:, :-1]
+        weights = importance * sigmoid(rows @ (sensitives * params))
+        denom = torch.inverse((torch.t(x_s * weights[:, None]) @ x_s) + torch.diag(flat))
+        difference_penalty = torch.abs(basis @ (denom @ (torch.t(x_s) @ (weights * y_s))) - initial_val)
+
+        size = torch.sum(weights)/n
+        return size_penalty(size, alpha, lam, smoothing) - .1*difference_penalty
+
+    # the scripted or compiled version of loss_fn, whose inputs are built once here instead of every step
+    if fused_loss is not None and x is not None:
+        x_t_fused = torch.t(x).contiguous()
+        flat_fused = torch.diag(flat).detach()
+        basis_fused = basis.detach()
+        consts = torch.tensor([initial_val, alpha[0], alpha[1], lam], device=x.device)
+
+        def fused_loss_fn(params):
+            return fused_loss(x_0, x_t_fused, x, y, params, sensitives, basis_fused, flat_fused, consts,
+                              float(smoothing))
+
+    if sketch is not None:
+        return sketch_loss_fn
+    if compressed is not None:
+        return compressed_loss_fn
+    return loss_fn if fused_loss is None else fused_loss_fn
+
+
+class SparseMatVec(torch.autograd.Function):
+    """
+    a @ v for a scipy CSR matrix a, differentiable in v. scipy's CSR kernels are several times faster than torch's
+    sparse matmul on CPU, and the backward pass is one more product with the stored transpose.
+    """
+    @staticmethod
+    def forward(ctx, v, a, a_t):
+        ctx.a_t = a_t
+        return torch.from_numpy(a @ v.detach().cpu().numpy()).to(v.device)
+
+    @staticmethod
+    def backward(ctx, grad):
+        return torch.from_numpy(ctx.a_t @ grad.cpu().numpy()).to(grad.device), None, None
+
+
+class SparseOperator:
+    """
+    A scipy sparse matrix kept in CSR together with its transpose, for SparseMatVec
+    """
+    def __init__(self, a, dtype=np.float32):
+        self.a = a.tocsr().astype(dtype)
+        self.a_t = self.a.T.tocsr()
+        self.shape = self.a.shape
 
-    return loss_fn
+
+def matvec(a, v: torch.Tensor) -> torch.Tensor:
+    """
+    a @ v for a dense tensor or a SparseOperator a and a vector v
+    """
+    if isinstance(a, SparseOperator):
+        return SparseMatVec.apply(v, a.a, a.a_t)
+    return (a @ v[:, None])[:, 0]
+
+
+def compressed_stats(x_0: torch.Tensor, y: torch.Tensor, f_sensitive: list):
+    """
+    Groups the rows of x_0 by their sensitive feature values, see PatternCompression.
+    :param x_0: the data tensor with intercept column
+    :param y: the target tensor
+    :param f_sensitive: indices of sensitive features
+    :return: k x p first row of each pattern, d^2 x k flattened Gram blocks, d x k moments, k row counts (as
+             tensors on x_0's device) and the PatternCompression that expands pattern values back to rows
+    """
+    x_np = x_0.cpu().numpy()
+    groups = PatternCompression(x_np[:, f_sensitive])
+    x_ni = x_np[:, :-1]
+    stats = [x_np[groups.first], groups.grams(x_ni).reshape(groups.k, -1).T, groups.moments(x_ni, y.cpu().numpy()).T,
+             groups.counts]
+    return tuple(torch.tensor(np.ascontiguousarray(a), dtype=x_0.dtype, device=x_0.device) for a in stats) + (groups,)
+
+
+def sparse_stats(x_0, y: torch.Tensor, device=None):
+    """
+    Sparse counterpart of compressed_stats with every row its own pattern. Row i's Gram block x_i x_i^T has
+    nnz_i^2 entries, so the weighted Gram matrix of a step costs sum_i nnz_i^2 instead of n d^2.
+    :param x_0: scipy CSR data with intercept column
+    :param y: the target tensor
+    :return: tuple laid out like compressed_stats, with SparseOperators and no PatternCompression
+    """
+    from scipy import sparse
+    x_0 = sparse.csr_matrix(x_0)
+    x = x_0[:, :-1].tocsr()
+    n, d = x.shape
+    lengths = np.diff(x.indptr)
+    # every pair (a, b) of nonzeros in the same row gives entry (col_a * d + col_b, row) of the d^2 x n matrix
+    row_of = np.repeat(np.arange(n), lengths)
+    sizes = lengths[row_of]
+    a = np.repeat(np.arange(len(x.indices)), sizes)
+    b = x.indptr[row_of][a] + np.arange(len(a)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    grams = sparse.csr_matrix((x.data[a] * x.data[b], (x.indices[a] * d + x.indices[b], row_of[a])),
+                              shape=(d * d, n))
+    moments = sparse.csr_matrix(x.multiply(y.cpu().numpy()[:, None]).T)
+    return (SparseOperator(x_0), SparseOperator(grams), SparseOperator(moments),
+            torch.ones(n, dtype=y.dtype, device=device), None)
+
+
+def stats_coefficients(stats: tuple, weights: torch.Tensor, flat: float) -> torch.Tensor:
+    """
+    WLS coefficients of the rows behind compressed_stats (or sparse_stats), from the stored Gram blocks and moments
+    :param weights: weight of each pattern (or sparse row)
+    :param flat: ridge term
+    """
+    _, grams, moments, _, _ = stats
+    d = moments.shape[0]
+    ridge = torch.diag(torch.full((d,), flat, device=weights.device))
+    return torch.inverse(matvec(grams, weights).reshape(d, d) + ridge) @ matvec(moments, weights)
+
+
+def stats_final_value(stats: tuple, params: np.ndarray, feature_num: int):
+    """
+    final_value on the rows behind compressed_stats (or sparse_stats), so --sparse evaluates the train split
+    without its dense tensor
+    :return: the float value of expressivity over the rows and subgroup assignments of every row
+    """
+    patterns, groups = stats[0], stats[-1]
+    one_d = sigmoid(matvec(patterns, torch.tensor(params, dtype=stats[3].dtype, device=stats[3].device)))
+    value = stats_coefficients(stats, one_d, 0.00001)[feature_num].item()
+    one_d = one_d.cpu().detach().numpy()
+    return value, one_d if groups is None else groups.expand(one_d)
+
+
+def sketch_rows(x_0: torch.Tensor, y: torch.Tensor, m: int, seed: int = 0, chunk: int = 2**20):
+    """
+    Row-sampling sketch of a split. Row i is kept with probability q_i = min(1, m p_i) and weighted by 1/q_i, where
+    p_i mixes its leverage score h_i / d with the uniform 1/n. Leverage keeps the rows that shape the full Gram
+    matrix, and the uniform half keeps rows that are unremarkable overall but may matter inside a subgroup.
+    :param x_0: the data tensor with intercept column
+    :param y: the target tensor
+    :param m: expected number of sampled rows
+    :param chunk: rows per block when computing leverage scores, which never materializes more than chunk x d
+    :return: sampled rows of x_0, their targets, importance weights and row indices
+    """
+    n, d = x_0.shape[0], x_0.shape[1] - 1
+    gram = torch.zeros(d, d, dtype=torch.float64, device=x_0.device)
+    for start in range(0, n, chunk):
+        block = x_0[start:start + chunk, :-1].double()
+        gram += torch.t(block) @ block
+    gram_inv = torch.linalg.pinv(gram, hermitian=True)
+    leverage = torch.cat([torch.sum((x_0[start:start + chunk, :-1].double() @ gram_inv) *
+                                    x_0[start:start + chunk, :-1].double(), dim=1)
+                          for start in range(0, n, chunk)])
+    p = .5 * leverage / leverage.sum() + .5 / n
+    q = torch.clamp(m * p, max=1.)
+    keep = torch.rand(n, generator=torch.Generator().manual_seed(seed), dtype=torch.float64).to(x_0.device) < q
+    return x_0[keep], y[keep], (1 / q[keep]).to(x_0.dtype), torch.nonzero(keep).squeeze(1)
 
 
 def train_and_return(x: torch.Tensor, y: torch.Tensor, feature_num: int, initial_val: float,
@@ -86,7 +330,34 @@ def train_and_return(x: torch.Tensor, y: torch.Tensor, feature_num: int, initial
     :param alpha: target subgroup size
     :return: the differential expressivity and maximal subset weights.
     """
-    #niters = niter
+    return train_checkpoints(x, y, feature_num, initial_val, f_sensitive, alpha, lam, [niters],
+                             optimizer=args.optimizer, smoothing=smoothing, project=args.project)[niters]
+
+
+def train_checkpoints(x: torch.Tensor, y: torch.Tensor, feature_num: int, initial_val: float,
+                      f_sensitive: list, alpha: list, lam: float, checkpoints: list, init_params: np.ndarray = None,
+                      compressed: tuple = None, sketch: tuple = None, optimizer: str = 'adam',
+                      smoothing: float = 0., tol: float = 1e-7, project: bool = False):
+    """
+    train_and_return for several iteration counts in one run. The result at each checkpoint is what
+    train_and_return would return with niters set to it, since the runs only differ in when they stop.
+    :param lam: weight of the subgroup size penalty
+    :param checkpoints: iteration counts to record results at
+    :param init_params: parameters to start from, e.g. from a nearby sweep point. Random if None.
+    :param compressed: compressed_stats (or sparse_stats) of x and y, to optimize over sensitive patterns instead
+                       of rows (or over sparse rows). x is then only used for its shape, and may be the first
+                       SparseOperator of sparse_stats.
+    :param sketch: sketch_rows of x and y, to optimize on the sketch. The returned assignments are still computed
+                   on all rows of x.
+    :param optimizer: 'adam' (lr .05) or 'lbfgs'. An L-BFGS iteration is one quasi-Newton step with a strong Wolfe
+                      line search, so it can take several loss evaluations. L-BFGS stops once an iteration improves
+                      the loss by less than tol relative, and later checkpoints get the converged result.
+    :param smoothing: see size_penalty
+    :param project: shift the intercept (the last parameter) onto the alpha band before the first step and after
+                    every step, see band_shift
+    :return: dict from checkpoint to the train_and_return tuple at that iteration, followed by the number of loss
+             evaluations up to it
+    """
     # Set seed to const value for reproducibility
     torch.manual_seed(seed)
     s_list = [0. for _ in range(x.shape[1])]
@@ -98,33 +369,127 @@ def train_and_return(x: torch.Tensor, y: torch.Tensor, feature_num: int, initial
     else:
         sensitives = torch.tensor(s_list, requires_grad=True)
         params_max = torch.randn(x.shape[1], requires_grad=True)
+    if init_params is not None:
+        params_max = torch.tensor(init_params, dtype=params_max.dtype, device=params_max.device, requires_grad=True)
 
-    optim = Adam(params=[params_max], lr=0.05)
+    if optimizer == 'lbfgs':
+        # max_eval bounds the line search too, its default of max_iter * 5/4 would leave no trial steps
+        optim = LBFGS(params=[params_max], lr=1, max_iter=1, max_eval=26, history_size=10,
+                      line_search_fn='strong_wolfe')
+    else:
+        # the fused Adam kernel updates all parameters in one op, same update as the default implementation
+        optim = Adam(params=[params_max], lr=0.05, fused=fused_loss is not None)
     iters = 0
     curr_error = 10000
     s_record = []
     p_record = []
-    loss_max = loss_fn_generator(x, y, initial_val, feature_num, sensitives, alpha)
-    while iters < niters:
+    results = {}
+    evaluations = 0
+    converged = False
+    loss_max = loss_fn_generator(x, y, initial_val, feature_num, sensitives, alpha, lam, compressed, sketch,
+                                 smoothing)
+
+    def closure():
+        nonlocal evaluations
+        evaluations += 1
         optim.zero_grad()
-        loss_res = loss_max(params_max)
-        loss_res.backward()
-        optim.step()
+        loss = loss_max(params_max)
+        loss.backward()
+        return loss
+
+    def subgroup_weights(params):
+        if compressed is None:
+            return sigmoid(x @ params).cpu().detach().numpy()
+        patterns, groups = compressed[0], compressed[-1]
+        weights = sigmoid(matvec(patterns, params)).cpu().detach().numpy()
+        return weights if groups is None else groups.expand(weights)
+
+    def project_params():
+        params_temp = (sensitives * params_max).detach()
+        if compressed is not None:
+            scores, weights = matvec(compressed[0], params_temp), compressed[3]
+        elif sketch is not None:
+            scores, weights = sketch[0] @ params_temp, sketch[2]
+        else:
+            scores, weights = x @ params_temp, None
+        with torch.no_grad():
+            params_max[-1] += band_shift(scores, weights, x.shape[0], alpha)
+    if project:
+        project_params()
+    while iters < max(checkpoints):
+        with tracer.span('solver_step') as span:
+            start = evaluations
+            if optimizer == 'lbfgs':
+                # like Adam's, the loss recorded is the one at the start of the step
+                loss_res = optim.step(closure)
+            else:
+                loss_res = closure()
+                optim.step()
+                if project:
+                    project_params()
+            span.add('evaluations', evaluations - start)
+        converged = optimizer == 'lbfgs' and abs(curr_error - loss_res.item()) <= tol * max(1., abs(curr_error))
         curr_error = loss_res.item()
 
         params_temp = sensitives * params_max
-        size = np.sum((sigmoid(x @ params_temp)).cpu().detach().numpy())/x.shape[0]
+        if compressed is not None:
+            size = (sigmoid(matvec(compressed[0], params_temp)) @ compressed[3]).item()/x.shape[0]
+        elif sketch is not None:
+            size = (sigmoid(sketch[0] @ params_temp) @ sketch[2]).item()/x.shape[0]
+        else:
+            size = np.sum((sigmoid(x @ params_temp)).cpu().detach().numpy())/x.shape[0]
         s_record.append(size)
-        size_penalty = lam * (max(alpha[0] - size, 0) + max(size - alpha[1], 0))
-        p_record.append(loss_res.item()-size_penalty)
+        p_record.append(loss_res.item()-float(size_penalty(size, alpha, lam, smoothing)))
         iters += 1
-    params_max = sensitives * params_max
-    max_error = curr_error * -1
-    assigns = (sigmoid(x @ params_max)).cpu().detach().numpy()
-    print('final train size: ',torch.sum(sigmoid(x @ params_max))/x.shape[0])
+        if iters in checkpoints or converged:
+            params_final = (sensitives * params_max).detach()
+            max_error = curr_error * -1
+            assigns = subgroup_weights(params_final)
+            print('final train size: ', np.sum(assigns)/x.shape[0])
+            result = (max_error, assigns, params_final.cpu().numpy(), list(s_record), list(p_record), evaluations)
+            for checkpoint in checkpoints:
+                if checkpoint == iters or (converged and checkpoint > iters):
+                    results[checkpoint] = result
+        if converged:
+            print('converged after', iters, 'iterations,', evaluations, 'loss evaluations')
+            break
     #print(max_error, initial_val, assigns[assigns >= 0.02])
-    return max_error, assigns, params_max.cpu().detach().numpy(), s_record, p_record
+    return results
+
+
+def nearest_point(point: tuple, done: dict, scales: tuple):
+    """
+    Completed sweep point closest to point, to warm-start from.
+    :param point: (alpha band, lam)
+    :param done: dict from completed (alpha band, lam) to its trained parameters
+    :param scales: spread of alpha band midpoints and of log(1 + lam) across the sweep, used to put them on one
+                   scale. log1p keeps lam = 0, e.g. under --project, finite.
+    :return: parameters of the nearest completed point, None if there are none
+    """
+    if not done:
+        return None
+
+    def distance(other):
+        d_alpha = abs(sum(point[0]) - sum(other[0])) / 2 / scales[0]
+        d_lam = abs(np.log1p(point[1]) - np.log1p(other[1])) / scales[1]
+        return d_alpha ** 2 + d_lam ** 2
+    return done[min(done, key=distance)]
+
 
+def baseline_values(x: torch.Tensor, y: torch.Tensor) -> np.ndarray:
+    """
+    initial_value for every feature at once, from a single inverse of the Gram matrix.
+    :param x: the data tensor
+    :param y: the target tensor
+    :return: array with the expressivity over the dataset of each feature
+    """
+    x_t = torch.t(x)
+    if useCUDA:
+        flat = torch.tensor([0.00001 for _ in range(x.shape[1])]).cuda()
+        denom = torch.inverse((x_t @ x) + torch.diag(flat))
+    else:
+        denom = torch.inverse((x_t @ x))
+    return (denom @ (x_t @ y)).cpu().detach().numpy()
 
 def initial_value(x: torch.Tensor, y: torch.Tensor, feature_num: int) -> float:
     """
@@ -151,13 +516,15 @@ def initial_value(x: torch.Tensor, y: torch.Tensor, feature_num: int) -> float:
         denom = torch.inverse((x_t @ x))
     return (basis @ (denom @ (x_t @ y))).item()
 
-def final_value(x_0: torch.Tensor, y: torch.Tensor, params: torch.Tensor, feature_num: int):
+def final_value(x_0: torch.Tensor, y: torch.Tensor, params: torch.Tensor, feature_num: int,
+                row_weights: torch.Tensor = None):
     """
     Given a defined subgroup function, returns the expressivity over the test data set
     :param x_0: the test data tensor
     :param y: the test target tensor
     :param params: tensor with coefficients defining the subgroup
     :param feature_num: the feature to test
+    :param row_weights: importance weights of sketched rows, multiplied into the returned assignments
     :return: the float value of expressivity over the dataset and subgroup assignments
     """
     x = remove_intercept_column(x_0)
@@ -176,67 +543,184 @@ def final_value(x_0: torch.Tensor, y: torch.Tensor, params: torch.Tensor, featur
         x_t = torch.t(x)
 
     one_d = sigmoid(x_0 @ params)
-    diag = torch.diag(one_d)
-    denom = torch.inverse((x_t @ diag @ x) + torch.diag(flat))
-    return (basis @ (denom @ (x_t @ diag @ y))).cpu().detach().numpy()[0], one_d.cpu().detach().numpy()
-
-def find_extreme_subgroups(dataset: pd.DataFrame, alpha: list, target_column: str, f_sensitive: list, t_split: float):
+    if row_weights is not None:
+        one_d = one_d * row_weights
+    # x^T diag(one_d) without the n x n diagonal, same values
+    x_tw = (x_t * one_d).contiguous()
+    denom = torch.inverse((x_tw @ x) + torch.diag(flat))
+    return (basis @ (denom @ (x_tw @ y))).cpu().detach().numpy()[0], one_d.cpu().detach().numpy()
+
+def find_extreme_subgroups(dataset: pd.DataFrame, alphas: list, target_column: str, f_sensitive: list, t_split: float,
+                           lams: list = None, niters_list: list = None):
     """
-    Given a dataset, finds the differential expressivity and maximal subset over all features.
-    Saves that subset to a file.
+    Given a dataset, finds the differential expressivity and maximal subset over all features, for every
+    combination of alpha band, lam and niters. The split, tensors and baseline expressivities are computed once.
+    Each (alpha, lam) point trains once up to the largest niters, recording every niters value on the way, and
+    warm-starts from the nearest point already done for that feature.
     :param dataset: the pandas dataframe to use
-    :param alpha: desired subgroup size
+    :param alphas: desired subgroup size bands
     :param target_column:  Which column in that dataframe is the target.
     :param f_sensitive: Which features are sensitive characteristics
-    :return:  N/A.  Logs results.
+    :param lams: size penalty weights, defaults to lam
+    :param niters_list: iteration counts, defaults to niters
+    :return:  dataframe with one row per feature and sweep point.
     """
+    lams = lams or [lam]
+    niters_list = sorted(niters_list or [niters])
     out_df = pd.DataFrame()
 
-    train_df, test_df = train_test_split(dataset, test_size=t_split, random_state=seed)
-
-    if useCUDA:
-        y_train = torch.tensor(train_df[target_column].values).float().cuda()
-        x_train = torch.tensor(train_df.drop(target_column, axis=1).values.astype('float16')).float().cuda()
-        y_test = torch.tensor(test_df[target_column].values).float().cuda()
-        x_test = torch.tensor(test_df.drop(target_column, axis=1).values.astype('float16')).float().cuda()
-    else:
-        y_train = torch.tensor(train_df[target_column].values).float()
-        x_train = torch.tensor(train_df.drop(target_column, axis=1).values.astype('float16')).float()
-        y_test = torch.tensor(test_df[target_column].values).float()
-        x_test = torch.tensor(test_df.drop(target_column, axis=1).values.astype('float16')).float()
+    with tracer.span('data_split') as span:
+        span.add('rows', len(dataset))
+        train_df, test_df = split_dataset(dataset, t_split, seed)
+
+        # under --sparse the train rows are only kept in CSR, see sparse_build below
+        x_train = None
+        if useCUDA:
+            y_train = torch.tensor(train_df[target_column].values).float().cuda()
+            if not args.sparse:
+                x_train = torch.tensor(train_df.drop(target_column, axis=1).values.astype('float16')).float().cuda()
+            y_test = torch.tensor(test_df[target_column].values).float().cuda()
+            x_test = torch.tensor(test_df.drop(target_column, axis=1).values.astype('float16')).float().cuda()
+        else:
+            y_train = torch.tensor(train_df[target_column].values).float()
+            if not args.sparse:
+                x_train = torch.tensor(train_df.drop(target_column, axis=1).values.astype('float16')).float()
+            y_test = torch.tensor(test_df[target_column].values).float()
+            x_test = torch.tensor(test_df.drop(target_column, axis=1).values.astype('float16')).float()
+        x_test_ni = remove_intercept_column(x_test)
+        if x_train is not None:
+            total_exps_train = baseline_values(remove_intercept_column(x_train), y_train)
+        total_exps_test = baseline_values(x_test_ni, y_test)
+        sensitives = torch.zeros(x_test.shape[1], device=x_test.device)
+        sensitives[f_sensitive] = 1.
+    compressed = None
+    if args.compress:
+        with tracer.span('compress') as span:
+            span.add('rows', x_train.shape[0])
+            compressed = compressed_stats(x_train, y_train, f_sensitive)
+            span.add('patterns', compressed[-1].k)
+        print("Compressed", x_train.shape[0], "rows to", compressed[-1].k, "sensitive patterns")
+    if args.sparse:
+        with tracer.span('sparse_build') as span:
+            span.add('rows', len(train_df))
+            x_train_csr = to_csr(train_df.drop(target_column, axis=1))
+            # same rounding as the dense tensors
+            x_train_csr.data = x_train_csr.data.astype('float16').astype('float32')
+            compressed = sparse_stats(x_train_csr, y_train, y_train.device)
+            # the CSR rows stand in for x_train, which the optimizer only reads the shape of
+            x_train = compressed[0]
+            total_exps_train = stats_coefficients(compressed, compressed[3], 0.00001 if useCUDA else 0.)
+            total_exps_train = total_exps_train.cpu().detach().numpy()
+            span.add('nnz', x_train_csr.nnz)
+        print("Sparse train data:", x_train_csr.nnz, "of", np.prod(x_train_csr.shape), "entries")
+    sketch = None
+    if args.sketch:
+        with tracer.span('sketch') as span:
+            span.add('rows', x_train.shape[0])
+            sketch = sketch_rows(x_train, y_train, args.sketch, seed)
+            span.add('sampled', sketch[0].shape[0])
+        print("Sketched", x_train.shape[0], "train rows to", sketch[0].shape[0])
+
+    points = sorted((tuple(a), l) for a in alphas for l in lams)
+    midpoints = [sum(a) / 2 for a, _ in points]
+    log_lams = [np.log1p(l) for _, l in points]
+    scales = (max(midpoints) - min(midpoints) or 1., max(log_lams) - min(log_lams) or 1.)
     errors_and_weights = []
+    # the shuffled reoptimization batches dense rows, so --sparse densifies the train split for it alone
+    x_train_reopt = x_train
+    if args.sparse and args.reopt_permutations:
+        x_train_reopt = torch.tensor(x_train_csr.toarray(), device=y_train.device)
     for feature_num in range(x_train.shape[1]-1):
         print("Feature", feature_num, "of", x_train.shape[1]-1)
-        x_train_ni = remove_intercept_column(x_train)
-        total_exp_train = initial_value(x_train_ni, y_train, feature_num)
-        try:
-            _, assigns_train, params, s_record, p_record = train_and_return(x_train, y_train, feature_num, total_exp_train, f_sensitive, alpha)
-            furthest_exp_train, _ = final_value(x_train, y_train, params, feature_num)
-            subgroup_size_train = sum(assigns_train)/len(assigns_train)
-            if not (np.isnan(furthest_exp_train)):
-                x_test_ni = remove_intercept_column(x_test)
-                total_exp = initial_value(x_test_ni, y_test, feature_num)
-                furthest_exp, assigns = final_value(x_test, y_test, params, feature_num)
-                subgroup_size = sum(assigns)/len(assigns)
-                errors_and_weights.append((furthest_exp, feature_num))
-                print(furthest_exp, feature_num)
-                params_with_labels = {dataset.columns[i]: float(param) for (i, param) in enumerate(params)}
-                out_df = pd.concat([out_df, pd.DataFrame.from_records([{'Feature': dataset.columns[feature_num],
-                                                                        'Alpha': alpha,
-                                                                        'F(D)': total_exp,
-                                                                        'max(F(S))': furthest_exp,
-                                                                        'Difference': abs(furthest_exp - total_exp),
-                                                                        'Subgroup Coefficients': params_with_labels,
-                                                                        'Subgroup Size': subgroup_size,
-                                                                        'F(D)_train': total_exp_train,
-                                                                        'max(F(S))_train': furthest_exp_train,
-                                                                        'Difference_train': abs(furthest_exp_train - total_exp_train),
-                                                                        'Subgroup Size_train': subgroup_size_train,
-                                                                        'Size record': s_record,
-                                                                        'WLS Penalties': p_record}])])
-        except RuntimeError as e:
-            print(e)
-            continue
+        total_exp_train = float(total_exps_train[feature_num])
+        total_exp = float(total_exps_test[feature_num])
+        done = {}
+        for alpha, point_lam in points:
+            alpha = list(alpha)
+            try:
+                with tracer.span('feature_opt', feature=dataset.columns[feature_num], alpha=alpha, lam=point_lam) as span:
+                    results = train_checkpoints(x_train, y_train, feature_num, total_exp_train, f_sensitive, alpha,
+                                                point_lam, niters_list,
+                                                init_params=nearest_point((alpha, point_lam), done, scales),
+                                                compressed=compressed, sketch=sketch, optimizer=args.optimizer,
+                                                smoothing=smoothing, project=args.project)
+                    span.add('iterations', len(results[niters_list[-1]][3]))
+                    span.add('evaluations', results[niters_list[-1]][5])
+                done[(tuple(alpha), point_lam)] = results[niters_list[-1]][2]
+                if args.reopt_permutations:
+                    with tracer.span('permutation_test', feature=dataset.columns[feature_num], reopt=True) as span:
+                        span.add('permutations', args.reopt_permutations)
+                        span.add('iterations', niters_list[-1])
+                        reopt_nulls = reoptimize_null(
+                            x_train_reopt, y_train, sensitives, feature_num,
+                            lambda coefs, sizes, baselines: size_penalty(sizes, alpha, point_lam, smoothing)
+                                                            - .1*torch.abs(coefs - baselines),
+                            args.reopt_permutations, niters_list, 0.00001, 0., seed,
+                            band=alpha if args.project else None, optimizer=args.optimizer,
+                            sample=(sketch[3], sketch[2]) if sketch is not None else None)
+                for point_niters in niters_list:
+                    _, assigns_train, params, s_record, p_record, evaluations = results[point_niters]
+                    if args.sparse:
+                        furthest_exp_train, _ = stats_final_value(compressed, params, feature_num)
+                    else:
+                        furthest_exp_train, _ = final_value(x_train, y_train, params, feature_num)
+                    subgroup_size_train = sum(assigns_train)/len(assigns_train)
+                    if sketch is not None:
+                        # the sketch's own estimates, their gap to the exact train values is the sketch error
+                        sketch_exp_train, sketch_weights = final_value(sketch[0], sketch[1], params, feature_num,
+                                                                       sketch[2])
+                        sketch_size_train = float(np.sum(sketch_weights))/x_train.shape[0]
+                    if np.isnan(furthest_exp_train):
+                        continue
+                    with tracer.span('test_eval', feature=dataset.columns[feature_num]) as span:
+                        span.add('rows', x_test.shape[0])
+                        furthest_exp, assigns = final_value(x_test, y_test, params, feature_num)
+                    subgroup_size = sum(assigns)/len(assigns)
+                    errors_and_weights.append((furthest_exp, feature_num))
+                    print(furthest_exp, feature_num)
+                    params_with_labels = {dataset.columns[i]: float(param) for (i, param) in enumerate(params)}
+                    record = {'Feature': dataset.columns[feature_num],
+                              'Alpha': alpha,
+                              'lam': point_lam,
+                              'niters': point_niters,
+                              'F(D)': total_exp,
+                              'max(F(S))': furthest_exp,
+                              'Difference': abs(furthest_exp - total_exp),
+                              'Subgroup Coefficients': params_with_labels,
+                              'Subgroup Size': subgroup_size,
+                              'F(D)_train': total_exp_train,
+                              'max(F(S))_train': furthest_exp_train,
+                              'Difference_train': abs(furthest_exp_train - total_exp_train),
+                              'Subgroup Size_train': subgroup_size_train,
+                              'Size record': s_record,
+                              'WLS Penalties': p_record,
+                              'Membership': 'sigmoid',
+                              'Loss Evaluations': evaluations}
+                    if sketch is not None:
+                        record['max(F(S))_train_sketch'] = sketch_exp_train
+                        record['Subgroup Size_train_sketch'] = sketch_size_train
+                    if args.permutations:
+                        with tracer.span('permutation_test', feature=dataset.columns[feature_num]) as span:
+                            span.add('permutations', args.permutations)
+                            observed, null = permutation_null(x_test_ni, assigns, y_test, feature_num,
+                                                              args.permutations, 0.00001, 0., seed)
+                        record['p_value'] = p_value(observed, null)
+                    if args.reopt_permutations:
+                        record['p_value_reopt'] = p_value(abs(furthest_exp_train - total_exp_train),
+                                                          reopt_nulls[point_niters][0])
+                    if args.bootstrap:
+                        with tracer.span('bootstrap', feature=dataset.columns[feature_num]) as span:
+                            span.add('resamples', args.bootstrap)
+                            # the intervals are extra columns, a failure there keeps the point estimates
+                            try:
+                                record.update(bootstrap_ci(x_test_ni, assigns, y_test, feature_num, args.bootstrap,
+                                                           0.00001, 0., args.ci_level, seed))
+                            except RuntimeError as e:
+                                print("Bootstrap failed:", e)
+                    out_df = pd.concat([out_df, pd.DataFrame.from_records([record])])
+            except RuntimeError as e:
+                print(e)
+                continue
     errors_sorted = sorted(errors_and_weights, key=lambda elem: abs(elem[0]), reverse=True)
     print(errors_sorted[0])
     #i_value = initial_value(x, y, errors_sorted[0][1])
@@ -275,57 +759,29 @@ def run_system(df, target, sensitive_features, df_name, dummy=False, t_split=.5)
     f_sensitive.append(df.shape[1]-2)
 
     print(df.shape[1])
-    final_df = pd.DataFrame()
 
     start = time.time()
     #alphas = [[.01,.05],[.05,.1],[.1,.15],[.15,.2]]
     alphas = [[.1,.15]]
-    for a in alphas:
-        print("Running", df_name, ", Alpha =", a)
-        out = find_extreme_subgroups(df, alpha=a, target_column=target, f_sensitive=f_sensitive, t_split=t_split)
-        final_df = pd.concat([final_df, out])
+    if args.alpha:
+        alphas = [args.alpha]
+    if args.alphas:
+        alphas = [args.alphas[i:i + 2] for i in range(0, len(args.alphas), 2)]
+    lams = args.lams or [lam]
+    print("Running", df_name, ", Alphas =", alphas, ", lams =", lams)
+    final_df = find_extreme_subgroups(df, alphas=alphas, target_column=target, f_sensitive=f_sensitive, t_split=t_split,
+                                      lams=lams, niters_list=args.niters_grid)
 
     date = datetime.today().strftime('%m_%d')
-    fname = f'output/nonsep/{df_name}_output_{date}_lam{int(lam)}.csv'
+    fname = args.out or f'output/nonsep/{df_name}_output_{date}_lam{"-".join(str(int(l)) for l in lams)}.csv'
     final_df.to_csv(fname)
     print("Runtime:", '%.2f'%((time.time()-start)/3600), "Hours")
     return 1
 
-seed = 0
-
-df = pd.read_csv('data/student/student_cleaned.csv')
-target = 'G3'
-t_split = .5
-sensitive_features = ['sex_M', 'Pstatus_T', 'address_U', 'Dalc', 'Walc', 'health']
-df_name = 'student'
-run_system(df, target, sensitive_features, df_name, dummy, t_split)
-
-# df = pd.read_csv('data/compas/compas_recid.csv')
-# target = 'two_year_recid'
-# t_split = .5
-# sensitive_features = ['age','sex_Male','race_African-American','race_Asian','race_Caucasian','race_Hispanic','race_Native American','race_Other']
-# df_name = 'compas_recid'
-# run_system(df, target, sensitive_features, df_name, dummy, t_split)
-
-# df = pd.read_csv('data/compas/compas_decile.csv')
-# target = 'decile_score'
-# t_split = .5
-# sensitive_features = ['age','sex_Male','race_African-American','race_Asian','race_Caucasian','race_Hispanic','race_Native American','race_Other']
-# df_name = 'compas_decile'
-# run_system(df, target, sensitive_features, df_name, dummy, t_split)
-
-# df = BankDataset().convert_to_dataframe()[0]
-# target = 'y'
-# t_split = .2
-# sensitive_features = ['age', 'marital=married', 'marital=single', 'marital=divorced']
-# df_name = 'bank'
-# run_system(df, target, sensitive_features, df_name, dummy, t_split)
-
-# df = pd.read_csv('data/folktables/ACSIncome_MI_2018_new.csv')
-# target = 'PINCP'
-# t_split = .2
-# sensitive_features = ['AGEP', 'SEX', 'MAR_1.0', 'MAR_2.0', 'MAR_3.0', 'MAR_4.0', 'MAR_5.0', 'RAC1P_1.0', 'RAC1P_2.0',
-#                       'RAC1P_3.0', 'RAC1P_4.0', 'RAC1P_5.0', 'RAC1P_6.0', 'RAC1P_7.0', 'RAC1P_8.0', 'RAC1P_9.0']
-# df_name = 'folktables'
-# run_system(df, target, sensitive_features, df_name, dummy, t_split)
+with tracer.span('data_load', dataset=args.dataset):
+    df, target, sensitive_features, t_split = load_dataset(args.dataset)
+if args.t_split is not None:
+    t_split = args.t_split
+run_system(df, target, sensitive_features, args.dataset, dummy, t_split)
 
+tracer.close()
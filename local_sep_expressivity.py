@@ -1,54 +1,46 @@
 from reg_oracle import ZeroPredictor, ExpPredictor, RegOracle
-from lime.lime_tabular import LimeTabularExplainer
+from lime_exp_func import LimeExpFunc, write_sample_stats
+from tree_exp_func import TreeShapExpFunc
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.linear_model import LogisticRegression
-from sklearn.model_selection import train_test_split
 from typing import Union, Callable, NewType
+from functools import partial
 import pandas as pd
 import numpy as np
-from aif360.datasets import CompasDataset, BankDataset
-import re
+import os
 import time
 from datetime import datetime
 import argparse
+from tracing import tracer
+from pipeline import ExpPipeline, ExpMatrix
+from datasets import load_dataset, split_dataset
 
 parser = argparse.ArgumentParser(description='Locally separable run')
 parser.add_argument('--dummy', action='store_true')
+parser.add_argument('--dataset', type=str, default='student', help='dataset name from datasets.DATASETS')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--out', type=str, default=None, help='output csv path, defaults to a dated file under output/sep/')
+parser.add_argument('--exp-backend', choices=['lime', 'treeshap'], default='lime',
+                    help='expressivities from LIME or from exact tree attributions')
+parser.add_argument('--adaptive-lime', action='store_true',
+                    help='draw LIME samples in rounds until the top coefficients are stable, see LimeExpFunc')
+parser.add_argument('--lime-tol', type=float, default=.02, help='standard error target for --adaptive-lime')
+parser.add_argument('--pipeline', action='store_true',
+                    help='explain train and test in background processes, optimizing as soon as train is done')
+parser.add_argument('--pipeline-chunk', type=int, default=64, help='rows per chunk streamed from --pipeline workers')
+parser.add_argument('--trace', type=str, default=None, help='append JSON phase timings to this file')
+parser.add_argument('--trace-memory', action='store_true', help='sample peak memory at the end of every span')
 args = parser.parse_args()
 dummy = args.dummy
+if args.trace:
+    tracer.enable(args.trace, memory=args.trace_memory)
 
+EXP_BACKENDS = {'lime': partial(LimeExpFunc, adaptive=args.adaptive_lime, tol=args.lime_tol),
+                'treeshap': TreeShapExpFunc}
 
-class LimeExpFunc:
-    def __init__(self, classifier, dataset, seed):
-        self.classifier = classifier
-        self.dataset = dataset
-        self.exps = []
-        self.lime_exp = LimeTabularExplainer(self.dataset, random_state=seed)
-
-    # Populate exps with expressivity dictionaries
-    # exps[n][i] returns expressivity of feature i in datapoint n
-    def populate_exps(self):
-        i = 0
-        for row in self.dataset:
-            #print('Computing ', i)
-            exp_i = self.lime_exp.explain_instance(row, self.classifier.predict_proba, num_features=row.shape[0]).as_list()
-            exp_dict = {}
-            # Clean up LIME output and return dict with key=feature, value=expressivity
-            for e in exp_i:
-                parts = re.split(r"[\<=\<\>=\>]", e[0].replace(" ", ""))
-                for p in parts:
-                    if '.' not in p and len(p)>0:
-                        feature = int(p)
-                exp_dict[feature] = e[1]
-            self.exps.append(exp_dict)
-            i += 1
-
-    # Given feature and row, return the computed expressivities
-    def get_exp(self, row, feature):
-        if len(self.exps) == 0:
-            print("Populating feature expressivities")
-            self.populate_exps()
-        return self.exps[row][feature]
+
+# per-row sample counts of adaptive LIME, totalled in the trace and written next to the output
+record_samples = args.adaptive_lime and args.exp_backend == 'lime'
 
 
 ExpFuncGenType = NewType("ExpFuncGenType", Callable[[np.ndarray, int], Callable[[np.ndarray], float]])
@@ -70,6 +62,22 @@ def fit_exps_dataset(dataset: np.ndarray, feature_num: int, exp_func: ExpFuncGen
     predictions, exp = predictor.predict(dataset)
     return predictions, exp
 
+def fit_exps_all(dataset: np.ndarray, exp_matrix: np.ndarray):
+    """
+    Fits the expressivity regression for every feature at once, as one multi-output least squares problem
+    against the n x d expressivity matrix, and reads off both directions from the fitted values.
+    Column i of each output matches fit_exps_dataset(dataset, i, ...) with minimize False/True.
+    :param dataset: n x p data the regressions are fit on
+    :param exp_matrix: n x d expressivity matrix
+    :return: max assignments (n x d), max expressivity per feature, min assignments (n x d), min expressivity per feature
+    """
+    predictor = ExpPredictor()
+    predictor.fit(dataset, exp_matrix)
+    predicted = predictor.predict(dataset)
+    max_assigns = (predicted >= 0).astype(int)
+    min_assigns = (predicted < 0).astype(int)
+    return max_assigns, np.maximum(predicted, 0).sum(axis=0), min_assigns, np.minimum(predicted, 0).sum(axis=0)
+
 def full_dataset_expressivity(exp_func, feature_num):
     total = 0
     for row in exp_func.exps:
@@ -97,19 +105,42 @@ def split_out_dataset(dataset, target_column, f_sensitive):
 
 def extremize_exps_dataset(dataset: pd.DataFrame, exp_func_type: ExpFuncGenType, target_column: str, f_sensitive: list, seed: int):
     # train test split
-    train_df, test_df = train_test_split(df, test_size=0.2, random_state=seed)
-    train_x, train_y, sensitive_train = split_out_dataset(train_df, target, f_sensitive)
-    test_x, test_y, sensitive_test = split_out_dataset(test_df, target, f_sensitive)
-    classifier = RandomForestClassifier(random_state=seed)
-    classifier.fit(train_x, train_y)
-
-    exp_func = exp_func_type(classifier, train_x, seed)
-    print("Populating train expressivity values")
-    exp_func.populate_exps()
-
-    exp_func_test = exp_func_type(classifier, test_x, seed)
-    print("Populating test expressivity values")
-    exp_func_test.populate_exps()
+    with tracer.span('data_split') as span:
+        span.add('rows', len(dataset))
+        train_df, test_df = split_dataset(df, 0.2, seed)
+        train_x, train_y, sensitive_train = split_out_dataset(train_df, target, f_sensitive)
+        test_x, test_y, sensitive_test = split_out_dataset(test_df, target, f_sensitive)
+    with tracer.span('classifier_fit') as span:
+        span.add('rows', len(train_x))
+        classifier = RandomForestClassifier(random_state=seed)
+        classifier.fit(train_x, train_y)
+
+    if args.pipeline:
+        # train and test are explained side by side, and test keeps going through the optimization. The workers
+        # build their own explainers, the results are held as ExpMatrix.
+        train_pipe = ExpPipeline(exp_func_type, classifier, train_x, seed, args.pipeline_chunk, name='train').start()
+        test_pipe = ExpPipeline(exp_func_type, classifier, test_x, seed, args.pipeline_chunk, name='test').start()
+        with tracer.span('lime_populate', split='train', source='pipeline') as span:
+            span.add('rows', len(train_x))
+            exp_func = ExpMatrix(train_pipe.result(), train_pipe.num_samples, train_pipe.std_errs)
+            if record_samples:
+                span.add('samples', sum(exp_func.num_samples))
+    else:
+        exp_func = exp_func_type(classifier, train_x, seed)
+        exp_func_test = exp_func_type(classifier, test_x, seed)
+        print("Populating train expressivity values")
+        with tracer.span('lime_populate', split='train') as span:
+            span.add('rows', len(train_x))
+            exp_func.populate_exps()
+            if record_samples:
+                span.add('samples', sum(exp_func.num_samples))
+
+        print("Populating test expressivity values")
+        with tracer.span('lime_populate', split='test') as span:
+            span.add('rows', len(test_x))
+            exp_func_test.populate_exps()
+            if record_samples:
+                span.add('samples', sum(exp_func_test.num_samples))
 
     # numpy_ds is now train_x/test_x
     # sensitive_ds is now sensitive_train/sensitive_test
@@ -117,12 +148,26 @@ def extremize_exps_dataset(dataset: pd.DataFrame, exp_func_type: ExpFuncGenType,
     # sensitive_ds = dataset[f_sensitive].to_numpy()
 
     out_df = pd.DataFrame(columns=['Feature', 'F(D)', 'max(F(S))', 'Difference', 'Subgroup Size', 'Subgroup Coefficients',
-                                   'Direction', 'F(D)_train', 'max(F(S))_train', 'Difference_train', 'Subgroup Size_train'])
+                                   'Membership', 'Direction', 'F(D)_train', 'max(F(S))_train', 'Difference_train', 'Subgroup Size_train'])
+
+    # all features' subgroups come from one multi-output fit
+    with tracer.span('feature_opt', features=train_x.shape[1]) as span:
+        span.add('rows', len(train_x))
+        exp_matrix = exp_func.as_matrix()
+        totals_train = exp_matrix.sum(axis=0)
+        max_preds, max_exps, min_preds, min_exps = fit_exps_all(train_x, exp_matrix)
+
+    if args.pipeline:
+        with tracer.span('lime_populate', split='test', source='pipeline') as span:
+            span.add('rows', len(test_x))
+            exp_func_test = ExpMatrix(test_pipe.result(), test_pipe.num_samples, test_pipe.std_errs)
+            if record_samples:
+                span.add('samples', sum(exp_func_test.num_samples))
 
     for feature_num in range(len(train_x[0])):
-        total_train = full_dataset_expressivity(exp_func, feature_num)
-        max_pred, max_exp = fit_exps_dataset(train_x, feature_num, exp_func, minimize=False)
-        min_pred, min_exp = fit_exps_dataset(train_x, feature_num, exp_func, minimize=True)
+        total_train = totals_train[feature_num]
+        max_pred, max_exp = max_preds[:, feature_num], max_exps[feature_num]
+        min_pred, min_exp = min_preds[:, feature_num], min_exps[feature_num]
         if abs(max_exp-total_train) > abs(min_exp-total_train):
             furthest_exp_train = max_exp
             predictions_train = max_pred
@@ -131,11 +176,11 @@ def extremize_exps_dataset(dataset: pd.DataFrame, exp_func_type: ExpFuncGenType,
             furthest_exp_train = min_exp
             predictions_train = min_pred
             direction = 'minimize'
-        subgroup_size_train = predictions_train.count(1)/len(predictions_train)
+        subgroup_size_train = np.mean(predictions_train)
 
         # Train logistic regression model on the classification of the points
         if len(set(predictions_train)) == 1:
-            params_with_labels = {f: 0 for f in f_sensitive}
+            params_with_labels = {f: 0 for f in f_sensitive + ['Intercept']}
             print("zeros")
             subgroup_model = ZeroPredictor()
         else:
@@ -143,26 +188,31 @@ def extremize_exps_dataset(dataset: pd.DataFrame, exp_func_type: ExpFuncGenType,
             params = subgroup_model.coef_[0]
             print(params)
             params_with_labels = {dataset[f_sensitive].columns[i]: float(param) for (i, param) in enumerate(params)}
+            params_with_labels['Intercept'] = float(subgroup_model.intercept_[0])
 
-        total = full_dataset_expressivity(exp_func_test, feature_num)
+        with tracer.span('test_eval', feature=dataset.columns[feature_num]) as span:
+            span.add('rows', len(test_x))
+            total = full_dataset_expressivity(exp_func_test, feature_num)
 
-        predictions_test = subgroup_model.predict(sensitive_test)
-        subgroup_size = np.sum(predictions_test)/len(predictions_test)
+            predictions_test = subgroup_model.predict(sensitive_test)
+            subgroup_size = np.sum(predictions_test)/len(predictions_test)
 
-        furthest_exp = partial_dataset_expressivity(exp_func_test, feature_num, predictions_test)
+            furthest_exp = partial_dataset_expressivity(exp_func_test, feature_num, predictions_test)
 
         out_df = pd.concat([out_df, pd.DataFrame.from_records([{'Feature': dataset.columns[feature_num],
                                                                 'F(D)': total,
                                                                 'max(F(S))': furthest_exp,
                                                                 'Difference': abs(furthest_exp - total),
                                                                 'Subgroup Coefficients': params_with_labels,
+                                                                # rows are members where x @ coef + intercept > 0
+                                                                'Membership': 'logit>0',
                                                                 'Subgroup Size': subgroup_size,
                                                                 'Direction': direction,
                                                                 'F(D)_train': total_train,
                                                                 'max(F(S))_train': furthest_exp_train,
                                                                 'Difference_train': abs(furthest_exp_train - total_train),
                                                                 'Subgroup Size_train': subgroup_size_train}])])
-    return out_df
+    return out_df, {'train': exp_func, 'test': exp_func_test}
 
 
 def run_system(df, target, sensitive_features, df_name, dummy=False):
@@ -174,44 +224,28 @@ def run_system(df, target, sensitive_features, df_name, dummy=False):
     new_cols = [col for col in df.columns if col != target] + [target]
     df = df[new_cols]
 
-    seeds = [0]
+    seeds = [args.seed]
     for s in seeds:
         np.random.seed(s)
         print("Running", df_name, ", Seed =", s)
         start = time.time()
 
-        out = extremize_exps_dataset(dataset=df, exp_func_type=LimeExpFunc, target_column=target,
-                                     f_sensitive=sensitive_features, seed=s)
+        out, exp_funcs = extremize_exps_dataset(dataset=df, exp_func_type=EXP_BACKENDS[args.exp_backend],
+                                                target_column=target, f_sensitive=sensitive_features, seed=s)
         date = datetime.today().strftime('%m_%d')
-        out.to_csv(f'output/sep/{df_name}_LIME_output_seed{s}_{date}.csv')
+        path = args.out or f'output/sep/{df_name}_{args.exp_backend.upper()}_output_seed{s}_{date}.csv'
+        out.to_csv(path)
+        if record_samples:
+            # same layout as process_LIME_exps.py's _samples files
+            for split, exp_func in exp_funcs.items():
+                write_sample_stats(exp_func, f'{os.path.splitext(path)[0]}_{split}_samples')
         print("Runtime:", '%.2f'%((time.time()-start)/3600), "Hours")
     return 1
 
 
-df = pd.read_csv('data/student/student_cleaned.csv')
-target = 'G3'
-sensitive_features = ['sex_M', 'Pstatus_T', 'address_U', 'Dalc', 'Walc', 'health']
-df_name = 'student'
+with tracer.span('data_load', dataset=args.dataset):
+    df, target, sensitive_features, _ = load_dataset(args.dataset)
+df_name = args.dataset
 run_system(df, target, sensitive_features, df_name, dummy)
 
-# df = CompasDataset().convert_to_dataframe()[0]
-# target = 'two_year_recid'
-# sensitive_features = ['age','race','sex','age_cat=25 - 45','age_cat=Greater than 45','age_cat=Less than 25']
-# df_name = 'compas'
-# run_system(df, target, sensitive_features, df_name, dummy)
-
-# df = BankDataset().convert_to_dataframe()[0]
-# target = 'y'
-# sensitive_features = ['age', 'marital=married', 'marital=single', 'marital=divorced']
-# df_name = 'bank'
-# run_system(df, target, sensitive_features, df_name, dummy)
-#
-# df = pd.read_csv('data/folktables/ACSIncome_MI_2018_sampled.csv')
-# target = 'PINCP'
-# sensitive_features = ['AGEP', 'SEX', 'MAR_1.0', 'MAR_2.0', 'MAR_3.0', 'MAR_4.0', 'MAR_5.0', 'RAC1P_1.0', 'RAC1P_2.0',
-#                       'RAC1P_3.0', 'RAC1P_4.0', 'RAC1P_5.0', 'RAC1P_6.0', 'RAC1P_7.0', 'RAC1P_8.0', 'RAC1P_9.0']
-# df_name = 'folktables'
-# run_system(df, target, sensitive_features, df_name, dummy)
-
-
-
+tracer.close()
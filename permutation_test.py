@@ -0,0 +1,168 @@
+import numpy as np
+import torch
+from torch.special import expit as sigmoid
+from torch.optim import Adam, LBFGS
+from size_projection import band_shift
+
+
+def permuted_targets(y: torch.Tensor, n_perms: int, seed: int = 0) -> torch.Tensor:
+    """
+    :param y: the target tensor
+    :param n_perms: number of shuffles
+    :param seed: seed for the shuffles
+    :return: n x n_perms tensor whose columns are independent shuffles of y
+    """
+    gen = torch.Generator().manual_seed(seed)
+    order = torch.argsort(torch.rand(n_perms, y.shape[0], generator=gen), dim=1)
+    return y.cpu()[order].t().to(y.device)
+
+
+def wls_coefficients(x: torch.Tensor, weights: torch.Tensor, ys: torch.Tensor, feature_num: int,
+                     flatval: float) -> torch.Tensor:
+    """
+    Weighted least squares coefficient of one feature for many targets at once. Neither the Gram matrix nor the
+    weights depend on the target, so the Gram matrix is solved once and all targets go through one n x P product.
+    :param x: the data tensor without intercept column
+    :param weights: subgroup weight of each row
+    :param ys: n x P targets
+    :param feature_num: the feature to test
+    :param flatval: ridge term added to the Gram matrix
+    :return: P coefficients
+    """
+    x, weights, ys = x.double(), weights.double(), ys.double()
+    xw = x * weights[:, None]
+    gram = torch.t(xw) @ x + flatval * torch.eye(x.shape[1], dtype=x.dtype, device=x.device)
+    return torch.linalg.solve(gram, torch.t(xw) @ ys)[feature_num]
+
+
+def permutation_null(x: torch.Tensor, weights, y: torch.Tensor, feature_num: int, n_perms: int,
+                     flat_subgroup: float, flat_full: float, seed: int = 0, chunk: int = 256):
+    """
+    Null distribution of the difference |F(S) - F(D)| of a fixed subgroup under shuffled targets.
+    :param x: the data tensor without intercept column
+    :param weights: subgroup weight of each row
+    :param y: the target tensor
+    :param feature_num: the feature to test
+    :param n_perms: number of shuffles
+    :param flat_subgroup: ridge term for F(S)
+    :param flat_full: ridge term for F(D)
+    :param chunk: shuffles evaluated per product, bounds memory at n x chunk
+    :return: observed difference, array of n_perms shuffled differences
+    """
+    weights = torch.as_tensor(np.asarray(weights), device=x.device)
+    ones = torch.ones(x.shape[0], device=x.device)
+
+    def difference(ys):
+        return torch.abs(wls_coefficients(x, weights, ys, feature_num, flat_subgroup) -
+                         wls_coefficients(x, ones, ys, feature_num, flat_full)).cpu().numpy()
+
+    observed = difference(y[:, None])[0]
+    null = [difference(permuted_targets(y, min(chunk, n_perms - start), seed + start))
+            for start in range(0, n_perms, chunk)]
+    return observed, np.concatenate(null)
+
+
+def reoptimize_null(x_0: torch.Tensor, y: torch.Tensor, sensitives: torch.Tensor, feature_num: int, objective,
+                    n_perms: int, checkpoints: list, flat_subgroup: float, flat_full: float, seed: int = 0,
+                    band: list = None, optimizer: str = 'adam', tol: float = 1e-7, sample: tuple = None):
+    """
+    Relearns the subgroup under n_perms shuffled targets, all at once: the parameters of every shuffle are rows of
+    one tensor, and the weighted Gram matrices are built and solved as one batch. Adam updates each element on its
+    own, so this takes the same steps as n_perms separate runs. L-BFGS runs on the summed loss of all shuffles,
+    which is separable, so it reaches the same per-shuffle optima with shared line searches.
+    :param x_0: the data tensor with intercept column last
+    :param y: the target tensor
+    :param sensitives: mask of the features subgroups are defined on
+    :param feature_num: the feature to test
+    :param objective: function(coefficients, sizes, baselines) returning the loss of every subgroup, the
+                      driver's loss written for a batch
+    :param n_perms: number of shuffles
+    :param checkpoints: iteration counts to record results at
+    :param flat_subgroup: ridge term for F(S)
+    :param flat_full: ridge term for F(D)
+    :param band: alpha band to shift every shuffle's intercept onto before the first step and after every step, as
+                 the drivers' --project does, see band_shift. None leaves the size to objective.
+    :param optimizer: 'adam' or 'lbfgs', with the settings of linearexpressivity's train_checkpoints. L-BFGS stops
+                      once an iteration improves the summed loss by less than tol relative, and later checkpoints
+                      get the converged result.
+    :param sample: (row indices, importance weights) of a row sketch, e.g. from linearexpressivity.sketch_rows. The
+                   search then runs on the sketched rows and their shuffled targets with the weights in the Gram
+                   matrices and sizes, and the checkpoints are still evaluated on all rows, as the drivers do with
+                   --sketch.
+    :return: dict from checkpoint to (array of shuffled differences |F(S) - F(D)|, array of subgroup sizes)
+    """
+    x = x_0[:, :-1]
+    d = x.shape[1]
+    ys = permuted_targets(y, n_perms, seed)
+    baselines = wls_coefficients(x, torch.ones(x.shape[0], device=x.device), ys, feature_num, flat_full).float()
+    flat = flat_subgroup * torch.eye(d, device=x.device)
+
+    torch.manual_seed(seed)
+    params = torch.randn(n_perms, x_0.shape[1], requires_grad=True, device=x.device)
+    if optimizer == 'lbfgs':
+        optim = LBFGS(params=[params], lr=1, max_iter=1, max_eval=26, history_size=10, line_search_fn='strong_wolfe')
+    else:
+        optim = Adam(params=[params], lr=0.05)
+
+    # the rows the search runs on, all of them unless sketched
+    x_search, ys_search, importance = x_0, ys, None
+    if sample is not None:
+        rows, importance = sample
+        x_search, ys_search = x_0[rows], ys[rows]
+
+    def project_params():
+        # each shuffle gets its own shift, as its separate run would, all from one batched bisection
+        with torch.no_grad():
+            params[:, -1] += band_shift(x_search @ torch.t(sensitives * params), importance, x.shape[0],
+                                        band).float()
+    if band is not None:
+        project_params()
+    results = {}
+
+    def coefficients_and_sizes(rows_0, targets, row_weights=None):
+        # one batched solve of every shuffle's weighted Gram matrix
+        one_d = sigmoid(rows_0 @ torch.t(sensitives * params))
+        if row_weights is not None:
+            one_d = one_d * row_weights[:, None]
+        rows = rows_0[:, :-1]
+        grams = torch.einsum('ni,nk,nj->kij', rows, one_d, rows) + flat
+        rhs = torch.einsum('ni,nk->ki', rows, one_d * targets)
+        return torch.linalg.solve(grams, rhs)[:, feature_num], torch.sum(one_d, 0) / x.shape[0]
+
+    def closure():
+        optim.zero_grad()
+        coefs, sizes = coefficients_and_sizes(x_search, ys_search, importance)
+        loss = objective(coefs, sizes, baselines).sum()
+        loss.backward()
+        return loss
+
+    curr_error = 10000
+    for iters in range(1, max(checkpoints) + 1):
+        if optimizer == 'lbfgs':
+            # the loss at the start of the step, as for Adam
+            loss = optim.step(closure).item()
+        else:
+            loss = closure().item()
+            optim.step()
+            if band is not None:
+                project_params()
+        converged = optimizer == 'lbfgs' and abs(curr_error - loss) <= tol * max(1., abs(curr_error))
+        curr_error = loss
+        if iters in checkpoints or converged:
+            with torch.no_grad():
+                coefs, sizes = coefficients_and_sizes(x_0, ys)
+            result = (torch.abs(coefs - baselines).cpu().numpy(), sizes.cpu().numpy())
+            for checkpoint in checkpoints:
+                if checkpoint == iters or (converged and checkpoint > iters):
+                    results[checkpoint] = result
+        if converged:
+            break
+    return results
+
+
+def p_value(observed: float, null) -> float:
+    """
+    Permutation p-value, counting the observed statistic as one of the shuffles.
+    """
+    null = np.asarray(null)
+    return (1 + np.sum(null >= observed)) / (1 + len(null))
@@ -0,0 +1,109 @@
+import contextlib
+import multiprocessing as mp
+import os
+import queue
+import threading
+import numpy as np
+from exp_func import ExpFunc
+
+
+def produce(exp_func_type, classifier, x, seed, chunk, out, name, report_every):
+    """
+    Explains x in chunks of rows with one explainer, so the random draws are the same as populating x in one go,
+    and puts each chunk's expressivity matrix on out, with the explainer's per-row num_samples and std_errs if it
+    records them. populate_exps' own progress counts rows of the chunk, so it is
+    silenced and the producer reports rows of the split instead.
+    """
+    exp_func = exp_func_type(classifier, x, seed)
+    reported = 0
+    for start in range(0, len(x), chunk):
+        # populate_exps appends to every per-row list, which the chunk's matrix doesn't need
+        exp_func.exps, exp_func.matrix = [], None
+        for attr in ('num_samples', 'std_errs'):
+            if hasattr(exp_func, attr):
+                setattr(exp_func, attr, [])
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            exp_func.populate_exps(x[start:start + chunk])
+            matrix = exp_func.as_matrix()
+        stats = {attr: getattr(exp_func, attr) for attr in ('num_samples', 'std_errs') if hasattr(exp_func, attr)}
+        done = start + len(matrix)
+        if done - reported >= report_every or done == len(x):
+            print(name, done, '/', len(x), flush=True)
+            reported = done
+        # blocks while the queue is full, so the producer never runs more than max_pending chunks ahead
+        out.put((start, matrix, stats))
+    out.put(None)
+
+
+class ExpPipeline:
+    """
+    Populates expressivities of x in a background process while the caller does other work, e.g. explaining the
+    test split while subgroups are optimized on train. Chunks stream through a bounded queue into a preallocated
+    n x p store, so memory stays at the store plus max_pending chunks however far the producer gets ahead. The
+    explainer's per-row num_samples and std_errs are collected alongside, None for explainers that don't record them.
+    :param exp_func_type: LimeExpFunc, TreeShapExpFunc or a partial of one, called as exp_func_type(classifier, x, seed)
+    :param chunk: rows per chunk
+    :param max_pending: chunks that can wait in the queue before the producer blocks
+    :param name: label of the split in the producer's progress lines
+    :param report_every: rows between progress lines
+    """
+    def __init__(self, exp_func_type, classifier, x, seed, chunk=64, max_pending=4, name='rows', report_every=100):
+        # fork, so the explainer and classifier don't need to be pickled
+        ctx = mp.get_context('fork')
+        self.store = np.zeros(x.shape)
+        self.filled = 0
+        self.num_samples = [None] * len(x)
+        self.std_errs = [None] * len(x)
+        self.queue = ctx.Queue(maxsize=max_pending)
+        self.process = ctx.Process(target=produce, daemon=True,
+                                   args=(exp_func_type, classifier, x, seed, chunk, self.queue, name, report_every))
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+
+    def start(self):
+        self.process.start()
+        self.collector.start()
+        return self
+
+    def collect(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=1)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    return
+                continue
+            if item is None:
+                return
+            start, matrix, stats = item
+            self.store[start:start + len(matrix)] = matrix
+            for attr, values in stats.items():
+                getattr(self, attr)[start:start + len(matrix)] = values
+            self.filled += len(matrix)
+
+    def result(self):
+        """
+        Waits for every row to be explained.
+        :return: n x p expressivity matrix
+        """
+        self.collector.join()
+        self.process.join()
+        if self.process.exitcode != 0 or self.filled != len(self.store):
+            raise RuntimeError(f"Expressivity producer failed with exit code {self.process.exitcode} after "
+                               f"{self.filled} of {len(self.store)} rows")
+        return self.store
+
+
+class ExpMatrix(ExpFunc):
+    """
+    A pipeline's result with the exps, get_exp, as_matrix and get_total_exp of an explainer that populate_exps has
+    run on, so the caller doesn't build explainers of its own for the pipelined splits.
+    :param matrix: n x p expressivity matrix
+    :param num_samples: the pipeline's per-row sample counts, if its explainer records them
+    :param std_errs: the pipeline's per-row standard errors, if its explainer records them
+    """
+    def __init__(self, matrix, num_samples=None, std_errs=None):
+        self.matrix = matrix
+        self.exps = [dict(enumerate(row)) for row in matrix.tolist()]
+        self.n_features = matrix.shape[1]
+        self.num_samples = num_samples or []
+        self.std_errs = std_errs or []
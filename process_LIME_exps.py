@@ -1,8 +1,7 @@
 #from constrained_opt import split_out_dataset
-from lime_exp_func import LimeExpFunc
+from lime_exp_func import LimeExpFunc, write_sample_stats
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.model_selection import train_test_split
-from aif360.datasets import BankDataset
+from datasets import load_dataset, split_dataset
 import argparse
 import pandas as pd
 import json
@@ -14,49 +13,27 @@ def split_out_dataset(dataset, target_column):
     #sensitive_ds = dataset[f_sensitive].to_numpy()
     return x, y
 
-seed = 0
+parser = argparse.ArgumentParser(description='Precompute LIME expressivities for constrained_opt.py')
+parser.add_argument('--dataset', type=str, default='folktables', help='dataset name from datasets.DATASETS')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--t-split', type=float, default=None, help='test fraction, defaults to the dataset setting')
+parser.add_argument('--adaptive', action='store_true',
+                    help='draw LIME samples in rounds until the top coefficients are stable, see LimeExpFunc')
+parser.add_argument('--tol', type=float, default=.02, help='standard error target for --adaptive')
+parser.add_argument('--max-samples', type=int, default=5000, help='sample cap per row for --adaptive')
+args = parser.parse_args()
+seed = args.seed
+lime_args = {'adaptive': args.adaptive, 'tol': args.tol, 'max_samples': args.max_samples}
 
-# df = pd.read_csv('data/student/student_cleaned.csv')
-# target = 'G3'
-# t_split = .5
-# sensitive_features = ['sex_M', 'Pstatus_T', 'address_U', 'Dalc', 'Walc', 'health']
-# df_name = 'student'
-
-# df = pd.read_csv('data/compas/compas_cleaned.csv')
-# target = 'two_year_recid'
-# t_split = .5
-# sensitive_features = ['age','sex_Male','race_African-American','race_Asian','race_Caucasian','race_Hispanic','race_Native American','race_Other']
-# df_name = 'compas_recid'
-
-# df = pd.read_csv('data/compas/compas_cleaned_decile.csv')
-# target = 'decile_score'
-# t_split = .5
-# sensitive_features = ['age','sex_Male','race_African-American','race_Asian','race_Caucasian','race_Hispanic','race_Native American','race_Other']
-# df_name = 'compas_decile'
-
-# df = pd.read_csv('data/compas/compas_decile_stripped.csv')
-# target = 'decile_score'
-# t_split = .5
-# sensitive_features = ['age','sex_Male','race_African-American','race_Asian','race_Caucasian','race_Hispanic','race_Native American','race_Other']
-# df_name = 'compas_decile'
-
-# df = BankDataset().convert_to_dataframe()[0]
-# target = 'y'
-# t_split = .2
-# sensitive_features = ['age', 'marital=married', 'marital=single', 'marital=divorced']
-# df_name = 'bank'
-
-df = pd.read_csv('data/folktables/ACSIncome_MI_2018_new.csv')
-target = 'PINCP'
-t_split = .2
-sensitive_features = ['AGEP', 'SEX', 'MAR_1.0', 'MAR_2.0', 'MAR_3.0', 'MAR_4.0', 'MAR_5.0', 'RAC1P_1.0', 'RAC1P_2.0',
-                      'RAC1P_3.0', 'RAC1P_4.0', 'RAC1P_5.0', 'RAC1P_6.0', 'RAC1P_7.0', 'RAC1P_8.0', 'RAC1P_9.0']
-df_name = 'folktables'
+df, target, sensitive_features, t_split = load_dataset(args.dataset)
+if args.t_split is not None:
+    t_split = args.t_split
+df_name = args.dataset
 
 print('starting', df_name)
 new_cols = [col for col in df.columns if col != target] + [target]
 df = df[new_cols]
-train_df, test_df = train_test_split(df, test_size=t_split, random_state=seed)
+train_df, test_df = split_dataset(df, t_split, seed)
 x_train, y_train = split_out_dataset(train_df, target)
 x_test, y_test = split_out_dataset(test_df, target)
 print('training classifier')
@@ -64,20 +41,24 @@ classifier = RandomForestClassifier(random_state=seed)
 classifier.fit(x_train, y_train)
 
 start = time.time()
-exp_func_train = LimeExpFunc(classifier, x_train, seed)
+exp_func_train = LimeExpFunc(classifier, x_train, seed, **lime_args)
 print("Populating train expressivity values")
 exp_func_train.populate_exps()
 print("runtime train: ", time.time()-start)
 
 with open(f'data/exps/{df_name}_train_seed{seed}', 'w') as fout:
     json.dump(exp_func_train.exps, fout)
+if args.adaptive:
+    write_sample_stats(exp_func_train, f'data/exps/{df_name}_train_seed{seed}_samples')
 
 start = time.time()
-exp_func_test = LimeExpFunc(classifier, x_test, seed)
+exp_func_test = LimeExpFunc(classifier, x_test, seed, **lime_args)
 print("Populating test expressivity values")
 exp_func_test.populate_exps()
 print("runtime test: ", time.time()-start)
 
 with open(f'data/exps/{df_name}_test_seed{seed}', 'w') as fout:
     json.dump(exp_func_test.exps, fout)
+if args.adaptive:
+    write_sample_stats(exp_func_test, f'data/exps/{df_name}_test_seed{seed}_samples')
 
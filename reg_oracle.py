@@ -1,3 +1,5 @@
+import numpy as np
+from scipy import sparse
 from sklearn.linear_model import LinearRegression
 # This class sourced from the gerryfair repo
 class RegOracle:
@@ -15,23 +17,25 @@ class RegOracle:
         self.minimize = minimize
 
     def predict(self, x):
-        """Predict labels on data set x."""
-        reg0 = self.b0
-        reg1 = self.b1
-        n = x.shape[0]
-        y = []
-        total_cost = 0
-        for i in range(n):
-            c_0 = reg0.predict([x[i][:]])
-            c_1 = reg1.predict([x[i][:]])
-            y_i = int(c_1 < c_0)
-            cost = min(c_0, c_1)
-            if not self.minimize:
-                y_i = 1 - y_i
-                cost = max(c_0, c_1)
-            y.append(y_i)
-            total_cost += cost[0]
-        return y, total_cost
+        """Predict labels on data set x, dense or scipy sparse. Both oracles score all rows in one call."""
+        c_0 = np.asarray(self.b0.predict(x), dtype=float).ravel()
+        c_1 = np.asarray(self.b1.predict(x), dtype=float).ravel()
+        y = (c_1 < c_0).astype(int)
+        cost = np.minimum(c_0, c_1)
+        if not self.minimize:
+            y = 1 - y
+            cost = np.maximum(c_0, c_1)
+        return y.tolist(), cost.sum()
+
+    def linear_cost(self):
+        """
+        For linear cost oracles, the coefficients and intercept of one score that predict thresholds: a row is
+        assigned 1 when x @ coef + intercept < 0.
+        :return: coef, intercept
+        """
+        sign = 1. if self.minimize else -1.
+        coef = sign*(np.ravel(self.b1.coef_) - np.ravel(self.b0.coef_))
+        return coef, sign*(float(np.ravel(self.b1.intercept_)[0]) - float(np.ravel(self.b0.intercept_)[0]))
 
 
 class ZeroPredictor:
@@ -43,7 +47,7 @@ class ZeroPredictor:
         """
         returns a vector of all 0 predictions
         """
-        return [0 for _ in range(len(x))]
+        return [0 for _ in range(x.shape[0])]
 
     @staticmethod
     def fit(_, __):
@@ -56,4 +60,42 @@ class ZeroPredictor:
         return
 
 
+class LinearPredictor:
+    """
+    A fixed linear cost oracle, x @ coef_ + intercept_. Used for models whose coefficients were solved
+    for outside of sklearn, with the same predict and coef_ interface as LinearRegression.
+    """
+    def __init__(self, coef, intercept):
+        self.coef_ = coef
+        self.intercept_ = intercept
+
+    def predict(self, x):
+        return x @ self.coef_ + self.intercept_
+
+
+class GramLinearRegression:
+    """
+    Least squares with an intercept, solved through the normal equations so the fit only touches X^T X and X^T y.
+    For scipy sparse X (e.g. one-hot sensitive columns) those cost O(nnz) and X is never densified. Same fit,
+    predict, coef_ and intercept_ interface as LinearRegression, and the same minimum-norm solution when columns
+    are collinear.
+    """
+    def fit(self, x, y):
+        y = np.asarray(y, dtype=float)
+        n = x.shape[0]
+        mean = np.asarray(x.mean(axis=0)).ravel()
+        y_mean = y.mean(axis=0)
+        gram = x.T @ x
+        gram = (gram.toarray() if sparse.issparse(gram) else np.asarray(gram)) - n * np.outer(mean, mean)
+        moment = np.asarray(x.T @ y) - n * np.multiply.outer(mean, y_mean)
+        coef = np.linalg.lstsq(gram, moment, rcond=None)[0]
+        self.coef_ = coef.T
+        self.intercept_ = y_mean - mean @ coef
+        return self
+
+    def predict(self, x):
+        return x @ self.coef_.T + self.intercept_
+
+
 ExpPredictor = LinearRegression
+CostPredictor = LinearRegression
@@ -0,0 +1,133 @@
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from datasets import DATASETS, load_dataset
+
+# Driver script for each method and the sweep axes it takes. Axes a method doesn't take are dropped
+# from its jobs so they aren't run once per value.
+METHODS = {
+    'nonsep': {'script': 'linearexpressivity.py', 'axes': ['alpha', 'seed', 'lam', 'niters']},
+    'ext': {'script': 'ext_linearexpressivity.py', 'axes': ['alpha', 'seed', 'flatval']},
+    'constrained': {'script': 'constrained_opt.py', 'axes': ['alpha', 'seed']},
+    'sep': {'script': 'local_sep_expressivity.py', 'axes': ['seed']},
+}
+
+DEFAULTS = {
+    'alpha': [[.1, .15]],
+    'seed': [0],
+    'lam': [10.],
+    'niters': [1000],
+    'flatval': [.00001],
+}
+
+
+def expand_jobs(config):
+    """
+    Expands a run-matrix config into one job per (dataset, method, alpha, seed, lam/niters/flatval) combination
+    :param config: dict with 'datasets' and 'methods' lists, and optional lists for each axis in DEFAULTS
+    :return: list of job dicts, each with the command line to run and the csv it writes
+    """
+    out_dir = config.get('out_dir', 'output/matrix')
+    jobs = []
+    for dataset, method in itertools.product(config['datasets'], config['methods']):
+        if dataset not in DATASETS:
+            raise ValueError(f"Unknown dataset '{dataset}'. Choose from {sorted(DATASETS)}")
+        if method not in METHODS:
+            raise ValueError(f"Unknown method '{method}'. Choose from {sorted(METHODS)}")
+        axes = METHODS[method]['axes']
+        values = [config.get(axis, DEFAULTS[axis]) for axis in axes]
+        for combo in itertools.product(*values):
+            point = dict(zip(axes, combo))
+            name = '_'.join([dataset] + [f'{axis}{format_value(point[axis])}' for axis in axes])
+            if config.get('dummy', False):
+                name = 'dummy_' + name
+            out = os.path.join(out_dir, method, name + '.csv')
+            jobs.append({'name': f'{method}/{name}', 'out': out, 'cmd': build_command(method, dataset, point, out, config)})
+    return jobs
+
+
+def format_value(value):
+    if isinstance(value, (list, tuple)):
+        return '-'.join(str(v) for v in value)
+    return str(value)
+
+
+def build_command(method, dataset, point, out, config):
+    cmd = [sys.executable, METHODS[method]['script']]
+    # positional arguments first, in the order each driver declares them
+    if method == 'nonsep':
+        cmd += [str(point['lam']), str(point['niters'])]
+    elif method == 'ext':
+        # a list of flatvals is run as one ridge sweep
+        flat = point['flatval']
+        cmd += [str(v) for v in flat] if isinstance(flat, (list, tuple)) else [str(flat)]
+    cmd += ['--dataset', dataset, '--seed', str(point['seed']), '--out', out]
+    if 'alpha' in point:
+        cmd += ['--alpha'] + [str(a) for a in point['alpha']]
+    if config.get('dummy', False):
+        cmd.append('--dummy')
+    if config.get('trace', False):
+        cmd += ['--trace', out[:-len('.csv')] + '_trace.jsonl']
+    return cmd
+
+
+def run_job(job, threads, log_dir):
+    """
+    Runs one job as a separate process, with the math libraries limited to its share of the core budget.
+    """
+    env = dict(os.environ)
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        env[var] = str(threads)
+    os.makedirs(os.path.dirname(job['out']), exist_ok=True)
+    log_path = os.path.join(log_dir, job['name'].replace('/', '_') + '.log')
+    start = time.time()
+    with open(log_path, 'w') as log:
+        code = subprocess.call(job['cmd'], stdout=log, stderr=subprocess.STDOUT, env=env)
+    return code, time.time() - start, log_path
+
+
+def run_matrix(config, cores, threads_per_job=1, dry_run=False):
+    jobs = expand_jobs(config)
+    todo = [job for job in jobs if not os.path.exists(job['out'])]
+    print(len(jobs), "jobs,", len(jobs) - len(todo), "already have outputs")
+    if dry_run:
+        for job in todo:
+            print(' '.join(job['cmd']))
+        return 0
+
+    # build dataset caches once up front rather than in every job
+    for dataset in sorted(set(config['datasets'])):
+        load_dataset(dataset)
+
+    log_dir = os.path.join(config.get('out_dir', 'output/matrix'), 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    workers = max(1, cores // threads_per_job)
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_job, job, threads_per_job, log_dir): job for job in todo}
+        for future in as_completed(futures):
+            job = futures[future]
+            code, seconds, log_path = future.result()
+            status = 'done' if code == 0 else f'FAILED ({code}), see {log_path}'
+            failed += code != 0
+            print(job['name'], status, '%.2f' % (seconds / 3600), "Hours")
+    print(len(todo) - failed, "finished,", failed, "failed")
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a matrix of datasets x methods x parameters')
+    parser.add_argument('config', type=str, help='JSON run-matrix config, see README')
+    parser.add_argument('--cores', type=int, default=os.cpu_count(), help='total cores to use across jobs')
+    parser.add_argument('--threads-per-job', type=int, default=1)
+    parser.add_argument('--dry-run', action='store_true', help='list the jobs that would run and exit')
+    args = parser.parse_args()
+    with open(args.config) as f:
+        config = json.load(f)
+    sys.exit(1 if run_matrix(config, args.cores, args.threads_per_job, args.dry_run) else 0)
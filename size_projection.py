@@ -0,0 +1,59 @@
+import torch
+from torch.special import expit as sigmoid, logit
+
+
+def band_shift(scores: torch.Tensor, weights: torch.Tensor, n: int, alpha: list, points: int = 16, rounds: int = 8,
+               margin: float = 1e-3):
+    """
+    Intercept shift that moves a soft subgroup's size into the alpha band. The size sum_i w_i sigmoid(s_i + b) / n
+    increases with b, so the smallest move into the band lands on its nearer edge, and the shift is found by
+    bisection. Each round evaluates points shifts of every subgroup at once as one weighted sum over rows,
+    narrowing each bracket by a factor of points + 1.
+    :param scores: subgroup score of each row (or pattern), x @ params, or an n x P matrix with one column per
+                   subgroup, e.g. a batch of shuffles, all shifted together
+    :param weights: weight of each score, e.g. pattern counts or importance weights, None for ones
+    :param n: number of rows the size is a share of. The weights may sum to something else, e.g. a sketch's
+              importance weights, which the bracket allows for.
+    :param alpha: size band
+    :param margin: share of the band's width kept between the projected size and the band's edges, so the result
+                   also passes strict checks like is_valid
+    :return: the shift, 0. when the size is already in the band. A tensor of P shifts for an n x P scores matrix.
+    """
+    single = scores.dim() == 1
+    # float64 so the size at the bracket ends is resolved well below the margin
+    scores = scores.detach().double()
+    if single:
+        scores = scores[:, None]
+    weights = torch.ones_like(scores[:, 0]) if weights is None else weights.detach().double()
+
+    def sizes(scores, shifts):
+        # P x G sizes of P subgroups under G shifts each
+        return torch.einsum('n,npg->pg', weights, sigmoid(scores[:, :, None] + shifts[None, :, :])) / n
+
+    inset = margin * (alpha[1] - alpha[0])
+    low, high = alpha[0] + inset, alpha[1] - inset
+    size = sizes(scores, torch.zeros(scores.shape[1], 1, dtype=scores.dtype, device=scores.device))[:, 0]
+    shift = torch.zeros_like(size)
+    outside = (size < low) | (size > high)
+    if outside.any():
+        scores, size = scores[:, outside], size[outside]
+        target = torch.where(size < low, low, high)
+        # the size is at most total / n times the largest sigmoid and at least that times the smallest, so with
+        # every sigmoid at most target and target * n / total at the lower end, and at least both at the upper end,
+        # the size crosses target in between. Importance weights, e.g. a sketch's, only sum to n in expectation.
+        total = weights.sum().item()
+        scaled = target * n / total
+        if (scaled >= 1.).any():
+            print(f"Size band {alpha} is out of reach of weights summing to {total:.1f} of {n}, "
+                  "projecting as close as possible")
+        lower = logit(torch.minimum(target, scaled)) - scores.max(dim=0).values
+        upper = logit(torch.clamp(torch.maximum(target, scaled), max=1 - 1e-12)) - scores.min(dim=0).values
+        steps = torch.linspace(0., 1., points + 2, dtype=scores.dtype, device=scores.device)
+        columns = torch.arange(scores.shape[1], device=scores.device)
+        for _ in range(rounds):
+            grid = lower[:, None] + (upper - lower)[:, None] * steps[None, :]
+            below = (sizes(scores, grid[:, 1:-1]) < target[:, None]).sum(dim=1)
+            lower, upper = grid[columns, below], grid[columns, below + 1]
+        # the bracket end on the band's side
+        shift[outside] = torch.where(size < low, upper, lower)
+    return shift[0].item() if single else shift
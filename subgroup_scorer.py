@@ -0,0 +1,225 @@
+import argparse
+import sys
+import time
+import numpy as np
+import pandas as pd
+from scipy.special import expit as sigmoid
+from datasets import DATASETS
+from incremental import load_subgroups, ridge_terms
+from tracing import tracer
+
+
+# membership rule written by each driver: sign that turns its score into one that is positive for members, and
+# whether membership is hard. Linear driver subgroups weight rows by sigmoid(score).
+RULES = {'sigmoid': (1., False), 'logit>0': (1., True), 'cost<0': (-1., True)}
+
+
+class SubgroupScorer:
+    """
+    Scores record batches against every subgroup stored in one or more driver outputs at once. The subgroups'
+    coefficients are stacked into one matrix, with each driver's membership rule folded into their sign, so
+    membership of a batch is a single matmul followed by a threshold at zero, or a sigmoid for the linear drivers'
+    soft subgroups.
+
+    When batches carry the target, the weighted Gram statistics of every linear driver subgroup and of the full data
+    are built up batch by batch, and report() solves them for F(D), F(S) and their difference the way the linear
+    drivers do. F(S) of the LIME drivers' subgroups is an expressivity sum, not a WLS coefficient, so it is left out.
+    """
+    def __init__(self, outputs, features, target=None, membership='sigmoid'):
+        """
+        :param outputs: driver output csvs with 'Feature' and 'Subgroup Coefficients' columns, and 'Membership'
+                        for outputs of drivers other than the linear ones
+        :param features: feature columns of the records, in dataset order and without the target
+        :param target: target column, None when batches have no target
+        :param membership: 'sigmoid' or 'threshold', soft or hard membership in the linear drivers' subgroups
+        """
+        self.features = list(features)
+        self.target = target
+        self.membership = membership
+        columns = self.features + ['Intercept']
+        results, params = [], []
+        for path in outputs:
+            out, param_names, out_params = load_subgroups(path)
+            out.insert(0, 'Output', path)
+            if 'Membership' not in out.columns:
+                # linear driver outputs from before the column was written
+                if 'Intercept' not in param_names:
+                    raise ValueError(f"{path} stores no intercept or membership rule, rerun its driver to score it")
+                out['Membership'] = 'sigmoid'
+            unknown = set(out['Membership']) - set(RULES)
+            if unknown:
+                raise ValueError(f"Unknown membership rule {sorted(unknown)} in {path}")
+            # outputs of the LIME drivers only store coefficients of the sensitive features and the intercept
+            index = [columns.index(name) for name in param_names]
+            full = np.zeros((len(out), len(columns)))
+            full[:, index] = out_params * np.array([RULES[r][0] for r in out['Membership']])[:, None]
+            flat_full, flat_subgroup = ridge_terms(out, 'ext' if 'flatval' in out.columns else 'nonsep')
+            out['flat_full'], out['flat_subgroup'] = flat_full, flat_subgroup
+            results.append(out)
+            params.append(full)
+        self.results = pd.concat(results, ignore_index=True)
+        self.params = np.concatenate(params)
+        self.coef = np.ascontiguousarray(self.params[:, :-1].T)
+        self.intercept = self.params[:, -1]
+        self.feature_index = np.array([self.features.index(f) for f in self.results['Feature']])
+        rules = self.results['Membership']
+        self.hard = np.array([RULES[r][1] or membership == 'threshold' for r in rules])
+        # subgroups whose WLS statistics are aggregated
+        self.linear = np.flatnonzero(rules.to_numpy() == 'sigmoid')
+
+        d, k = len(self.features), len(self.results)
+        self.rows = 0
+        self.sizes = np.zeros(k)
+        # last entry is the full dataset
+        self.grams = np.zeros((len(self.linear) + 1, d, d))
+        self.moments = np.zeros((len(self.linear) + 1, d))
+
+    def score(self, x):
+        """
+        :param x: n x d records without target
+        :return: n x k membership of every record in every stored subgroup
+        """
+        scores = x @ self.coef
+        scores += self.intercept
+        if self.hard.all():
+            return (scores > 0).astype(np.float64)
+        out = sigmoid(scores)
+        out[:, self.hard] = scores[:, self.hard] > 0
+        return out
+
+    def update(self, x, y=None):
+        """
+        Scores one batch and adds it to the aggregates.
+        :return: n x k membership
+        """
+        weights = self.score(x)
+        self.rows += len(x)
+        self.sizes += weights.sum(axis=0)
+        if y is not None:
+            # one n x d weighted copy at a time, never an n x d^2 buffer
+            for j, c in enumerate(self.linear):
+                xw = x * weights[:, c, None]
+                self.grams[j] += xw.T @ x
+                self.moments[j] += xw.T @ y
+            self.grams[-1] += x.T @ x
+            self.moments[-1] += x.T @ y
+        return weights
+
+    def report(self):
+        """
+        :return: one row per stored subgroup with its size over all rows seen, and F(D), F(S) and Difference
+                 for the linear drivers' subgroups when the batches carried the target
+        """
+        out = self.results.drop(columns=['Subgroup Coefficients', 'flat_full', 'flat_subgroup']).copy()
+        out['Subgroup Size'] = self.sizes / max(self.rows, 1)
+        out['rows'] = self.rows
+        if self.target is None or self.rows == 0 or len(self.linear) == 0:
+            return out
+        d = len(self.features)
+        eye = np.eye(d)
+        f_d, f_s = np.full(len(out), np.nan), np.full(len(out), np.nan)
+        for j, c in enumerate(self.linear):
+            f = self.feature_index[c]
+            f_d[c] = np.linalg.solve(self.grams[-1] + self.results['flat_full'][c] * eye, self.moments[-1])[f]
+            f_s[c] = np.linalg.solve(self.grams[j] + self.results['flat_subgroup'][c] * eye, self.moments[j])[f]
+        out['F(D)'], out['F(S)'] = f_d, f_s
+        out['Difference'] = np.abs(out['F(S)'] - out['F(D)'])
+        return out
+
+
+def read_batches(paths, batch_size):
+    """
+    Streams record batches from csv files with a header row, '-' reads stdin.
+    """
+    for path in paths:
+        reader = pd.read_csv(sys.stdin if path == '-' else path, chunksize=batch_size, dtype=np.float64)
+        for batch in reader:
+            yield batch
+
+
+class MembershipWriter:
+    """
+    Streams membership matrices to a csv, or to a float32 .npy file when the path ends in .npy. Text formatting
+    caps a csv at roughly 150k rows per second, the .npy path writes raw rows and fills in the row count on close.
+    """
+    # room for any row count in the .npy header, which is rewritten in place on close
+    HEADER_BYTES = 128
+
+    def __init__(self, path, names, membership):
+        self.npy = path.endswith('.npy')
+        self.f = open(path, 'wb' if self.npy else 'w')
+        self.names = names
+        self.fmt = '%d' if membership == 'threshold' else '%.6g'
+        self.rows = 0
+        if self.npy:
+            self.write_header()
+        else:
+            self.f.write(','.join(names) + '\n')
+
+    def write_header(self):
+        header = "{'descr': '<f4', 'fortran_order': False, 'shape': (%d, %d), }" % (self.rows, len(self.names))
+        header = header.ljust(self.HEADER_BYTES - 10 - 1) + '\n'
+        self.f.write(b'\x93NUMPY\x01\x00' + np.uint16(len(header)).tobytes() + header.encode('latin1'))
+
+    def write(self, weights):
+        self.rows += len(weights)
+        if self.npy:
+            self.f.write(weights.astype('<f4').tobytes())
+        else:
+            np.savetxt(self.f, weights, fmt=self.fmt, delimiter=',')
+
+    def close(self):
+        if self.npy:
+            self.f.seek(0)
+            self.write_header()
+        self.f.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Score record batches against stored subgroups')
+    parser.add_argument('outputs', type=str, nargs='+', help='driver output csvs whose subgroups are scored')
+    parser.add_argument('--dataset', type=str, required=True, help='dataset name from datasets.DATASETS')
+    parser.add_argument('--input', type=str, nargs='+', default=['-'],
+                        help="csv files of records with a header row, '-' (default) reads stdin")
+    parser.add_argument('--membership', choices=['sigmoid', 'threshold'], default='sigmoid',
+                        help='soft membership as the linear drivers weight rows, or hard membership')
+    parser.add_argument('--batch-size', type=int, default=65536)
+    parser.add_argument('--membership-out', type=str, default=None,
+                        help="write each record's membership, one column per subgroup, to this csv or .npy file")
+    parser.add_argument('--report', type=str, default=None, help='csv for per-subgroup aggregates')
+    parser.add_argument('--trace', type=str, default=None, help='append JSON phase timings to this file')
+    args = parser.parse_args()
+    if args.trace:
+        tracer.enable(args.trace)
+
+    target = DATASETS[args.dataset]['target']
+    start = time.time()
+    scorer = None
+    membership_out = None
+    for batch in read_batches(args.input, args.batch_size):
+        if scorer is None:
+            has_target = target in batch.columns
+            features = [c for c in batch.columns if c != target]
+            scorer = SubgroupScorer(args.outputs, features, target if has_target else None, args.membership)
+            if args.membership_out:
+                membership_out = MembershipWriter(args.membership_out,
+                                                  [f'{f}_{i}' for i, f in enumerate(scorer.results['Feature'])],
+                                                  args.membership)
+        with tracer.span('score') as span:
+            span.add('rows', len(batch))
+            x = batch[scorer.features].to_numpy()
+            weights = scorer.update(x, batch[target].to_numpy() if has_target else None)
+        if membership_out is not None:
+            membership_out.write(weights)
+    if membership_out is not None:
+        membership_out.close()
+    if scorer is None:
+        print("No records")
+    else:
+        elapsed = time.time() - start
+        report = scorer.report()
+        print(report[[c for c in ['Feature', 'Subgroup Size', 'F(D)', 'F(S)', 'Difference'] if c in report.columns]])
+        print(scorer.rows, "rows in", '%.2f' % elapsed, "seconds,", '%.0f' % (scorer.rows / elapsed), "rows/second")
+        if args.report:
+            report.to_csv(args.report, index=False)
+    tracer.close()
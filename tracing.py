@@ -0,0 +1,142 @@
+import json
+import time
+from collections import defaultdict
+
+try:
+    import resource
+except ImportError:  # resource is unavailable on Windows
+    resource = None
+
+
+def peak_memory_mb():
+    """
+    Peak resident set size of this process so far, in MB. None if the platform can't report it.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is reported in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class NullSpan:
+    """
+    Span handed out while tracing is disabled. Every method is a no-op so instrumented code pays
+    one attribute lookup and one call per span.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def add(self, counter, value=1):
+        return
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    """
+    A named, timed region of the pipeline. Counters added with add() are written with the timing,
+    and a <counter>_per_sec rate is derived for each of them.
+    """
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.counters = {}
+        self.start = None
+
+    def __enter__(self):
+        self.tracer.stack.append(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        self.tracer.stack.pop()
+        self.tracer.record(self, duration, failed=exc_type is not None)
+        return False
+
+    def add(self, counter, value=1):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+
+class Tracer:
+    """
+    Collects phase timings for a run and writes them as JSON lines. Disabled by default.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.memory = False
+        self.quiet = ()
+        self.out = None
+        self.stack = []
+        self.totals = defaultdict(lambda: {'count': 0, 'seconds': 0., 'max_seconds': 0., 'counters': {}})
+
+    def enable(self, path, memory=False, quiet=('solver_step',)):
+        """
+        :param path: file that span records are appended to
+        :param memory: whether to sample peak memory at the end of every span
+        :param quiet: span names that are only aggregated into the summary records written by close()
+                      instead of getting one record each, e.g. per-iteration solver steps.
+        """
+        self.enabled = True
+        self.memory = memory
+        self.quiet = quiet
+        self.out = open(path, 'a')
+
+    def span(self, name, **attrs):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, attrs)
+
+    def record(self, span, duration, failed=False):
+        path = '/'.join(self.stack + [span.name])
+        total = self.totals[path]
+        total['count'] += 1
+        total['seconds'] += duration
+        total['max_seconds'] = max(total['max_seconds'], duration)
+        for k, v in span.counters.items():
+            total['counters'][k] = total['counters'].get(k, 0) + v
+
+        if span.name in self.quiet:
+            return
+        rec = {'span': path, 'seconds': duration}
+        rec.update(span.attrs)
+        for k, v in span.counters.items():
+            rec[k] = v
+            rec[f'{k}_per_sec'] = v / duration if duration > 0 else None
+        if self.memory:
+            rec['peak_mem_mb'] = peak_memory_mb()
+        if failed:
+            rec['failed'] = True
+        self.write(rec)
+
+    def write(self, rec):
+        self.out.write(json.dumps(rec, default=str) + '\n')
+        self.out.flush()
+
+    def close(self):
+        """
+        Write one summary record per span path and stop tracing.
+        """
+        if not self.enabled:
+            return
+        for path, total in self.totals.items():
+            rec = {'summary': path, 'count': total['count'], 'seconds': total['seconds'],
+                   'mean_seconds': total['seconds'] / total['count'], 'max_seconds': total['max_seconds']}
+            for k, v in total['counters'].items():
+                rec[k] = v
+                rec[f'{k}_per_sec'] = v / total['seconds'] if total['seconds'] > 0 else None
+            self.write(rec)
+        if self.memory:
+            self.write({'summary': 'process', 'peak_mem_mb': peak_memory_mb()})
+        self.out.close()
+        self.enabled = False
+        self.totals.clear()
+
+
+# Shared tracer for the drivers. Enabled from the command line with --trace.
+tracer = Tracer()
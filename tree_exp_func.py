@@ -0,0 +1,133 @@
+import numpy as np
+from scipy import sparse
+from exp_func import ExpFunc
+
+
+def leaf_paths(tree):
+    """
+    Every root-to-leaf path of a fitted sklearn tree, with the conditions on each feature merged.
+    :param tree: sklearn Tree (estimator.tree_)
+    :return: list of (leaf node, {feature: [lower, upper, zero_fraction]}). A row follows the path on a
+             feature when lower < x <= upper. zero_fraction is the share of training cover that goes the
+             path's way at that feature's splits, used when the feature is left out.
+    """
+    cover = tree.weighted_n_node_samples
+    paths = []
+    stack = [(0, {})]
+    while stack:
+        node, conditions = stack.pop()
+        left, right = tree.children_left[node], tree.children_right[node]
+        if left == -1:
+            paths.append((node, conditions))
+            continue
+        f, thr = tree.feature[node], tree.threshold[node]
+        for child, is_left in [(left, True), (right, False)]:
+            lower, upper, zero = conditions.get(f, [-np.inf, np.inf, 1.])
+            if is_left:
+                upper = min(upper, thr)
+            else:
+                lower = max(lower, thr)
+            child_conditions = dict(conditions)
+            child_conditions[f] = [lower, upper, zero * cover[child] / cover[node]]
+            stack.append((child, child_conditions))
+    return paths
+
+
+class TreeShapExpFunc(ExpFunc):
+    """
+    Exact path-dependent TreeSHAP attributions of a fitted sklearn tree ensemble, as a drop-in for LimeExpFunc.
+    Explains the probability of class `label` (LIME's default label) for classifiers, the prediction for regressors.
+
+    For one leaf with k distinct path features, a row either satisfies all of the path's conditions on feature j
+    (o_j = 1) or not (o_j = 0), and z_j is that feature's zero fraction. The leaf's share of the Shapley value of
+    feature i is then
+        value * (o_i - z_i) * integral_0^1 prod_{j != i} (z_j + (o_j - z_j) u) du
+    since the Shapley weights s!(k-s-1)!/k! are Beta integrals. The integrand has degree k-1, so Gauss-Legendre
+    quadrature with ceil(k/2) nodes is exact. Leaves from all trees are grouped by k, and each group is computed
+    for a block of rows at once with batched matrix products.
+    """
+    def __init__(self, classifier, dataset, seed=None, label=1, max_block_bytes=2**28):
+        self.classifier = classifier
+        self.dataset = dataset
+        self.label = label
+        self.max_block_bytes = max_block_bytes
+        self.exps = []
+        self.matrix = None
+
+        trees = getattr(classifier, 'estimators_', [classifier])
+        self.n_features = classifier.n_features_in_
+        groups = {}
+        for est in trees:
+            tree = est.tree_
+            value = tree.value[:, 0, :]
+            if value.shape[1] > 1:
+                value = value[:, label] / value.sum(axis=1)
+            else:
+                value = value[:, 0]
+            for leaf, conditions in leaf_paths(tree):
+                k = len(conditions)
+                if k == 0:
+                    continue
+                items = sorted(conditions.items())
+                group = groups.setdefault(k, ([], [], [], [], []))
+                group[0].append([f for f, _ in items])
+                group[1].append([c[0] for _, c in items])
+                group[2].append([c[1] for _, c in items])
+                group[3].append([c[2] for _, c in items])
+                group[4].append(value[leaf] / len(trees))
+        self.groups = {k: self.prepare_group(k, *(np.array(g) for g in group)) for k, group in groups.items()}
+
+    def prepare_group(self, k, features, lower, upper, zero, value):
+        """
+        Per-leaf quadrature terms for the leaves with k path features.
+        :return: features, lower, upper (L x k), log integrand at o = 0 (L x 1 x q), its change when o_j = 1
+                 (L x k x q), the weights taking the integrand at each node to feature i's contribution when o_i = 0
+                 and when o_i = 1 (L x q x k each), and the (L*k) x p matrix that sums contributions into features
+        """
+        nodes, weights = np.polynomial.legendre.leggauss((k + 1) // 2)
+        u, weights = (nodes + 1) / 2, weights / 2
+        # factor of feature j at node u: z_j (1 - u) when o_j = 0, z_j + (1 - z_j) u when o_j = 1
+        off = zero[:, :, None] * (1 - u)
+        on = zero[:, :, None] + (1 - zero[:, :, None]) * u
+        log_off = np.log(off)
+        # quadrature weight, feature i's own factor divided back out, and value * (o_i - z_i)
+        scale = value[:, None, None] * weights
+        to_off = (-zero[:, :, None] * scale / off).transpose(0, 2, 1)
+        to_on = ((1 - zero[:, :, None]) * scale / on).transpose(0, 2, 1)
+        scatter = sparse.csr_matrix((np.ones(features.size), (np.arange(features.size), features.ravel())),
+                                    shape=(features.size, self.n_features))
+        return (features, lower, upper, log_off.sum(axis=1)[:, None, :], np.log(on) - log_off, to_off, to_on,
+                scatter)
+
+    def attributions(self, x):
+        """
+        :param x: n x p rows to explain
+        :return: n x p matrix of attributions
+        """
+        # sklearn trees split on float32 values
+        x = np.asarray(x, dtype=np.float32)
+        n = x.shape[0]
+        phi = np.zeros((n, self.n_features))
+        for k, (features, lower, upper, log_base, log_step, to_off, to_on, scatter) in self.groups.items():
+            n_leaves = len(features)
+            block = max(1, int(self.max_block_bytes // (8 * n_leaves * (3*k + 2*log_base.shape[2]))))
+            for start in range(0, n, block):
+                vals = x[start:start + block, features].transpose(1, 0, 2)
+                ones = (vals > lower[:, None, :]) & (vals <= upper[:, None, :])
+                # L x rows x q integrand over all k factors
+                full = np.exp(log_base + ones.astype(float) @ log_step)
+                contrib = np.where(ones, full @ to_on, full @ to_off)
+                phi[start:start + block] += scatter.T.dot(contrib.transpose(1, 0, 2).reshape(len(vals[0]), -1).T).T
+        return phi
+
+    # Populate exps with expressivity dictionaries, same layout as LimeExpFunc
+    # exps[n][i] returns expressivity of feature i in datapoint n
+    # rows defaults to the dataset, other rows are appended to exps as in LimeExpFunc
+    def populate_exps(self, rows=None):
+        matrix = self.attributions(self.dataset if rows is None else rows)
+        if rows is None or len(self.exps) == 0:
+            self.matrix = matrix
+            self.exps = [dict(enumerate(row)) for row in matrix.tolist()]
+        else:
+            self.matrix = np.vstack([self.as_matrix(), matrix])
+            self.exps += [dict(enumerate(row)) for row in matrix.tolist()]
@@ -0,0 +1,65 @@
+import torch
+from torch.nn.functional import softplus
+
+
+def wls_loss(x_0: torch.Tensor, x_t: torch.Tensor, x: torch.Tensor, y: torch.Tensor, params: torch.Tensor,
+             sensitives: torch.Tensor, basis: torch.Tensor, flat: torch.Tensor, consts: torch.Tensor,
+             smoothing: float) -> torch.Tensor:
+    """
+    loss_fn_generator's dense loss as one function for torch.jit.script or torch.compile. Rows are weighted by
+    broadcasting instead of an n x n diag, and the size penalty uses clamp instead of Python max, so the whole
+    step stays inside the graph. Values match the eager loss.
+    :param x_t: x transposed, contiguous, built once per feature
+    :param basis: 1 x d one-hot row of the feature
+    :param flat: d x d ridge matrix
+    :param consts: initial_val, alpha low, alpha high and lam, as a tensor so compiled graphs don't specialize on
+                   them
+    :param smoothing: see linearexpressivity.size_penalty
+    """
+    one_d = torch.sigmoid(x_0 @ (sensitives * params))
+    x_tw = (x_t * one_d).contiguous()
+    denom = torch.inverse((x_tw @ x) + flat)
+    difference_penalty = torch.abs(basis @ (denom @ (x_tw @ y)) - consts[0])
+
+    size = torch.sum(one_d)/x.shape[0]
+    if smoothing > 0:
+        size_penalty = consts[3]*(softplus(consts[1]-size, smoothing) + softplus(size-consts[2], smoothing))
+    else:
+        size_penalty = consts[3]*(torch.clamp(consts[1]-size, min=0.) + torch.clamp(size-consts[2], min=0.))
+    return size_penalty - .1*difference_penalty
+
+
+class FusedLoss:
+    """
+    wls_loss scripted ('script') or compiled with inductor ('compile'), falling back to the eager function when
+    the backend is unavailable, e.g. without a C++ compiler for inductor. torch.compile fails on the first call
+    rather than when it is set up, so the first call falls back too. Later errors, like a singular Gram matrix, are
+    raised as they are by the eager loss.
+    """
+    def __init__(self, mode: str):
+        self.mode = mode
+        self.fn = wls_loss
+        self.checked = False
+        try:
+            if mode == 'script':
+                self.fn = torch.jit.script(wls_loss)
+            elif mode == 'compile':
+                self.fn = torch.compile(wls_loss, dynamic=False)
+        except Exception as e:
+            self.fallback(e)
+
+    def fallback(self, e):
+        print(f"Falling back to the eager WLS loss, {self.mode} failed: {type(e).__name__}: {e}")
+        self.mode = 'eager'
+        self.fn = wls_loss
+
+    def __call__(self, *args):
+        if self.checked or self.mode == 'eager':
+            return self.fn(*args)
+        try:
+            out = self.fn(*args)
+        except Exception as e:
+            self.fallback(e)
+            out = self.fn(*args)
+        self.checked = True
+        return out